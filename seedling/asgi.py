@@ -0,0 +1,40 @@
+"""
+ASGI config for seedling project.
+
+It exposes the ASGI callable as a module-level variable named ``application``. gunicorn_config.py serves this instead
+of seedling.wsgi when GUNICORN_ASGI=True, through uvicorn's gunicorn worker class.
+
+Django runs sync views and middleware through sync_to_async(thread_sensitive=True), which on its own puts all of them
+in one thread per process, so a slow sync view would hold up every other request. ``application`` runs each request
+in a ThreadSensitiveContext instead, which gives each request's sync code a thread of its own. Each of those threads
+gets its own database connections, so settings.py closes them at the end of every request when SERVING_ASGI is set.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.2/howto/deployment/asgi/
+"""
+import os
+import sys
+
+from asgiref.sync import ThreadSensitiveContext
+from django.core.asgi import get_asgi_application
+
+# This allows easy placement of apps within the interior seedling directory.
+app_path = os.path.abspath(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+)
+sys.path.append(os.path.join(app_path, "seedling"))
+
+# We defer to a DJANGO_SETTINGS_MODULE already in the environment.
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'seedling.settings')
+# This tells settings.py not to keep database connections open between requests.
+os.environ['SERVING_ASGI'] = 'True'
+
+django_application = get_asgi_application()
+
+
+async def application(scope, receive, send):
+    """
+    This application object is used by any ASGI server configured to use this file.
+    """
+    async with ThreadSensitiveContext():
+        await django_application(scope, receive, send)
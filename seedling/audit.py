@@ -0,0 +1,278 @@
+"""
+An asynchronous, queue-backed pipeline for our model audit log events.
+
+The ``log_*`` functions in ``seedling.logging`` take the logger to write to as their first argument.  When they're
+handed ``audit_logger`` instead of a structlog logger, their events are put on a bounded in-process queue instead of
+being rendered and written inside the request thread.  A background writer thread drains that queue in batches and
+hands the events to the real logger.
+
+Because the writer thread has no current request, we capture the request context (``remote_ip``, ``username``,
+``superuser``) and the time at the moment the event is logged, so the log lines look exactly like they did when
+written inline. The request context is kept apart from the event's own fields, which can have the same names (e.g. a
+``users.User`` event's ``username``). Log lines get it with ``setdefault()`` semantics, plus ``actor_<name>`` for
+each field that the event shadows, and stored ``AuditEvent`` rows get it in their own columns.
+
+Events logged inside a transaction are held back until that transaction commits, and are thrown away if it rolls
+back, so we never log changes that didn't actually happen, and never write log lines while holding row locks.  Pass
+``audit_logger.using(alias)`` to the ``log_*`` functions to tie their events to a database other than the default one.
+
+Configure the pipeline with these settings:
+
+  ``AUDIT_LOG_ON_COMMIT``: (bool) If ``False``, events are logged immediately, even inside a transaction.
+  ``AUDIT_LOG_ASYNC``: (bool) If ``False``, events are written synchronously, just like a normal logger.
+  ``AUDIT_LOG_QUEUE_SIZE``: (int) The maximum number of events that may be waiting to be written.
+  ``AUDIT_LOG_BATCH_SIZE``: (int) The maximum number of events the writer thread writes per wakeup.
+  ``AUDIT_LOG_FLUSH_INTERVAL``: (float) The longest time, in seconds, the writer thread waits for more events.
+  ``AUDIT_LOG_FULL_POLICY``: (string) What to do when the queue is full: "block" waits up to
+      ``AUDIT_LOG_BLOCK_TIMEOUT`` seconds for room before dropping the event, "drop" drops it immediately.
+      Dropped events are counted, and the count is logged as an ``audit.dropped`` warning by the writer thread.
+  ``AUDIT_LOG_STORE``: (bool) If ``True``, events are also saved as ``seedling.core.models.AuditEvent`` rows, with one
+      bulk INSERT per batch that the writer thread writes.
+"""
+import atexit
+import contextvars
+import os
+import queue
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, transaction
+from django.utils import timezone
+
+from .logging import get_request_context_fields, logger as seedling_logger
+
+
+class AuditPipeline(object):
+    """
+    A logger-like object which queues ``info()`` calls for a background writer thread.
+
+    :param logger: the logger that the writer thread writes our events to
+    :type logger: a structlog logger
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+        self._stopping = False
+        self._atexit_registered = False
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'AUDIT_LOG_ASYNC', False)
+
+    def info(self, event, **kwargs):
+        """
+        Queue an INFO level event for the writer thread. This has the same signature as structlog's ``info()``.
+        """
+        self._log(event, kwargs, DEFAULT_DB_ALIAS)
+
+    def using(self, alias):
+        """
+        Return a logger-like object whose events wait for the current transaction on database ``alias`` to commit.
+        """
+        return _DatabaseAuditLogger(self, alias)
+
+    def _log(self, event, kwargs, using):
+        if getattr(settings, 'AUDIT_LOG_ON_COMMIT', True) and transaction.get_connection(using).in_atomic_block:
+            # Capture the request context and time now, since on_commit() hooks may run after the request context is
+            # gone, and some time after the change was made.
+            emit = partial(self._emit, event, kwargs, get_request_context_fields(), timezone.now())
+            # Django keeps these hooks in order, runs them all right after the outermost commit, and drops the ones
+            # registered inside a savepoint that gets rolled back, along with all of them on a full rollback.
+            transaction.on_commit(emit, using=using)
+        else:
+            self._emit(event, kwargs)
+
+    def _emit(self, event, kwargs, context=None, timestamp=None):
+        if context is None:
+            # Capture the request context and time now, while we're still in the request thread.
+            context = get_request_context_fields()
+            timestamp = timezone.now()
+        item = (event, kwargs, context, timestamp)
+        if not self.enabled or self._stopping:
+            self._write_log_line(item)
+            if self.store_enabled:
+                self._store([item])
+            return
+        self._put(item)
+
+    def _write_log_line(self, item):
+        event, kwargs, context, _ = item
+        kwargs = dict(kwargs)
+        for key, value in context.items():
+            if key not in kwargs:
+                kwargs[key] = value
+            elif kwargs[key] != value:
+                kwargs[f'actor_{key}'] = value
+        self.logger.info(event, **kwargs)
+
+    @property
+    def store_enabled(self):
+        return getattr(settings, 'AUDIT_LOG_STORE', False)
+
+    def _store(self, events):
+        """
+        Save the given (event, kwargs, request context, timestamp) tuples as AuditEvent rows, in a single bulk INSERT.
+        """
+        # This is imported here because models can't be imported until the app registry is ready.
+        from .core.models import AuditEvent
+        try:
+            # The savepoint keeps a failed INSERT from breaking any transaction we happen to be in.
+            with transaction.atomic():
+                AuditEvent.objects.bulk_create([AuditEvent.from_log_event(*item) for item in events])
+        except Exception:  # noqa
+            # A broken event must never lose the rest of the batch's log lines, nor kill the writer thread.
+            seedling_logger.exception('audit.store.failed', count=len(events))
+
+    def _put(self, item):
+        self._ensure_started()
+        try:
+            if getattr(settings, 'AUDIT_LOG_FULL_POLICY', 'block') == 'drop':
+                self._queue.put_nowait(item)
+            else:
+                self._queue.put(item, timeout=getattr(settings, 'AUDIT_LOG_BLOCK_TIMEOUT', 5.0))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _ensure_started(self):
+        # The writer thread doesn't survive a fork(), so each gunicorn worker starts its own the first time it logs.
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._queue = queue.Queue(maxsize=getattr(settings, 'AUDIT_LOG_QUEUE_SIZE', 10000))
+            # Each writer thread only ever reads the queue it was started with.
+            self._thread = threading.Thread(target=self._run, args=(self._queue,), name='audit-log-writer', daemon=True)
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread.start()
+            if not self._atexit_registered:
+                # Flush on the way out of manage.py commands and the like. gunicorn workers use worker_exit instead.
+                atexit.register(self.stop)
+                self._atexit_registered = True
+
+    def _run(self, items):
+        batch_size = getattr(settings, 'AUDIT_LOG_BATCH_SIZE', 100)
+        flush_interval = getattr(settings, 'AUDIT_LOG_FLUSH_INTERVAL', 1.0)
+        while True:
+            try:
+                batch = [items.get(timeout=flush_interval)]
+            except queue.Empty:
+                batch = []
+            while len(batch) < batch_size:
+                try:
+                    batch.append(items.get_nowait())
+                except queue.Empty:
+                    break
+            done = self._write(batch)
+            for _ in batch:
+                items.task_done()
+            if done:
+                return
+
+    def _write(self, batch):
+        """
+        Write the given batch of queued items to our logger. Returns ``True`` if the batch contained our stop marker.
+        """
+        done = False
+        events = []
+        for item in batch:
+            if item is None:
+                done = True
+            elif isinstance(item, threading.Event):
+                # flush() is waiting for everything queued before this marker to be written.
+                item.set()
+            else:
+                events.append(item)
+                try:
+                    self._write_log_line(item)
+                except Exception:  # noqa
+                    # A broken event must never kill the writer thread.
+                    seedling_logger.exception('audit.write.failed', audit_event=item[0])
+        if events and self.store_enabled:
+            # The writer thread has its own database connection, which nothing else ever recycles.
+            close_old_connections()
+            self._store(events)
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if dropped:
+            seedling_logger.warning('audit.dropped', count=dropped)
+        return done
+
+    def flush(self, timeout=5.0):
+        """
+        Wait up to ``timeout`` seconds for every event queued so far to be written. Returns ``True`` on success.
+        """
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return True
+        marker = threading.Event()
+        try:
+            self._queue.put(marker, timeout=timeout)
+        except queue.Full:
+            return False
+        return marker.wait(timeout)
+
+    def stop(self, timeout=5.0):
+        """
+        Write everything that's been queued so far, then shut down the writer thread. Any events logged after this
+        are written synchronously.
+        """
+        if self._thread is None or self._pid != os.getpid() or not self._thread.is_alive():
+            return
+        self._stopping = True
+        self.flush(timeout=timeout)
+        try:
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+
+
+class _DatabaseAuditLogger(object):
+    """
+    What ``AuditPipeline.using()`` returns.
+    """
+
+    __slots__ = ('pipeline', 'alias')
+
+    def __init__(self, pipeline, alias):
+        self.pipeline = pipeline
+        self.alias = alias
+
+    def info(self, event, **kwargs):
+        self.pipeline._log(event, kwargs, self.alias)
+
+
+audit_logger = AuditPipeline(seedling_logger)
+
+# Set while an operation which logs its own aggregate audit event is running.
+_audit_suppressed = contextvars.ContextVar('audit_suppressed', default=False)
+
+
+@contextmanager
+def suppress_audit():
+    """
+    Within this context, the ``seedling.core.signals`` receivers don't log per-instance events, and the bulk
+    operations of ``seedling.core.managers.AuditedQuerySetMixin`` don't log their own events. Bulk operations use this
+    so that e.g. a QuerySet.delete() logs one ``model.bulk_delete`` event instead of one event per deleted row.
+    """
+    token = _audit_suppressed.set(True)
+    try:
+        yield
+    finally:
+        _audit_suppressed.reset(token)
+
+
+def audit_suppressed():
+    """
+    Return ``True`` if we're inside ``suppress_audit()``.
+    """
+    return _audit_suppressed.get()
@@ -1,4 +1,5 @@
 from django.apps import AppConfig
+from django.contrib.auth.signals import user_logged_in, user_logged_out
 
 
 class CoreConfig(AppConfig):
@@ -8,14 +9,19 @@ class CoreConfig(AppConfig):
 
     def ready(self):
         """
-        This function runs as soon as the app is loaded. It loads our signal receivers.
+        This function runs as soon as the app is loaded. It connects our signal receivers to the audited models, and
+        to login and logout, which change the user that our log messages name.
         """
         # As suggested by the Django docs, we need to make absolutely certain that this code runs only once.
         if not self.ready_is_done:
             # See https://docs.djangoproject.com/en/dev/topics/signals/#connecting-receiver-functions, in the
-            # "Where should this code live?" section, for why this import is inside CoreConfig.ready().
-            # To disable model change logging, comment out this import.
-            from . import signals  # noqa:F401
+            # "Where should this code live?" section, for why this is inside CoreConfig.ready().
+            # To disable model change logging, comment out this line.
+            from .registry import audit_registry
+            audit_registry.connect()
+            from ..logging import forget_request_logging_user
+            user_logged_in.connect(forget_request_logging_user, dispatch_uid='seedling.logging.user_logged_in')
+            user_logged_out.connect(forget_request_logging_user, dispatch_uid='seedling.logging.user_logged_out')
             self.ready_is_done = True
         else:
             print(f"{self.__class__.__name__}.ready() executed multiple times! It is skipped on subsequent runs.")
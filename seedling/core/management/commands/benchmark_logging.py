@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import logging
+import timeit
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+import structlog
+
+from seedling.logging import (
+    PrecompiledConsoleRenderer,
+    bind_request_logging_context,
+    clear_request_logging_context,
+)
+from seedling.middleware import reset_current_request, set_current_request
+
+
+class _NullStream(object):
+
+    def write(self, msg):
+        pass
+
+    def flush(self):
+        pass
+
+
+class Command(BaseCommand):
+    """
+    Measure the per-call overhead of ``logger.info()`` through our full structlog processor chain, inside a fake
+    request, before and after our logging optimizations:
+
+      ``before``: no logger caching, and the request context looked up on every call.
+      ``after``: logger caching, and the request context bound once per request.
+
+    The output is rendered but thrown away, so this measures our own overhead rather than the cost of I/O.
+    """
+    help = 'Benchmark the per-call overhead of structlog logging.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=50000, help='How many log calls to make per scenario.')
+
+    def _make_logger(self, name):
+        handler = logging.StreamHandler(_NullStream())
+        handler.setFormatter(structlog.stdlib.ProcessorFormatter(processor=PrecompiledConsoleRenderer()))
+        stdlib_logger = logging.getLogger(name)
+        stdlib_logger.handlers = [handler]
+        stdlib_logger.setLevel(logging.INFO)
+        stdlib_logger.propagate = False
+        return structlog.get_logger(name)
+
+    def _run(self, name, cache_loggers, bind_context, calls):
+        structlog.configure(cache_logger_on_first_use=cache_loggers)
+        logger = self._make_logger(f'seedling.benchmark.{name}')
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        request_token = set_current_request(request)
+        token = bind_request_logging_context(request) if bind_context else None
+        try:
+            seconds = timeit.timeit(lambda: logger.info('benchmark.event', pk=42, model='users.User'), number=calls)
+        finally:
+            if token is not None:
+                clear_request_logging_context(token)
+            reset_current_request(request_token)
+        return seconds / calls * 1e6
+
+    def handle(self, **options):
+        original_config = structlog.get_config()
+        try:
+            before = self._run('before', cache_loggers=False, bind_context=False, calls=options['calls'])
+            after = self._run('after', cache_loggers=True, bind_context=True, calls=options['calls'])
+        finally:
+            structlog.configure(**original_config)
+        self.stdout.write(f'before: {before:.2f} µs/call')
+        self.stdout.write(f'after: {after:.2f} µs/call')
+        self.stdout.write(f'Speedup: {before / after:.2f}x')
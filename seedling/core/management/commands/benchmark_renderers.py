@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from seedling.logging import ConsoleRenderer, PrecompiledConsoleRenderer
+
+# A representative mix of events: a plain request log line, a model.update audit event, and an error with a traceback.
+SAMPLE_EVENTS = [
+    {
+        'timestamp': '2021-11-02T17:25:01.123456Z',
+        'level': 'info',
+        'logger': 'seedling',
+        'event': 'user.login',
+        'remote_ip': '10.0.0.1',
+        'username': 'jdoe',
+        'superuser': False,
+    },
+    {
+        'timestamp': '2021-11-02T17:25:01.223456Z',
+        'level': 'info',
+        'logger': 'seedling',
+        'event': 'model.update',
+        'model': 'users.User',
+        'pk': 42,
+        'full_name': '"Jane" -> "Jane Doe"',
+        'remote_ip': '10.0.0.1',
+        'username': 'jdoe',
+        'superuser': False,
+    },
+    {
+        'timestamp': '2021-11-02T17:25:01.323456Z',
+        'level': 'error',
+        'logger': 'django.request',
+        'event': 'Internal Server Error: /users/',
+        'exception': 'Traceback (most recent call last):\n  File "views.py", line 1\nValueError: nope',
+        'status_code': 500,
+    },
+]
+
+
+class Command(BaseCommand):
+    """
+    Compare the events/sec of ``ConsoleRenderer`` and ``PrecompiledConsoleRenderer``, after verifying that they
+    produce identical output for every combination of options.
+    """
+    help = 'Benchmark the structlog console renderers against each other.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--events', type=int, default=100000, help='How many events to render per renderer.')
+
+    def handle(self, **options):
+        for colors in (False, True):
+            for newlines in (False, True):
+                reference = ConsoleRenderer(colors=colors, newlines=newlines)
+                precompiled = PrecompiledConsoleRenderer(colors=colors, newlines=newlines)
+                for event in SAMPLE_EVENTS:
+                    if reference(None, None, dict(event)) != precompiled(None, None, dict(event)):
+                        raise CommandError(
+                            f'Output differs for colors={colors}, newlines={newlines}, event={event["event"]!r}'
+                        )
+
+        count = options['events']
+        rounds = max(count // len(SAMPLE_EVENTS), 1)
+        results = {}
+        for renderer_class in (ConsoleRenderer, PrecompiledConsoleRenderer):
+            renderer = renderer_class(colors=False, newlines=False)
+
+            def render():
+                for event in SAMPLE_EVENTS:
+                    renderer(None, None, dict(event))
+
+            seconds = timeit.timeit(render, number=rounds)
+            results[renderer_class.__name__] = (rounds * len(SAMPLE_EVENTS)) / seconds
+            self.stdout.write(f'{renderer_class.__name__}: {results[renderer_class.__name__]:,.0f} events/sec')
+        speedup = results['PrecompiledConsoleRenderer'] / results['ConsoleRenderer']
+        self.stdout.write(f'Speedup: {speedup:.2f}x')
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import datetime
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from seedling.core.models import AuditEvent
+from seedling.logging import logger
+
+
+class Command(BaseCommand):
+    """
+    Delete the stored audit log events that are older than the retention period, in batches of ``--batch-size`` rows,
+    so that the audit table is never locked for long and replication never falls far behind.
+    """
+    help = 'Delete stored audit log events older than AUDIT_LOG_STORE_RETENTION_DAYS, in bounded batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='Keep this many days of events. Defaults to settings.AUDIT_LOG_STORE_RETENTION_DAYS.'
+        )
+        parser.add_argument('--batch-size', type=int, default=1000, help='How many rows to delete per DELETE.')
+        parser.add_argument('--sleep', type=float, default=0.0, help='How many seconds to pause between batches.')
+
+    def handle(self, **options):
+        days = options['days'] if options['days'] is not None else settings.AUDIT_LOG_STORE_RETENTION_DAYS
+        cutoff = timezone.now() - datetime.timedelta(days=days)
+        logger.info('audit.prune.start', cutoff=cutoff)
+        total = 0
+        for deleted in AuditEvent.objects.prune(cutoff, batch_size=options['batch_size']):
+            total += deleted
+            if options['sleep']:
+                time.sleep(options['sleep'])
+        logger.info('audit.prune.end', cutoff=cutoff, deleted=total)
+        self.stdout.write(f'Deleted {total} audit events older than {cutoff.isoformat()}.')
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import datetime
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from seedling.profiling import ProfileStore
+
+
+class Command(BaseCommand):
+    """
+    List the slow request profiles that ``seedling.middleware.SlowRequestProfilerMiddleware`` has stored, or dump one
+    of them as JSON.
+    """
+    help = 'List the stored slow request profiles, or dump one of them as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('profile_id', nargs='?', help='The id of the profile to dump. Omit to list them all.')
+        parser.add_argument('--clear', action='store_true', help='Delete all the stored profiles.')
+
+    def handle(self, **options):
+        store = ProfileStore(
+            max_entries=settings.SLOW_REQUEST_PROFILE_MAX_ENTRIES,
+            timeout=settings.SLOW_REQUEST_PROFILE_TIMEOUT,
+        )
+        if options['clear']:
+            store.clear()
+            return
+        if options['profile_id']:
+            profile = store.get(options['profile_id'])
+            if profile is None:
+                raise CommandError(f'No profile with id {options["profile_id"]!r}; it may have expired.')
+            self.stdout.write(json.dumps(profile, indent=2))
+            return
+        for profile_id, timestamp, duration_ms, method, path in store.list():
+            when = datetime.datetime.fromtimestamp(timestamp, tz=datetime.timezone.utc).isoformat(timespec='seconds')
+            self.stdout.write(f'{profile_id}  {when}  {duration_ms:>10.1f} ms  {method} {path}')
@@ -0,0 +1,112 @@
+from django.conf import settings
+from django.db import models
+from django.db.models import Max, Min
+
+from ..audit import audit_logger, audit_suppressed, suppress_audit
+from ..logging import log_bulk_operation, summarize_pks
+from .registry import audit_registry
+from .snapshots import remember_snapshot
+
+
+class AuditedQuerySetMixin(object):
+    """
+    A QuerySet mixin which audit logs bulk operations as one compact ``model.bulk_<operation>`` event each, with the
+    model, a pk list (or, for many rows, the first and last pks), the written columns and the row count.
+
+    Without this, ``bulk_create()``, ``bulk_update()`` and ``update()`` aren't audit logged at all, since they don't
+    send any signals, and ``delete()`` logs one full ``model.delete`` event per deleted row.
+
+    Use it like this::
+
+        class BookQuerySet(AuditedQuerySetMixin, models.QuerySet):
+            ...
+
+        class Book(models.Model):
+            objects = models.Manager.from_queryset(BookQuerySet)()
+    """
+
+    def _audited(self):
+        return audit_registry.is_audited(self.model) and not audit_suppressed()
+
+    def _pk_summary(self):
+        """
+        Return summarize_pks()'s log fields for the rows this QuerySet matches, loading no more than
+        AUDIT_LOG_BULK_PK_LIMIT + 1 of their pks.
+        """
+        limit = settings.AUDIT_LOG_BULK_PK_LIMIT
+        pks = list(self.values_list('pk', flat=True)[:limit + 1])
+        if len(pks) <= limit:
+            return summarize_pks(pks, limit)
+        return self.aggregate(first_pk=Min('pk'), last_pk=Max('pk'))
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        if self._audited() and objs:
+            for obj in objs:
+                remember_snapshot(obj)
+            log_bulk_operation(
+                audit_logger.using(self.db),
+                self.model,
+                'create',
+                len(objs),
+                pk_summary=summarize_pks([obj.pk for obj in objs], settings.AUDIT_LOG_BULK_PK_LIMIT),
+            )
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        objs = tuple(objs)
+        audited = self._audited()
+        # bulk_update() does its work through update(), which must not log a second event.
+        with suppress_audit():
+            result = super().bulk_update(objs, fields, *args, **kwargs)
+        if audited and objs:
+            for obj in objs:
+                # Keep the snapshots that seedling.core.signals diffs against in step with what we just wrote.
+                remember_snapshot(obj, update_fields=fields)
+            log_bulk_operation(
+                audit_logger.using(self.db),
+                self.model,
+                'update',
+                len(objs),
+                pk_summary=summarize_pks([obj.pk for obj in objs], settings.AUDIT_LOG_BULK_PK_LIMIT),
+                fields=fields,
+            )
+        return result
+
+    def update(self, **kwargs):
+        if not self._audited() or self.query.is_sliced:
+            # Sliced QuerySets can't be updated; let Django raise the appropriate error.
+            return super().update(**kwargs)
+        pk_summary = self._pk_summary()
+        rows = super().update(**kwargs)
+        if rows:
+            log_bulk_operation(
+                audit_logger.using(self.db), self.model, 'update', rows, pk_summary=pk_summary, fields=kwargs.keys()
+            )
+        return rows
+
+    update.alters_data = True
+
+    def delete(self):
+        if not self._audited() or self.query.is_sliced:
+            # Sliced QuerySets can't be deleted; let Django raise the appropriate error.
+            return super().delete()
+        pk_summary = self._pk_summary()
+        with suppress_audit():
+            deleted, per_model = super().delete()
+        if deleted:
+            # per_model also counts the rows removed by cascades, which would each have been logged individually.
+            log_bulk_operation(
+                audit_logger.using(self.db), self.model, 'delete', deleted, pk_summary=pk_summary, deleted=per_model
+            )
+        return deleted, per_model
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class AuditedQuerySet(AuditedQuerySetMixin, models.QuerySet):
+    pass
+
+
+AuditedManager = models.Manager.from_queryset(AuditedQuerySet)
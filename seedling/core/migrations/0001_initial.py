@@ -0,0 +1,41 @@
+# Generated by Django 3.2.8 on 2026-10-18 18:02
+
+from django.db import migrations, models
+import django.utils.timezone
+import seedling.core.models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AuditEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(default=django.utils.timezone.now)),
+                ('event', models.CharField(max_length=64)),
+                ('model', models.CharField(blank=True, max_length=100)),
+                ('object_pk', models.CharField(blank=True, max_length=64)),
+                ('username', models.CharField(blank=True, max_length=150)),
+                ('remote_ip', models.CharField(blank=True, max_length=64)),
+                ('data', models.JSONField(default=dict, encoder=seedling.core.models.AuditEventJSONEncoder)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='auditevent',
+            index=models.Index(fields=['model', 'object_pk', 'timestamp'], name='core_audit_object_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditevent',
+            index=models.Index(fields=['username', 'timestamp'], name='core_audit_username_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='auditevent',
+            index=models.Index(fields=['timestamp'], name='core_audit_timestamp_idx'),
+        ),
+    ]
@@ -1,3 +1,156 @@
+import json
+
+from django.apps import apps
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from ..logging import _json_default
+
+
+class AuditEventJSONEncoder(json.JSONEncoder):
+    """
+    Encodes audit event data the same way the JSON log renderer does.
+    """
+
+    def default(self, o):
+        return _json_default(o)
+
+
+class AuditEventQuerySet(models.QuerySet):
+
+    def for_object(self, model, pk):
+        """
+        Return the events about the object with primary key ``pk``.
+
+        :param model: the object's model class, or its app_label.ModelName string
+        """
+        if not isinstance(model, str):
+            model = model._meta.label
+        return self.filter(model=model, object_pk=str(pk))
+
+    def for_user(self, username):
+        """
+        Return the events caused by the user with the given username.
+        """
+        return self.filter(username=username)
+
+    def between(self, since=None, until=None):
+        """
+        Return the events logged at or after ``since`` and before ``until``. Either may be ``None``.
+        """
+        qs = self
+        if since is not None:
+            qs = qs.filter(timestamp__gte=since)
+        if until is not None:
+            qs = qs.filter(timestamp__lt=until)
+        return qs
+
+    def page(self, cursor=None, size=50):
+        """
+        Return one page of these events, newest first, as an ``(events, next_cursor)`` pair. Pass ``next_cursor`` back
+        in to get the next page; it's ``None`` on the last page.
+
+        This uses keyset pagination on (timestamp, id) rather than OFFSET, so every page costs the same no matter how
+        deep into the results it is.
+        """
+        qs = self.order_by('-timestamp', '-id')
+        if cursor is not None:
+            timestamp, pk = self._parse_cursor(cursor)
+            qs = qs.filter(Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lt=pk))
+        events = list(qs[:size + 1])
+        if len(events) <= size:
+            return events, None
+        events = events[:size]
+        last = events[-1]
+        return events, '{}|{}'.format(last.timestamp.isoformat(), last.pk)
+
+    @staticmethod
+    def _parse_cursor(cursor):
+        try:
+            timestamp, pk = cursor.rsplit('|', 1)
+            timestamp = parse_datetime(timestamp)
+            pk = int(pk)
+        except (AttributeError, TypeError, ValueError):
+            timestamp = None
+        if timestamp is None:
+            raise ValueError(f'Invalid audit event cursor: {cursor!r}')
+        return timestamp, pk
+
+    def prune(self, before, batch_size=1000):
+        """
+        Delete these events if they were logged before ``before``, ``batch_size`` rows at a time, so that no single
+        DELETE holds its locks for long. Yields the number of rows deleted by each batch.
+        """
+        qs = self.filter(timestamp__lt=before)
+        while True:
+            pks = list(qs.order_by('timestamp', 'id').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return
+            # AuditEvent has no relations or delete signal receivers, so this is a single DELETE statement.
+            deleted, _ = self.model.objects.filter(pk__in=pks).delete()
+            yield deleted
+
+
+class AuditEvent(models.Model):
+    """
+    One model audit log event, as written by seedling.audit when the AUDIT_LOG_STORE setting is on.
+
+    ``model`` and ``object_pk`` identify the object the event is about. Bulk events have no ``object_pk``; their pks
+    are in ``data``, along with everything else that was logged. ``username`` and ``remote_ip`` are those of the
+    request that caused the event, i.e. the actor, and are blank outside of requests.
+    """
+
+    timestamp = models.DateTimeField(default=timezone.now)
+    event = models.CharField(max_length=64)
+    model = models.CharField(max_length=100, blank=True)
+    object_pk = models.CharField(max_length=64, blank=True)
+    username = models.CharField(max_length=150, blank=True)
+    remote_ip = models.CharField(max_length=64, blank=True)
+    data = models.JSONField(default=dict, encoder=AuditEventJSONEncoder)
+
+    objects = AuditEventQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['model', 'object_pk', 'timestamp'], name='core_audit_object_idx'),
+            models.Index(fields=['username', 'timestamp'], name='core_audit_username_idx'),
+            models.Index(fields=['timestamp'], name='core_audit_timestamp_idx'),
+        ]
+
+    def __str__(self):
+        return f'{self.event} {self.model} {self.object_pk}'.rstrip()
+
+    @classmethod
+    def from_log_event(cls, event, kwargs, context=None, timestamp=None):
+        """
+        Build an unsaved AuditEvent from the arguments of an audit logger ``info()`` call.
 
-# Create your models here.
+        :param context: the request context fields (see seedling.logging.get_request_context_fields()) captured when
+            the event was logged. ``username`` and ``remote_ip`` come from here, never from ``kwargs``, whose fields
+            are the object's own and are stored in ``data`` as they are.
+        :param timestamp: when the event was logged. Defaults to now.
+        """
+        context = context or {}
+        data = dict(kwargs)
+        model = data.get('model', '')
+        object_pk = data.get('pk')
+        if object_pk is None and model:
+            # model.create and model.delete log the pk under the name of the pk field itself.
+            try:
+                object_pk = data.get(apps.get_model(model)._meta.pk.attname)
+            except (LookupError, ValueError):
+                pass
+        username = context.get('username')
+        if not isinstance(username, str):
+            username = ''
+        return cls(
+            timestamp=timestamp or timezone.now(),
+            event=event[:64],
+            model=str(model)[:100],
+            object_pk='' if object_pk is None else str(object_pk)[:64],
+            username=username[:150],
+            remote_ip=str(context.get('remote_ip') or '')[:64],
+            data=data,
+        )
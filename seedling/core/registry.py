@@ -0,0 +1,105 @@
+"""
+The registry of models whose changes we audit log.
+
+The registry is built once, in ``core.apps.CoreConfig.ready()``, from the ``UNLOGGED_MODELS`` and
+``AUDIT_LOG_MODEL_FIELDS`` settings. It connects the ``seedling.core.signals`` receivers to each audited model
+individually, rather than to every sender, so Django never even dispatches model signals for unaudited models (and can
+use its fast delete path for them).
+"""
+from django.apps import apps
+from django.conf import settings
+from django.db.models import ManyToManyField
+from django.db.models.signals import m2m_changed, post_init, post_save, pre_delete, pre_save
+
+
+class AuditOptions(object):
+    """
+    How a single model is audit logged.
+
+    :param model: the model class
+    :param fields: (optional) a frozenset of the only field names to log
+    :param exclude: (optional) a frozenset of field names not to log
+    """
+
+    def __init__(self, model, fields=None, exclude=None):
+        self.model = model
+        self.fields = fields
+        self.exclude = exclude
+
+    def filter(self, values):
+        """
+        Return a copy of the given dict of field values, with only the fields we log for this model.
+        """
+        if self.fields is None and self.exclude is None:
+            return values
+        return {
+            name: value for name, value in values.items()
+            if (self.fields is None or name in self.fields) and (self.exclude is None or name not in self.exclude)
+        }
+
+
+class AuditRegistry(object):
+
+    def __init__(self):
+        self._options = {}
+
+    def get_options(self, model):
+        """
+        Return the AuditOptions for the given model class, or ``None`` if it isn't audited.
+        """
+        return self._options.get(model)
+
+    def is_audited(self, model):
+        return model in self._options
+
+    def _build_options(self, model):
+        field_settings = getattr(settings, 'AUDIT_LOG_MODEL_FIELDS', {}).get(model._meta.label, {})
+        fields = field_settings.get('fields')
+        exclude = field_settings.get('exclude')
+        return AuditOptions(
+            model,
+            fields=frozenset(fields) if fields is not None else None,
+            exclude=frozenset(exclude) if exclude is not None else None,
+        )
+
+    def connect(self):
+        """
+        Register every installed model that isn't in ``settings.UNLOGGED_MODELS``, and connect our signal receivers
+        to each of them.
+        """
+        # These are imported here because signals.py imports this module.
+        from .signals import (
+            log_model_deletions,
+            log_model_instance_changes,
+            log_model_instance_creations,
+            log_model_instance_m2m_changes,
+            refresh_model_instance_state,
+            remember_model_instance_state,
+        )
+        for model in apps.get_models():
+            if model._meta.label in settings.UNLOGGED_MODELS:
+                continue
+            self._options[model] = self._build_options(model)
+            uid = model._meta.label_lower
+            post_init.connect(remember_model_instance_state, sender=model, dispatch_uid=f'audit.post_init.{uid}')
+            pre_save.connect(log_model_instance_changes, sender=model, dispatch_uid=f'audit.pre_save.{uid}')
+            post_save.connect(log_model_instance_creations, sender=model, dispatch_uid=f'audit.post_save.{uid}')
+            post_save.connect(refresh_model_instance_state, sender=model, dispatch_uid=f'audit.refresh.{uid}')
+            pre_delete.connect(log_model_deletions, sender=model, dispatch_uid=f'audit.pre_delete.{uid}')
+
+        # m2m_changed is sent by the "through" model, and its instance may be on either side of the relationship.
+        # The receiver itself checks that the instance's model is audited.
+        for model in apps.get_models():
+            for field in model._meta.local_many_to_many:
+                if not isinstance(field, ManyToManyField):
+                    continue
+                if self.is_audited(model) or self.is_audited(field.related_model):
+                    through = field.remote_field.through
+                    m2m_changed.connect(
+                        log_model_instance_m2m_changes,
+                        sender=through,
+                        dispatch_uid=f'audit.m2m_changed.{through._meta.label_lower}'
+                    )
+
+
+audit_registry = AuditRegistry()
@@ -1,60 +1,86 @@
 """
-Because the act of importing this file registers the signal handlers, it must only be imported from within
-core.apps.CoreConfig.ready(). See https://docs.djangoproject.com/en/1.9/topics/signals/#connecting-receiver-functions
-"""
-from django.conf import settings
-from django.db.models.signals import pre_save, post_save, m2m_changed, pre_delete
-from django.dispatch.dispatcher import receiver
+The receivers for our model change logging.
 
+These are connected to each audited model individually by ``core.registry.AuditRegistry.connect()``, which must only
+be called from within core.apps.CoreConfig.ready().
+See https://docs.djangoproject.com/en/1.9/topics/signals/#connecting-receiver-functions
+"""
+from ..audit import audit_logger, audit_suppressed
 from ..logging import (
-    logger,
-    log_model_changes,
+    log_model_dict_changes,
     log_new_model,
     log_model_m2m_changes,
     log_model_deletion
 )
+from .registry import audit_registry
+from .snapshots import get_original, normalize_field_names, remember_snapshot, take_snapshot, track_instance
+
+
+# noinspection PyUnusedLocal
+def remember_model_instance_state(sender, instance, **kwargs):
+    """
+    Take a snapshot of the field values of audited model instances as they are initialized. For instances loaded from
+    the database, this is what log_model_instance_changes() diffs against, which saves it from having to re-SELECT the
+    original instance on every save. Every instance is also tracked, so that the originals of those which turn out to
+    have been built by hand can be fetched in batches.
+    """
+    remember_snapshot(instance)
+    track_instance(instance)
 
-# NOTE: Signals are not loaded by default. Uncomment the signals import line in core.apps.CoreConfig to enable them.
 
 # noinspection PyUnusedLocal
-@receiver(pre_save)
 def log_model_instance_changes(sender, instance, raw, using, update_fields, **kwargs):
     """
-    Log the changes made to all model instances, except for models that we've been told to skip.
-    Also skip if raw = True, aka when loading fixtures.
+    Log the changes made to audited model instances.
+    Skip if raw = True, aka when loading fixtures, and inside suppress_audit().
     """
-    if not raw and instance._meta.label not in settings.UNLOGGED_MODELS:
-        try:
-            original_instance = sender.objects.get(pk=instance.pk)
-            log_model_changes(logger, original_instance, instance)
-        except sender.DoesNotExist:
-            # This will happen the first time the object is saved, since an original_instance doesn't exist.
-            pass
+    if not raw and not audit_suppressed():
+        # get_original() returns None the first time the object is saved, since an original doesn't exist.
+        original = get_original(instance, using=using, exclude_passwords=True)
+        if original is not None:
+            original = audit_registry.get_options(sender).filter(original)
+            if update_fields is not None:
+                # Only the fields in update_fields are actually going to be written, so ignore changes to the others.
+                update_fields = normalize_field_names(sender, update_fields)
+                original = {name: value for name, value in original.items() if name in update_fields}
+            new = take_snapshot(instance, field_names=original.keys())
+            log_model_dict_changes(audit_logger.using(using), instance, original, new)
 
 
 # noinspection PyUnusedLocal
-@receiver(post_save)
 def log_model_instance_creations(sender, instance, raw, created, using, update_fields, **kwargs):
     """
-    Log the creation of all model instances, except for models that we've been told to skip.
-    Also skip if raw = True, aka when loading fixtures.
+    Log the creation of audited model instances.
+    Skip if raw = True, aka when loading fixtures, and inside suppress_audit().
     """
-    if not raw and created and instance._meta.label not in settings.UNLOGGED_MODELS:
-        log_new_model(logger, instance)
+    if not raw and created and not audit_suppressed():
+        options = audit_registry.get_options(sender)
+        log_new_model(audit_logger.using(using), instance, fields=options.fields, exclude=options.exclude)
+
+
+# noinspection PyUnusedLocal
+def refresh_model_instance_state(sender, instance, raw, using, update_fields, **kwargs):
+    """
+    Refresh the snapshot of saved audited model instances, so that the next save of the same instance diffs against
+    what we just wrote.
+    """
+    remember_snapshot(instance, update_fields=update_fields)
 
 
 # noinspection PyUnusedLocal
-@receiver(m2m_changed)
 def log_model_instance_m2m_changes(sender, action, instance, reverse, model, pk_set, using, **kwargs):
-    if instance._meta.label not in settings.UNLOGGED_MODELS:
-        log_model_m2m_changes(logger, instance, action, model, pk_set)
+    """
+    Log the changes made to the many-to-many relationships of audited model instances, except inside suppress_audit().
+    """
+    if audit_registry.is_audited(instance.__class__) and not audit_suppressed():
+        log_model_m2m_changes(audit_logger.using(using), instance, action, model, pk_set)
 
 
 # noinspection PyUnusedLocal
-@receiver(pre_delete)
 def log_model_deletions(sender, instance, using, **kwargs):
     """
-    Log the deletions of all model instances, except for models that we've been told to skip.
+    Log the deletions of audited model instances, except inside suppress_audit().
     """
-    if instance._meta.label not in settings.UNLOGGED_MODELS:
-        log_model_deletion(logger, instance)
+    if not audit_suppressed():
+        options = audit_registry.get_options(sender)
+        log_model_deletion(audit_logger.using(using), instance, fields=options.fields, exclude=options.exclude)
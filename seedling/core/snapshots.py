@@ -0,0 +1,205 @@
+"""
+The snapshot/diff engine behind our model change logging.
+
+Rather than re-SELECTing every instance from the database in ``pre_save`` just to find out what changed, we keep a
+copy of each instance's concrete field values (a "snapshot") on the instance itself. The snapshot is taken when the
+instance is loaded from the ORM (``post_init``), and refreshed after each successful save (``post_save``), so the
+common "load, modify, save" pattern costs no extra queries at all.
+
+Instances that have no usable snapshot (e.g. ``Model(pk=5, ...)`` built by hand) need a query instead. We keep weak
+references to the most recently initialized instances of each audited model, so the first such save also fetches the
+originals of the other instances of the same model that were built by hand, with one query per ``PREFETCH_BATCH_SIZE``
+instances, when it happens inside a transaction. Saving many of them in one ``transaction.atomic()`` block thus costs
+one extra query, not one per save.
+Code that builds and saves its instances one at a time can call ``prefetch_originals()`` up front instead.
+
+NOTE: A snapshot reflects the database as of the moment the instance was loaded or saved. ``refresh_from_db()`` and
+deferred field loads don't refresh it, so fields that only appear after the snapshot was taken are not diffed.
+"""
+import threading
+import weakref
+from collections import defaultdict, deque
+from copy import deepcopy
+
+from django.db import connections, router
+
+# The name of the instance attribute in which we store the snapshot.
+SNAPSHOT_ATTR = '_audit_snapshot'
+# The name of the instance attribute which holds the database alias that prefetch_originals() fetched the snapshot
+# from, for instances that weren't loaded from the database themselves.
+PREFETCHED_ATTR = '_audit_snapshot_prefetched'
+# The maximum number of primary keys to put in a single "pk IN (...)" query when prefetching originals.
+PREFETCH_BATCH_SIZE = 500
+# How many of the most recently initialized instances of each model we track, per thread.
+TRACKED_INSTANCES = 5000
+
+# Weak references to each thread's most recently initialized instances of each audited model. These are only ever
+# appended to, and emptied when get_original() needs to query, which keeps tracking cheap enough for every instance
+# the ORM loads.
+_tracked = threading.local()
+
+
+def _copy_value(value):
+    # Mutable values (e.g. from a JSONField) would otherwise be shared with the instance, and thus modified right
+    # along with it.
+    if isinstance(value, (dict, list)):
+        return deepcopy(value)
+    return value
+
+
+def take_snapshot(instance, field_names=None, exclude_passwords=False):
+    """
+    Return a dict of the current values of the given instance's concrete fields, keyed by field name. Fields which
+    are deferred (and thus not loaded) on the instance are omitted.
+
+    Pass ``field_names`` to restrict the snapshot to those fields, and ``exclude_passwords`` = True to skip any field
+    named "password", just like ``seedling.logging.model_to_dict()``.
+    """
+    data = instance.__dict__
+    snapshot = {}
+    for f in instance._meta.concrete_fields:
+        if f.attname not in data:
+            continue
+        if field_names is not None and f.name not in field_names:
+            continue
+        if f.name == 'password' and exclude_passwords:
+            continue
+        snapshot[f.name] = _copy_value(data[f.attname])
+    return snapshot
+
+
+def normalize_field_names(model, names):
+    """
+    Return the given field names (e.g. from ``save(update_fields=...)``, which also accepts attnames like
+    ``author_id``) as a set of the names that snapshots are keyed by.
+    """
+    return {model._meta.get_field(name).name for name in names}
+
+
+def remember_snapshot(instance, update_fields=None):
+    """
+    Store a snapshot of the given instance's current field values on the instance.
+
+    If ``update_fields`` is given, only those fields are refreshed in an existing snapshot, since those are the only
+    ones that were actually written to the database.
+    """
+    existing = instance.__dict__.get(SNAPSHOT_ATTR)
+    if update_fields is not None and existing is not None:
+        existing.update(take_snapshot(instance, field_names=normalize_field_names(type(instance), update_fields)))
+    else:
+        instance.__dict__[SNAPSHOT_ATTR] = take_snapshot(instance)
+        instance.__dict__.pop(PREFETCHED_ATTR, None)
+
+
+def track_instance(instance):
+    """
+    Remember the given newly initialized instance, in case it was built by hand and get_original() needs to query for
+    its original along with another's. Only a weak reference is kept.
+    """
+    try:
+        tracked = _tracked.by_model[type(instance)]
+    except AttributeError:
+        _tracked.by_model = {}
+        tracked = None
+    except KeyError:
+        tracked = None
+    if tracked is None:
+        tracked = _tracked.by_model[type(instance)] = deque(maxlen=TRACKED_INSTANCES)
+    tracked.append(weakref.ref(instance))
+
+
+def _has_usable_snapshot(instance, using):
+    if SNAPSHOT_ATTR not in instance.__dict__:
+        return False
+    prefetched = instance.__dict__.get(PREFETCHED_ATTR)
+    if prefetched is not None:
+        return prefetched == using
+    # Snapshots taken in post_init are only trustworthy for instances that came from the database, which Django marks
+    # by setting _state.adding to False. For the same reason, we ignore snapshots from a different database.
+    return not instance._state.adding and instance._state.db in (None, using)
+
+
+def _query_originals(model, pks, field_names, using):
+    """
+    Return a dict of snapshots for the rows with the given primary keys, keyed by primary key, using one query.
+    """
+    fields = [f for f in model._meta.concrete_fields if field_names is None or f.name in field_names]
+    pk_attname = model._meta.pk.attname
+    attnames = [f.attname for f in fields]
+    if pk_attname not in attnames:
+        attnames.append(pk_attname)
+    rows = model._base_manager.using(using).filter(pk__in=pks).values(*attnames)
+    return {row[pk_attname]: {f.name: row[f.attname] for f in fields} for row in rows}
+
+
+def get_original(instance, using=None, exclude_passwords=False):
+    """
+    Return a snapshot dict of the given instance's values as they currently exist in the database, or ``None`` if the
+    instance has not yet been saved.
+
+    This returns the snapshot stored on the instance whenever we can trust it. Otherwise, inside a transaction, it
+    queries for the originals of this instance and of the other tracked instances of its model that need them. If
+    there are none, or we're in autocommit mode, it queries for only the fields that are loaded on this instance.
+    """
+    if instance.pk is None:
+        return None
+    using = using or router.db_for_write(instance.__class__, instance=instance)
+    if not _has_usable_snapshot(instance, using):
+        # Outside a transaction, an original fetched now could well be stale by the time its instance is saved.
+        others = _tracked_instances_needing_originals(instance, using) if connections[using].in_atomic_block else []
+        if not others:
+            field_names = set(take_snapshot(instance, exclude_passwords=exclude_passwords))
+            return _query_originals(instance.__class__, [instance.pk], field_names, using).get(instance.pk)
+        prefetch_originals([instance] + others, using=using)
+        if not _has_usable_snapshot(instance, using):
+            # There's no such row.
+            return None
+    snapshot = instance.__dict__[SNAPSHOT_ATTR]
+    if exclude_passwords:
+        return {name: value for name, value in snapshot.items() if name != 'password'}
+    return dict(snapshot)
+
+
+def _tracked_instances_needing_originals(instance, using):
+    """
+    Return the other tracked instances of the given instance's model which would need a query for their originals in
+    get_original(), and stop tracking all of them.
+    """
+    tracked = getattr(_tracked, 'by_model', {}).get(type(instance))
+    if not tracked:
+        return []
+    references = list(tracked)
+    tracked.clear()
+    others = []
+    for reference in references:
+        other = reference()
+        if (
+            other is not None and other is not instance and other.pk is not None
+            and not _has_usable_snapshot(other, using) and router.db_for_write(type(other), instance=other) == using
+        ):
+            others.append(other)
+    return others
+
+
+def prefetch_originals(instances, using=None):
+    """
+    Fetch and store the originals of all the given instances that lack a usable snapshot, using one query per model
+    (per ``PREFETCH_BATCH_SIZE`` instances), so that saving them costs no extra SELECTs.
+    """
+    by_model = defaultdict(list)
+    for instance in instances:
+        if instance.pk is None:
+            continue
+        db = using or router.db_for_write(instance.__class__, instance=instance)
+        if not _has_usable_snapshot(instance, db):
+            by_model[(instance.__class__, db)].append(instance)
+
+    for (model, db), model_instances in by_model.items():
+        for start in range(0, len(model_instances), PREFETCH_BATCH_SIZE):
+            batch = model_instances[start:start + PREFETCH_BATCH_SIZE]
+            originals = _query_originals(model, [instance.pk for instance in batch], None, db)
+            for instance in batch:
+                original = originals.get(instance.pk)
+                if original is not None:
+                    instance.__dict__[SNAPSHOT_ATTR] = original
+                    instance.__dict__[PREFETCHED_ATTR] = db
@@ -1,3 +1,1336 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import decimal
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.admin.models import ADDITION, LogEntry
+from django.contrib.auth import get_user_model, login, logout
+from django.contrib.auth.models import Group
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.contrib.sessions.models import Session
+from django.contrib.sessions.middleware import SessionMiddleware
+from asgiref.testing import ApplicationCommunicator
+from django.core.cache import cache, caches
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.db import connection, models, transaction
+from django.db.models.signals import m2m_changed, post_init, pre_delete, pre_save
+from django.http import HttpResponse
+from django.template import engines
+from django.test import AsyncClient, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext, isolate_apps
+from django.urls import path
+from django.utils import timezone
+
+from ..audit import AuditPipeline, audit_logger, suppress_audit
+from .. import gunicorn_config
+from ..logging import (
+    ConsoleRenderer,
+    JSONLinesRenderer,
+    LogSampler,
+    M2M_POLICIES,
+    PrecompiledConsoleRenderer,
+    QueuedLogging,
+    _extraction_plans,
+    bind_request_logging_context,
+    clear_request_logging_context,
+    get_extraction_plan,
+    get_request_context_fields,
+    model_to_dict,
+    summarize_pks
+)
+from ..middleware import (
+    AsyncCapableMiddleware,
+    CurrentRequestMiddleware,
+    RequestMetricsMiddleware,
+    SlowRequestProfilerMiddleware,
+    get_current_request,
+)
+from ..profiling import ProfileStore
+from ..statsd import LocalStatsdListener, StatsdClient
+from . import snapshots
+from .models import AuditEvent
+from .registry import AuditRegistry, audit_registry
+from .snapshots import prefetch_originals
+
+User = get_user_model()
+
+
+class RecordingLogger(object):
+    """
+    Stands in for the structlog logger that audit_logger writes to, and records the events it's given.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def info(self, event, **kwargs):
+        self.events.append((event, kwargs))
+
+    def named(self, event):
+        return [kwargs for name, kwargs in self.events if name == event]
+
+
+class BlockingLogger(RecordingLogger):
+    """
+    A RecordingLogger which holds up the writer thread on its first event until ``release`` is set.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def info(self, event, **kwargs):
+        self.entered.set()
+        self.release.wait(5)
+        super().info(event, **kwargs)
+
+
+class AuditLogMixin(object):
+    """
+    Records every audit log event in ``self.audit``, instead of writing it.
+    """
+
+    def setUp(self):
+        super().setUp()
+        self.audit = RecordingLogger()
+        patcher = mock.patch.object(audit_logger, 'logger', self.audit)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+
+class AuditLogTestCase(AuditLogMixin, TestCase):
+    pass
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=False)
+class SnapshotTests(AuditLogTestCase):
+
+    def test_saving_an_instance_loaded_from_the_database_does_not_reselect_it(self):
+        user = User.objects.create(username='snapshot')
+        user = User.objects.get(pk=user.pk)
+        user.first_name = 'Snap'
+        with self.assertNumQueries(1):
+            user.save(update_fields=['first_name'])
+        self.assertEqual(self.audit.named('model.update')[-1]['first_name'], '"" -> "Snap"')
+
+    def test_update_fields_may_name_attnames(self):
+        author = User.objects.create(username='author')
+        other = User.objects.create(username='other')
+        entry = LogEntry.objects.create(user=author, action_flag=ADDITION, object_repr='entry')
+        entry = LogEntry.objects.get(pk=entry.pk)
+
+        entry.user_id = other.pk
+        with self.assertNumQueries(1):
+            entry.save(update_fields=['user_id'])
+        self.assertEqual(self.audit.named('model.update')[-1]['user'], f'"{author.pk}" -> "{other.pk}"')
+
+        # The snapshot must have been refreshed by that save, or this would diff against the author again.
+        entry.user_id = author.pk
+        entry.save(update_fields=['user_id'])
+        self.assertEqual(self.audit.named('model.update')[-1]['user'], f'"{other.pk}" -> "{author.pk}"')
+
+    def save_by_hand(self, users, suffix):
+        with transaction.atomic():
+            copies = [User(pk=user.pk, username=user.username + suffix) for user in users]
+            for copy in copies:
+                copy.save()
+
+    def test_saving_instances_built_by_hand_fetches_their_originals_in_one_query(self):
+        users = [User.objects.create(username=f'hand{i}') for i in range(5)]
+        with suppress_audit(), CaptureQueriesContext(connection) as unaudited:
+            self.save_by_hand(users, '-a')
+        with CaptureQueriesContext(connection) as audited:
+            self.save_by_hand(users, '-b')
+        self.assertEqual(len(audited), len(unaudited) + 1)
+        updates = self.audit.named('model.update')
+        self.assertEqual(len(updates), 5)
+        self.assertEqual(updates[0]['username'], '"hand0-a" -> "hand0-b"')
+
+    def test_prefetch_originals_batches_its_queries(self):
+        users = [User.objects.create(username=f'batch{i}') for i in range(5)]
+        copies = [User(pk=user.pk, username=f'copy{i}') for i, user in enumerate(users)]
+        with mock.patch.object(snapshots, 'PREFETCH_BATCH_SIZE', 2), self.assertNumQueries(3):
+            prefetch_originals(copies)
+        with self.assertNumQueries(5):
+            for copy in copies:
+                copy.save()
+        self.assertEqual(self.audit.named('model.update')[-1]['username'], '"batch4" -> "copy4"')
+
+
+class ShoutingField(models.CharField):
+
+    def value_from_object(self, obj):
+        return super().value_from_object(obj).upper()
+
+
+class BrokenField(models.CharField):
+
+    def value_from_object(self, obj):
+        raise RuntimeError('broken')
+
+
+@override_settings(AUDIT_LOG_RELATIONS='pk')
+@isolate_apps('seedling.core')
+class ModelToDictTests(SimpleTestCase):
+    """
+    model_to_dict() runs a cached extraction plan, which must produce what calling value_from_object() on each field
+    would.
+    """
+
+    def test_concrete_fields_match_value_from_object(self):
+        entry = LogEntry(pk=3, user_id=5, object_id='7', object_repr='entry', action_flag=ADDITION)
+        expected = {f.name: f.value_from_object(entry) for f in LogEntry._meta.concrete_fields}
+        self.assertEqual(model_to_dict(entry, related=False), expected)
+        # The plan has the user's FK under its field name, with the raw column value.
+        self.assertEqual(model_to_dict(entry)['user'], 5)
+
+    def test_fields_which_override_value_from_object(self):
+        class Shout(models.Model):
+            loud = ShoutingField(max_length=10)
+            broken = BrokenField(max_length=10)
+            password = models.CharField(max_length=10)
+
+        shout = Shout(pk=1, loud='hi', broken='no', password='secret')
+        self.assertEqual(model_to_dict(shout), {'id': 1, 'loud': 'HI', 'password': 'secret'})
+        self.assertEqual(model_to_dict(shout, exclude_passwords=True), {'id': 1, 'loud': 'HI'})
+
+    def test_fields_without_a_column(self):
+        class Owner(models.Model):
+            name = models.CharField(max_length=10)
+            tags = models.ManyToManyField('self')
+
+        class Badge(models.Model):
+            owner = models.OneToOneField(Owner, on_delete=models.CASCADE)
+
+        owner = Owner(pk=1, name='owner')
+        # Assigning the forward side caches the reverse side on the owner too, so reading it costs no query.
+        Badge(pk=9, owner=owner)
+        self.assertEqual(model_to_dict(owner), {'id': 1, 'name': 'owner', 'badge': 9})
+        self.assertEqual(model_to_dict(owner, related=False), {'id': 1, 'name': 'owner'})
+        # A reverse one-to-one that isn't loaded is left out, rather than queried for.
+        self.assertEqual(model_to_dict(Owner(pk=2, name='other')), {'id': 2, 'name': 'other'})
+        with self.settings(AUDIT_LOG_RELATIONS='count'):
+            self.assertEqual(model_to_dict(owner)['badge'], 1)
+
+    def test_plans_are_rebuilt_after_class_prepared(self):
+        class Before(models.Model):
+            name = models.CharField(max_length=10)
+
+        plan = get_extraction_plan(Before)
+        self.assertIs(get_extraction_plan(Before), plan)
+        self.assertIn((Before, False, None, None, True), _extraction_plans)
+
+        class After(models.Model):
+            pass
+
+        self.assertEqual(_extraction_plans, {})
+        rebuilt = get_extraction_plan(Before)
+        self.assertIsNot(rebuilt, plan)
+        self.assertEqual([name for name, _ in rebuilt], ['id', 'name'])
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=False)
+class AuditRegistryTests(AuditLogTestCase):
+
+    def use_registry(self, **model_fields):
+        """
+        Audit log through a new registry, built with the given AUDIT_LOG_MODEL_FIELDS.
+        """
+        registry = AuditRegistry()
+        with self.settings(AUDIT_LOG_MODEL_FIELDS=model_fields):
+            registry.connect()
+        patcher = mock.patch('seedling.core.signals.audit_registry', registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return registry
+
+    def test_only_audited_models_have_receivers(self):
+        for model in (User, LogEntry):
+            self.assertTrue(audit_registry.is_audited(model))
+            for signal in (post_init, pre_save, pre_delete):
+                self.assertTrue(signal.has_listeners(model), (model, signal))
+        # These are in UNLOGGED_MODELS.
+        for model in (Session, AuditEvent):
+            self.assertFalse(audit_registry.is_audited(model))
+            for signal in (post_init, pre_save, pre_delete):
+                self.assertFalse(signal.has_listeners(model), (model, signal))
+        self.assertTrue(m2m_changed.has_listeners(User.groups.through))
+
+    def test_unlogged_models_are_not_audited(self):
+        with self.assertNumQueries(1):
+            Session.objects.create(session_key='abc', session_data='', expire_date=timezone.now())
+        self.assertEqual(self.audit.events, [])
+
+    def test_fields_limits_the_logged_fields(self):
+        registry = self.use_registry(**{'users.User': {'fields': ['username', 'email']}})
+        self.assertEqual(registry.get_options(User).fields, frozenset(['username', 'email']))
+        user = User.objects.create(username='fields', email='a@example.com', first_name='F')
+        created = self.audit.named('model.create')[-1]
+        self.assertEqual(set(created) - {'model', 'instance'}, {'username', 'email'})
+
+        user.first_name = 'Changed'
+        user.save()
+        self.assertEqual(self.audit.named('model.update'), [])
+        user.email = 'b@example.com'
+        user.first_name = 'Again'
+        user.save()
+        updated = self.audit.named('model.update')[-1]
+        self.assertEqual(updated['email'], '"a@example.com" -> "b@example.com"')
+        self.assertNotIn('first_name', updated)
+
+        user.delete()
+        self.assertEqual(set(self.audit.named('model.delete')[-1]) - {'model', 'instance'}, {'username', 'email'})
+
+    def test_exclude_drops_fields(self):
+        self.use_registry(**{'users.User': {'exclude': ['first_name']}})
+        user = User.objects.create(username='exclude', first_name='F')
+        self.assertNotIn('first_name', self.audit.named('model.create')[-1])
+        self.assertIn('username', self.audit.named('model.create')[-1])
+        user.first_name = 'Changed'
+        user.save()
+        self.assertEqual(self.audit.named('model.update'), [])
+        user.username = 'renamed'
+        user.save()
+        self.assertEqual(self.audit.named('model.update')[-1]['username'], '"exclude" -> "renamed"')
+
+    def test_other_models_keep_every_field(self):
+        registry = self.use_registry(**{'users.User': {'fields': ['username']}})
+        options = registry.get_options(LogEntry)
+        self.assertEqual((options.fields, options.exclude), (None, None))
+        values = {'object_repr': 'x', 'action_flag': ADDITION}
+        self.assertIs(options.filter(values), values)
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=False, AUDIT_LOG_RELATIONS='pk')
+class RelationLoggingTests(AuditLogTestCase):
+
+    def test_creations_do_not_look_up_related_objects(self):
+        with self.assertNumQueries(1):
+            User.objects.create(username='new')
+        event = self.audit.named('model.create')[-1]
+        self.assertEqual(event['username'], 'new')
+        self.assertNotIn('logentry', event)
+
+    def test_related_objects_are_only_logged_when_already_loaded(self):
+        user = User.objects.create(username='related')
+        entry = LogEntry.objects.create(user=user, action_flag=ADDITION, object_repr='entry')
+        user = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertNotIn('logentry', model_to_dict(user))
+        user = User.objects.prefetch_related('logentry_set').get(pk=user.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(model_to_dict(user)['logentry'], [entry.pk])
+
+    def test_deletions_do_not_look_up_related_objects(self):
+        user = User.objects.create(username='deleted')
+        user = User.objects.get(pk=user.pk)
+        with self.assertNumQueries(0):
+            model_to_dict(user)
+        user.delete()
+        self.assertNotIn('logentry', self.audit.named('model.delete')[-1])
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=False, AUDIT_LOG_M2M='pk')
+class M2MLoggingTests(AuditLogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create(username='m2m')
+        self.groups = [Group.objects.create(name=f'group{number}') for number in range(3)]
+
+    def count_queries(self, func):
+        with CaptureQueriesContext(connection) as context:
+            func()
+        return len(context.captured_queries)
+
+    def test_logging_pks_costs_no_queries(self):
+        with suppress_audit():
+            unaudited = self.count_queries(lambda: self.user.groups.add(*self.groups[:2]))
+            self.user.groups.clear()
+        audited = self.count_queries(lambda: self.user.groups.add(*self.groups[:2]))
+        self.assertEqual(audited, unaudited)
+        event = self.audit.named('model.m2m.add')[-1]
+        self.assertEqual((event['objects'], event['count']), ([self.groups[0].pk, self.groups[1].pk], 2))
+
+        with suppress_audit():
+            unaudited = self.count_queries(lambda: self.user.groups.remove(self.groups[0]))
+            self.user.groups.add(self.groups[0])
+        audited = self.count_queries(lambda: self.user.groups.remove(self.groups[0]))
+        self.assertEqual(audited, unaudited)
+        self.assertEqual(self.audit.named('model.m2m.delete')[-1]['objects'], [self.groups[0].pk])
+
+    def test_reverse_side_costs_no_queries(self):
+        with suppress_audit():
+            unaudited = self.count_queries(lambda: self.groups[2].user_set.add(self.user))
+            self.groups[2].user_set.clear()
+        audited = self.count_queries(lambda: self.groups[2].user_set.add(self.user))
+        self.assertEqual(audited, unaudited)
+        event = self.audit.named('model.m2m.add')[-1]
+        self.assertEqual((event['model'], event['objects']), ('auth.Group', [self.user.pk]))
+
+    @override_settings(AUDIT_LOG_BULK_PK_LIMIT=1)
+    def test_large_sets_log_their_first_and_last_pks(self):
+        for policy in M2M_POLICIES:
+            with self.subTest(policy=policy), override_settings(AUDIT_LOG_M2M=policy):
+                self.user.groups.clear()
+                # Leave out the middle group, so the pks aren't contiguous.
+                audited = self.count_queries(lambda: self.user.groups.add(self.groups[0], self.groups[2]))
+                with suppress_audit():
+                    self.user.groups.clear()
+                    unaudited = self.count_queries(lambda: self.user.groups.add(self.groups[0], self.groups[2]))
+                self.assertEqual(audited, unaudited)
+                event = self.audit.named('model.m2m.add')[-1]
+                self.assertNotIn('objects', event)
+                self.assertEqual(
+                    (event['count'], event['first_pk'], event['last_pk']), (2, self.groups[0].pk, self.groups[2].pk)
+                )
+
+    @override_settings(AUDIT_LOG_M2M='repr')
+    def test_repr_policy_costs_one_query(self):
+        with suppress_audit():
+            unaudited = self.count_queries(lambda: self.user.groups.add(*self.groups))
+            self.user.groups.clear()
+        audited = self.count_queries(lambda: self.user.groups.add(*self.groups))
+        self.assertEqual(audited, unaudited + 1)
+        self.assertEqual(
+            self.audit.named('model.m2m.add')[-1]['objects'], '<Group: group0>, <Group: group1>, <Group: group2>'
+        )
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=False, AUDIT_LOG_BULK_PK_LIMIT=3)
+class BulkOperationTests(AuditLogTestCase):
+    """
+    users.User's manager uses AuditedQuerySet.
+    """
+
+    def create_users(self, count):
+        with suppress_audit():
+            User.objects.bulk_create([User(username=f'bulk{number}') for number in range(count)])
+        # Not every database can return the pks from bulk_create().
+        return list(User.objects.filter(username__startswith='bulk').order_by('pk'))
+
+    def test_bulk_create_logs_one_event(self):
+        users = User.objects.bulk_create([User(username='bulk1'), User(username='bulk2')])
+        self.assertEqual(self.audit.named('model.create'), [])
+        event, = self.audit.named('model.bulk_create')
+        self.assertEqual(event['model'], 'users.User')
+        self.assertEqual(event['count'], 2)
+        self.assertEqual(event, {'model': 'users.User', 'count': 2, **summarize_pks([user.pk for user in users], 3)})
+
+    def test_bulk_update_logs_one_event_with_the_written_columns(self):
+        users = self.create_users(2)
+        for user in users:
+            user.first_name = 'Bulk'
+        User.objects.bulk_update(users, ['first_name'])
+        self.assertEqual(self.audit.named('model.bulk_update'), [
+            {'model': 'users.User', 'count': 2, 'pks': [user.pk for user in users], 'fields': ['first_name']},
+        ])
+
+    def test_update_logs_the_first_and_last_pks_for_many_rows(self):
+        users = self.create_users(5)
+        # Leave out one in the middle, so the pks aren't contiguous.
+        User.objects.filter(username__startswith='bulk').exclude(pk=users[2].pk).update(is_active=False)
+        self.assertEqual(self.audit.named('model.bulk_update'), [{
+            'model': 'users.User',
+            'count': 4,
+            'first_pk': users[0].pk,
+            'last_pk': users[-1].pk,
+            'fields': ['is_active'],
+        }])
+
+    def test_summarize_pks(self):
+        self.assertEqual(summarize_pks([3, 1, None], 2), {'pks': [3, 1]})
+        self.assertEqual(summarize_pks([3, 1, 7], 2), {'first_pk': 1, 'last_pk': 7})
+        self.assertEqual(summarize_pks([None], 2), {'pks': None})
+
+    def test_delete_logs_one_event_instead_of_one_per_row(self):
+        users = self.create_users(2)
+        User.objects.filter(username__startswith='bulk').delete()
+        self.assertEqual(self.audit.named('model.delete'), [])
+        event, = self.audit.named('model.bulk_delete')
+        self.assertEqual((event['count'], event['pks']), (2, [user.pk for user in users]))
+        self.assertEqual(event['deleted'], {'users.User': 2})
+
+    def test_suppress_audit_silences_the_per_instance_receivers(self):
+        with suppress_audit():
+            user = User.objects.create(username='quiet')
+            user.first_name = 'Quiet'
+            user.save()
+            user.delete()
+        self.assertEqual(self.audit.events, [])
+
+
+class RequestLoggingContextTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='fred', is_superuser=True)
+
+    def make_request(self):
+        """
+        Return a request that has been through the session and authentication middleware, and bind it.
+        """
+        request = RequestFactory().get('/')
+        SessionMiddleware(lambda r: None).process_request(request)
+        AuthenticationMiddleware(lambda r: None).process_request(request)
+        token = bind_request_logging_context(request)
+        self.addCleanup(clear_request_logging_context, token)
+        return request
+
+    def test_unloaded_users_are_logged_as_placeholders_without_queries(self):
+        request = self.make_request()
+        with self.assertNumQueries(0):
+            fields = get_request_context_fields()
+        self.assertEqual(fields, {'remote_ip': '127.0.0.1', 'username': '__UNRESOLVED__', 'superuser': None})
+        # Once something else has loaded the user, it's logged.
+        self.assertTrue(request.user.is_anonymous)
+        with self.assertNumQueries(0):
+            fields = get_request_context_fields()
+        self.assertEqual((fields['username'], fields['superuser']), ('AnonymousUser', False))
+
+    def test_logged_in_users_are_snapshotted_once(self):
+        request = self.make_request()
+        request.user = self.user
+        with self.assertNumQueries(0):
+            self.assertEqual(get_request_context_fields()['username'], 'fred')
+        # The snapshot is reused, rather than read from the user again.
+        self.user.username = 'changed'
+        self.assertEqual(get_request_context_fields()['username'], 'fred')
+
+    def test_login_and_logout_refresh_the_user_fields(self):
+        request = self.make_request()
+        self.assertFalse(request.user.is_authenticated)
+        self.assertEqual(get_request_context_fields()['username'], 'AnonymousUser')
+        login(request, self.user, backend='django.contrib.auth.backends.ModelBackend')
+        self.assertEqual(get_request_context_fields()['username'], 'fred')
+        self.assertTrue(get_request_context_fields()['superuser'])
+        logout(request)
+        self.assertEqual(get_request_context_fields()['username'], 'AnonymousUser')
+        self.assertFalse(get_request_context_fields()['superuser'])
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=False, AUDIT_LOG_STORE=True)
+class AuditEventStoreTests(AuditLogTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.admin = User.objects.create(username='admin', is_superuser=True)
+        request = RequestFactory().get('/')
+        request.user = self.admin
+        token = bind_request_logging_context(request)
+        self.addCleanup(clear_request_logging_context, token)
+
+    def test_the_actor_is_kept_apart_from_the_object_fields(self):
+        victim = User.objects.create(username='victim')
+        victim_pk = victim.pk
+        victim.username = 'victim2'
+        victim.save()
+        victim.delete()
+
+        events = list(AuditEvent.objects.for_object(User, victim_pk).order_by('id'))
+        self.assertEqual([event.event for event in events], ['model.create', 'model.update', 'model.delete'])
+        self.assertEqual({event.username for event in events}, {'admin'})
+        self.assertEqual(events[0].data['username'], 'victim')
+        self.assertEqual(events[1].data['username'], '"victim" -> "victim2"')
+        self.assertEqual(AuditEvent.objects.for_user('admin').count(), 3)
+
+        # The log line keeps the object's username, and names the actor separately.
+        line = self.audit.named('model.update')[-1]
+        self.assertEqual((line['username'], line['actor_username']), ('"victim" -> "victim2"', 'admin'))
+
+    @override_settings(AUDIT_LOG_ON_COMMIT=True)
+    def test_events_are_stamped_when_they_are_logged(self):
+        logged_at = timezone.now() - datetime.timedelta(minutes=5)
+        with self.captureOnCommitCallbacks(execute=True):
+            with mock.patch('seedling.audit.timezone.now', return_value=logged_at):
+                user = User.objects.create(username='stamped')
+        event = AuditEvent.objects.for_object(User, user.pk).get()
+        self.assertEqual(event.timestamp, logged_at)
+
+
+@override_settings(AUDIT_LOG_ON_COMMIT=True)
+class OnCommitTests(AuditLogMixin, TransactionTestCase):
+
+    def created(self):
+        return [kwargs['username'] for kwargs in self.audit.named('model.create')]
+
+    def test_rolled_back_transactions_log_nothing(self):
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                User.objects.create(username='rolled-back')
+                raise RuntimeError
+        self.assertEqual(self.created(), [])
+
+    def test_committed_transactions_log_once_after_the_commit(self):
+        with transaction.atomic():
+            User.objects.create(username='committed')
+            self.assertEqual(self.created(), [])
+        self.assertEqual(self.created(), ['committed'])
+
+    def test_rolled_back_savepoints_drop_only_their_own_events(self):
+        with transaction.atomic():
+            User.objects.create(username='kept')
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    User.objects.create(username='rolled-back')
+                    raise RuntimeError
+        self.assertEqual(self.created(), ['kept'])
+
+    def test_events_outside_a_transaction_are_logged_right_away(self):
+        User.objects.create(username='autocommit')
+        self.assertEqual(self.created(), ['autocommit'])
+
+    @override_settings(AUDIT_LOG_ON_COMMIT=False)
+    def test_deferral_can_be_turned_off(self):
+        with transaction.atomic():
+            User.objects.create(username='immediate')
+            self.assertEqual(self.created(), ['immediate'])
+
+
+@override_settings(AUDIT_LOG_ASYNC=True, AUDIT_LOG_FLUSH_INTERVAL=0.05)
+class AuditPipelineTests(SimpleTestCase):
+
+    def make_pipeline(self, logger):
+        pipeline = AuditPipeline(logger)
+        self.addCleanup(pipeline.stop)
+        return pipeline
+
+    def test_events_are_written_by_the_writer_thread(self):
+        logger = RecordingLogger()
+        pipeline = self.make_pipeline(logger)
+        pipeline.info('model.create', model='users.User', pk=1)
+        self.assertTrue(pipeline.flush())
+        self.assertEqual([name for name, _ in logger.events], ['model.create'])
+        self.assertNotEqual(pipeline._thread, threading.current_thread())
+
+    @override_settings(AUDIT_LOG_QUEUE_SIZE=1, AUDIT_LOG_FULL_POLICY='drop')
+    def test_drop_policy_counts_events_that_do_not_fit(self):
+        logger = BlockingLogger()
+        pipeline = self.make_pipeline(logger)
+        pipeline.info('first')
+        # Wait until the writer thread is stuck writing the first event, so the queue is empty again.
+        self.assertTrue(logger.entered.wait(5))
+        pipeline.info('second')
+        pipeline.info('third')
+        self.assertEqual(pipeline.dropped, 1)
+        logger.release.set()
+        with mock.patch('seedling.audit.seedling_logger') as internal_logger:
+            pipeline.stop()
+        self.assertEqual([name for name, _ in logger.events], ['first', 'second'])
+        # The writer thread logs the drop count, and starts counting again.
+        internal_logger.warning.assert_called_once_with('audit.dropped', count=1)
+        self.assertEqual(pipeline.dropped, 0)
+
+    @override_settings(AUDIT_LOG_QUEUE_SIZE=1, AUDIT_LOG_FULL_POLICY='block', AUDIT_LOG_BLOCK_TIMEOUT=0.05)
+    def test_block_policy_drops_events_after_the_timeout(self):
+        logger = BlockingLogger()
+        pipeline = self.make_pipeline(logger)
+        pipeline.info('first')
+        self.assertTrue(logger.entered.wait(5))
+        pipeline.info('second')
+        pipeline.info('third')
+        self.assertEqual(pipeline.dropped, 1)
+        logger.release.set()
+        with mock.patch('seedling.audit.seedling_logger'):
+            pipeline.stop()
+
+    def test_stop_drains_the_queue(self):
+        logger = RecordingLogger()
+        pipeline = self.make_pipeline(logger)
+        for number in range(50):
+            pipeline.info('model.update', pk=number)
+        pipeline.stop()
+        self.assertEqual([kwargs['pk'] for _, kwargs in logger.events], list(range(50)))
+        self.assertFalse(pipeline._thread.is_alive())
+        # Events logged after stop() are written right away.
+        pipeline.info('model.delete', pk=50)
+        self.assertEqual(logger.events[-1][0], 'model.delete')
+
+    def test_a_forked_process_starts_its_own_writer_thread(self):
+        logger = RecordingLogger()
+        pipeline = self.make_pipeline(logger)
+        pipeline.info('parent')
+        self.assertTrue(pipeline.flush())
+        parent_thread, parent_queue = pipeline._thread, pipeline._queue
+        # After a fork(), the pid changes and the parent's thread is gone.
+        with mock.patch('seedling.audit.os.getpid', return_value=os.getpid() + 1):
+            pipeline.info('child')
+            self.assertTrue(pipeline.flush())
+            self.assertIsNot(pipeline._thread, parent_thread)
+            self.assertIsNot(pipeline._queue, parent_queue)
+            pipeline.stop()
+        parent_queue.put(None)
+        parent_thread.join(5)
+        self.assertEqual([name for name, _ in logger.events], ['parent', 'child'])
+
+
+class ConsoleRendererTests(SimpleTestCase):
+    """
+    PrecompiledConsoleRenderer must render exactly what ConsoleRenderer, the reference implementation it replaces, does.
+    """
+
+    def event_dicts(self):
+        yield {
+            'timestamp': '2021-10-18T12:00:00.000000Z',
+            'level': 'info',
+            'logger': 'seedling',
+            'event': 'model.update',
+            'username': 'fred',
+            'pk': 42,
+            'changes': {'first_name': '"" -> "Fred"'},
+            'remote_ip': None,
+        }
+        yield {
+            'timestamp': '2021-10-18T12:00:01.000000Z',
+            'level': 'error',
+            'logger': 'django.request',
+            'event': 'request.failed',
+            'stack': 'Stack (most recent call last):\n  File "x.py", line 1',
+            'exception': 'Traceback (most recent call last):\nValueError: multi\nline',
+            'path': '/users/',
+        }
+        # No timestamp, level or logger, and nothing left after the event.
+        yield {'event': 'bare'}
+        # Only a stack and exception are left after the event.
+        yield {'level': 'warning', 'event': 'warned', 'exception': 'Traceback\nboom'}
+
+    def assert_same_output(self, **kwargs):
+        reference = ConsoleRenderer(**kwargs)
+        precompiled = PrecompiledConsoleRenderer(**kwargs)
+        for event_dict in self.event_dicts():
+            expected = reference(None, None, dict(event_dict))
+            self.assertEqual(precompiled(None, None, dict(event_dict)), expected)
+            # The second call uses the cached key fragments.
+            self.assertEqual(precompiled(None, None, dict(event_dict)), expected)
+
+    def test_matches_the_reference_without_colors(self):
+        self.assert_same_output()
+
+    def test_matches_the_reference_with_colors(self):
+        self.assert_same_output(colors=True)
+
+    def test_matches_the_reference_without_newlines(self):
+        self.assert_same_output(colors=True, newlines=False)
+        failure = list(self.event_dicts())[1]
+        self.assertNotIn('\n', PrecompiledConsoleRenderer(newlines=False)(None, None, failure))
+
+
+class Unserializable(object):
+
+    def __repr__(self):
+        return '<Unserializable>'
+
+
+class JSONLinesRendererTests(SimpleTestCase):
+
+    def render(self, event_dict):
+        return JSONLinesRenderer()(None, None, event_dict)
+
+    def assert_renders(self, event_dict, expected):
+        """
+        Check the output both with orjson (if it's installed) and with the standard library's json module.
+        """
+        self.assertEqual(self.render(dict(event_dict)), expected)
+        with mock.patch('seedling.logging.orjson', None):
+            self.assertEqual(self.render(dict(event_dict)), expected)
+
+    def test_key_order(self):
+        self.assert_renders(
+            {'zebra': 1, 'event': 'model.update', 'apple': 2, 'level': 'info', 'timestamp': 't', 'logger': 'seedling'},
+            '{"timestamp":"t","level":"info","logger":"seedling","event":"model.update","apple":2,"zebra":1}'
+        )
+        # The leading keys are only emitted when they're present.
+        self.assert_renders({'b': 1, 'event': 'bare', 'a': 2}, '{"event":"bare","a":2,"b":1}')
+
+    def test_values_json_cannot_serialize(self):
+        self.assert_renders(
+            {
+                'event': 'odd',
+                'when': datetime.datetime(2021, 10, 18, 12, 30),
+                'amount': decimal.Decimal('1.50'),
+                'tags': frozenset(['a']),
+                'thing': Unserializable(),
+            },
+            '{"event":"odd","amount":"1.50","tags":["a"],"thing":"<Unserializable>","when":"2021-10-18T12:30:00"}'
+        )
+
+    def test_integers_wider_than_64_bits_fall_back_to_json(self):
+        self.assert_renders({'event': 'big', 'n': 2 ** 70}, f'{{"event":"big","n":{2 ** 70}}}')
+
+    def test_events_are_one_line(self):
+        line = self.render({'event': 'failed', 'exception': 'Traceback\nValueError: ünïcode'})
+        self.assertNotIn('\n', line)
+        self.assertEqual(json.loads(line)['exception'], 'Traceback\nValueError: ünïcode')
+
+
+class GunicornSizingTests(SimpleTestCase):
+
+    def available_cpus(self, files, affinity=8, cpu_count=8):
+        """
+        Run _available_cpus() with the given cgroup files (a dict of path to contents), CPU affinity and cpu_count().
+        Pass ``affinity=None`` for a platform without os.sched_getaffinity().
+        """
+        def read(*paths):
+            for cgroup_path in paths:
+                if cgroup_path in files:
+                    return files[cgroup_path].strip()
+            return None
+
+        if affinity is None:
+            affinity_mock = mock.Mock(side_effect=AttributeError)
+        else:
+            affinity_mock = mock.Mock(return_value=set(range(affinity)))
+        with mock.patch.object(gunicorn_config, '_read_cgroup_file', read), \
+                mock.patch.object(gunicorn_config.os, 'sched_getaffinity', affinity_mock, create=True), \
+                mock.patch.object(gunicorn_config.os, 'cpu_count', return_value=cpu_count):
+            return gunicorn_config._available_cpus()
+
+    def test_cgroup_v2_quota(self):
+        self.assertEqual(self.available_cpus({'/sys/fs/cgroup/cpu.max': '200000 100000\n'}), 2)
+        # Fractions of a CPU round to the nearest whole one, but never below 1.
+        self.assertEqual(self.available_cpus({'/sys/fs/cgroup/cpu.max': '150000 100000'}), 2)
+        self.assertEqual(self.available_cpus({'/sys/fs/cgroup/cpu.max': '10000 100000'}), 1)
+        # A quota of more CPUs than we may run on doesn't raise the count.
+        self.assertEqual(self.available_cpus({'/sys/fs/cgroup/cpu.max': '1600000 100000'}), 8)
+
+    def test_cgroup_v2_unlimited(self):
+        self.assertEqual(self.available_cpus({'/sys/fs/cgroup/cpu.max': 'max 100000'}), 8)
+
+    def test_cgroup_v1_quota(self):
+        files = {
+            '/sys/fs/cgroup/cpu/cpu.cfs_quota_us': '300000',
+            '/sys/fs/cgroup/cpu/cpu.cfs_period_us': '100000',
+        }
+        self.assertEqual(self.available_cpus(files), 3)
+
+    def test_cgroup_v1_unlimited(self):
+        files = {
+            '/sys/fs/cgroup/cpu/cpu.cfs_quota_us': '-1',
+            '/sys/fs/cgroup/cpu/cpu.cfs_period_us': '100000',
+        }
+        self.assertEqual(self.available_cpus(files), 8)
+
+    def test_no_cgroup_limits(self):
+        self.assertEqual(self.available_cpus({}, affinity=4), 4)
+
+    def test_falls_back_to_cpu_count(self):
+        self.assertEqual(self.available_cpus({}, affinity=None, cpu_count=6), 6)
+        self.assertEqual(self.available_cpus({}, affinity=None, cpu_count=None), 1)
+        self.assertEqual(self.available_cpus({'/sys/fs/cgroup/cpu.max': '200000 100000'}, affinity=None), 2)
+
+    def test_memory_limit(self):
+        def memory_limit(value):
+            with mock.patch.object(gunicorn_config, '_read_cgroup_file', return_value=value):
+                return gunicorn_config._memory_limit_mb()
+
+        self.assertEqual(memory_limit(str(512 * 1024 * 1024)), 512)
+        self.assertIsNone(memory_limit('max'))
+        self.assertIsNone(memory_limit(None))
+        # cgroup v1's "no limit".
+        self.assertIsNone(memory_limit('9223372036854771712'))
+
+    def test_read_cgroup_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cpu.max')
+            with open(path, 'w') as f:
+                f.write('max 100000\n')
+            missing = os.path.join(directory, 'missing')
+            self.assertEqual(gunicorn_config._read_cgroup_file(missing, path), 'max 100000')
+            self.assertIsNone(gunicorn_config._read_cgroup_file(missing))
+
+
+class RecordingHandler(logging.Handler):
+    """
+    Records the messages of the log records it's given, optionally waiting for ``gate`` to be set first.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.messages = []
+        self.threads = set()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    def emit(self, record):
+        self.gate.wait(5)
+        self.threads.add(threading.current_thread())
+        self.messages.append(record.getMessage())
+
+
+class QueuedLoggingTests(SimpleTestCase):
+
+    def make_logger(self, name):
+        logger = logging.getLogger(name)
+        handler = RecordingHandler()
+        logger.addHandler(handler)
+        logger.propagate = False
+        logger.setLevel(logging.INFO)
+
+        def cleanup():
+            for h in list(logger.handlers):
+                logger.removeHandler(h)
+            logger.propagate = True
+        self.addCleanup(cleanup)
+        return logger, handler
+
+    def make_topology(self, **kwargs):
+        topology = QueuedLogging(**kwargs)
+        self.addCleanup(topology.stop)
+        return topology
+
+    def test_records_are_written_by_the_listener_thread(self):
+        logger, handler = self.make_logger('seedling.tests.queued')
+        topology = self.make_topology()
+        topology.install(['seedling.tests.queued'])
+        self.assertNotIn(handler, logger.handlers)
+        for number in range(50):
+            logger.info('message %d', number)
+        topology.stop()
+        self.assertEqual(handler.messages, [f'message {number}' for number in range(50)])
+        self.assertNotIn(threading.current_thread(), handler.threads)
+
+    def test_stop_drains_the_queue(self):
+        logger, handler = self.make_logger('seedling.tests.queued')
+        handler.gate.clear()
+        topology = self.make_topology()
+        topology.install(['seedling.tests.queued'])
+        for number in range(20):
+            logger.info('message %d', number)
+        # The listener is stuck on the first record, so the rest are still queued.
+        self.assertEqual(handler.messages, [])
+        handler.gate.set()
+        topology.stop()
+        self.assertEqual(len(handler.messages), 20)
+        self.assertIsNone(topology.listener._thread)
+
+    def test_records_are_dropped_and_counted_when_the_queue_is_full(self):
+        logger, handler = self.make_logger('seedling.tests.queued')
+        _, dropped_handler = self.make_logger('seedling.logging')
+        handler.gate.clear()
+        topology = self.make_topology(max_size=2)
+        topology.install(['seedling.tests.queued', 'seedling.logging'])
+        logger.info('first')
+        # Wait for the listener to take the first record, and block on it.
+        for _ in range(100):
+            if topology.queue.empty():
+                break
+            time.sleep(0.01)
+        for number in range(5):
+            logger.info('message %d', number)
+        self.assertEqual(topology.dropped, 3)
+        handler.gate.set()
+        topology.stop()
+        self.assertEqual(handler.messages, ['first', 'message 0', 'message 1'])
+        self.assertEqual(dropped_handler.messages, ['logging.queue.dropped count=3'])
+
+    def test_gunicorn_hooks_start_and_drain_the_queue(self):
+        logger, handler = self.make_logger('gunicorn.error')
+        topology = self.make_topology()
+        with mock.patch.object(gunicorn_config, 'logging_queue', True), \
+                mock.patch('seedling.logging.queued_logging', topology):
+            gunicorn_config.post_fork(None, None)
+            self.assertIsNotNone(topology.listener._thread)
+            for number in range(10):
+                logger.info('message %d', number)
+            gunicorn_config.worker_exit(None, None)
+        self.assertEqual(len(handler.messages), 10)
+        self.assertIsNone(topology.listener._thread)
+
+
+class LogSamplerTests(SimpleTestCase):
+
+    def make_sampler(self, **kwargs):
+        # One event per name, and then (practically) never another.
+        return LogSampler(default_limit=(0.0001, 1), **kwargs)
+
+    def test_default_limit_applies_per_name(self):
+        sampler = self.make_sampler()
+        self.assertTrue(sampler.allow('a', logging.INFO))
+        self.assertFalse(sampler.allow('a', logging.INFO))
+        self.assertTrue(sampler.allow('b', logging.INFO))
+        self.assertTrue(sampler.allow('a', logging.ERROR))
+
+    def test_default_limit_buckets_are_bounded(self):
+        sampler = self.make_sampler(max_names=2)
+        for name in ('a', 'b', 'a', 'c'):
+            sampler.allow(name, logging.INFO)
+        # 'b' was the least recently seen name.
+        self.assertEqual(list(sampler._default_buckets), ['a', 'c'])
+        for number in range(100):
+            sampler.allow(f'dynamic.{number}', logging.INFO)
+        self.assertEqual(len(sampler._default_buckets), 2)
+
+    def test_suppressed_counts_are_bounded(self):
+        sampler = self.make_sampler(max_names=2)
+        for number in range(5):
+            self.assertTrue(sampler.allow(f'dynamic.{number}', logging.INFO))
+            self.assertFalse(sampler.allow(f'dynamic.{number}', logging.INFO))
+        self.assertEqual(len(sampler._suppressed), 3)
+        self.assertEqual(sampler._suppressed[LogSampler.OTHER], 3)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'metrics-default'},
+    'other': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'metrics-other'},
+})
+class RequestMetricsMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.listener = LocalStatsdListener().start()
+        self.addCleanup(self.listener.stop)
+        client = StatsdClient('127.0.0.1', self.listener.port)
+        patcher = mock.patch('seedling.middleware.get_statsd_client', return_value=client)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        cache.set('present', 'value')
+        self.addCleanup(cache.clear)
+
+    def view(self, request):
+        cache.get('present')
+        cache.get('absent')
+        cache.get_many(['present', 'absent', 'also-absent'])
+        list(User.objects.all())
+        return HttpResponse(engines['django'].from_string('{{ greeting }}').render({'greeting': 'hello'}))
+
+    def send_request(self):
+        request = RequestFactory().get('/')
+        request.resolver_match = mock.Mock(view_name='users:detail')
+        return RequestMetricsMiddleware(self.view)(request)
+
+    def test_sends_the_request_metrics(self):
+        response = self.send_request()
+        self.assertEqual(response.content, b'hello')
+        lines = self.listener.wait_for(7)
+        metrics = {line.split(':', 1)[0]: line.split(':', 1)[1] for line in lines}
+        self.assertEqual(metrics['view.users.detail.cache.hits'], '2|c')
+        self.assertEqual(metrics['view.users.detail.cache.misses'], '3|c')
+        self.assertEqual(metrics['view.users.detail.db.queries'], '1|h')
+        self.assertEqual(metrics['view.users.detail.status.2xx'], '1|c')
+        for timer in ('latency', 'db.time', 'template.time'):
+            self.assertTrue(metrics[f'view.users.detail.{timer}'].endswith('|ms'), timer)
+
+    def test_restores_the_cache_methods(self):
+        self.send_request()
+        self.assertNotIn('get', caches['default'].__dict__)
+        self.assertNotIn('get_many', caches['default'].__dict__)
+        self.assertEqual(cache.get('absent', 'default'), 'default')
+
+    def test_does_not_create_unused_caches(self):
+        try:
+            # An earlier test in this thread may have created it.
+            del caches['other']
+        except AttributeError:
+            pass
+        self.send_request()
+        self.assertEqual([cache for cache in caches.all(initialized_only=True)], [caches['default']])
+
+    def test_counts_caches_created_during_the_request(self):
+        def view(request):
+            caches['other'].get('absent')
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.resolver_match = mock.Mock(view_name='users:detail')
+        RequestMetricsMiddleware(view)(request)
+        metrics = dict(line.split(':', 1) for line in self.listener.wait_for(4))
+        self.assertEqual(metrics['view.users.detail.cache.misses'], '1|c')
+        self.assertNotIn('get', caches['other'].__dict__)
+
+    def test_buffer_is_flushed_when_full(self):
+        client = StatsdClient('127.0.0.1', self.listener.port, max_buffer_size=3)
+        client.incr('one')
+        client.incr('two')
+        self.assertEqual(self.listener.lines, [])
+        client.incr('three')
+        self.assertEqual(self.listener.wait_for(3), ['one:1|c', 'two:1|c', 'three:1|c'])
+        self.assertEqual(client._buffer, [])
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'profiles'}}
+
+
+def profile(path, duration_ms=100.0, timestamp=1634558400.0):
+    return {'timestamp': timestamp, 'method': 'GET', 'path': path, 'duration_ms': duration_ms}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ProfileStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.store = ProfileStore(max_entries=3)
+        self.addCleanup(self.store.clear)
+
+    def test_save_list_and_get(self):
+        first = self.store.save(profile('/first/'))
+        second = self.store.save(profile('/second/', duration_ms=250.5))
+        self.assertEqual(self.store.list(), [
+            (second, 1634558400.0, 250.5, 'GET', '/second/'),
+            (first, 1634558400.0, 100.0, 'GET', '/first/'),
+        ])
+        self.assertEqual(self.store.get(first)['path'], '/first/')
+        self.assertIsNone(self.store.get('missing'))
+
+    def test_only_the_most_recent_entries_are_listed(self):
+        ids = [self.store.save(profile(f'/{number}/')) for number in range(5)]
+        self.assertEqual([entry[0] for entry in self.store.list()], ids[:1:-1])
+
+    def test_clear(self):
+        profile_id = self.store.save(profile('/first/'))
+        self.store.clear()
+        self.assertEqual(self.store.list(), [])
+        self.assertIsNone(self.store.get(profile_id))
+
+
+@override_settings(
+    CACHES=LOCMEM_CACHES,
+    SLOW_REQUEST_PROFILING=True,
+    SLOW_REQUEST_THRESHOLD_MS=20,
+    SLOW_REQUEST_PROFILE_RATE=0.0,
+)
+class SlowRequestProfilerMiddlewareTests(TestCase):
+
+    def setUp(self):
+        self.store = ProfileStore()
+        self.addCleanup(self.store.clear)
+
+    def send_request(self, delay=0.0, path='/users/'):
+        def view(request):
+            list(User.objects.all())
+            time.sleep(delay)
+            return HttpResponse()
+
+        request = RequestFactory().get(path)
+        request.resolver_match = mock.Mock(view_name='users:list')
+        return SlowRequestProfilerMiddleware(view)(request)
+
+    def test_fast_requests_are_not_stored(self):
+        self.send_request()
+        self.assertEqual(self.store.list(), [])
+
+    def test_slow_requests_are_stored_with_their_sql(self):
+        self.send_request(delay=0.03)
+        [(profile_id, _, duration_ms, method, path)] = self.store.list()
+        self.assertGreaterEqual(duration_ms, 20)
+        self.assertEqual((method, path), ('GET', '/users/'))
+        stored = self.store.get(profile_id)
+        self.assertEqual((stored['view'], stored['status'], stored['profiled']), ('users:list', 200, False))
+        self.assertEqual(stored['functions'], [])
+        self.assertEqual(stored['db_queries'], 1)
+        self.assertEqual(stored['sql'][0]['count'], 1)
+        self.assertIn('users_user', stored['sql'][0]['sql'])
+
+    @override_settings(SLOW_REQUEST_PROFILE_RATE=1.0)
+    def test_sampled_requests_have_a_profile(self):
+        self.send_request(delay=0.03)
+        stored = self.store.get(self.store.list()[0][0])
+        self.assertTrue(stored['profiled'])
+        self.assertTrue(any('sleep' in function['function'] for function in stored['functions']))
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=0, SLOW_REQUEST_PROFILE_RATE=1.0)
+    def test_a_zero_threshold_stores_every_profiled_request(self):
+        self.send_request()
+        self.assertEqual(len(self.store.list()), 1)
+
+    @override_settings(SLOW_REQUEST_THRESHOLD_MS=0)
+    def test_a_zero_threshold_does_not_store_unprofiled_requests(self):
+        self.send_request()
+        self.assertEqual(self.store.list(), [])
+
+    @override_settings(SLOW_REQUEST_PROFILING=False)
+    def test_disabled(self):
+        self.send_request(delay=0.03)
+        self.assertEqual(self.store.list(), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class SlowRequestsCommandTests(SimpleTestCase):
+
+    def setUp(self):
+        self.store = ProfileStore()
+        self.addCleanup(self.store.clear)
+
+    def call(self, *args):
+        out = StringIO()
+        call_command('slow_requests', *args, stdout=out)
+        return out.getvalue()
+
+    def test_lists_the_profiles(self):
+        first = self.store.save(profile('/first/', duration_ms=1234.56))
+        second = self.store.save(profile('/second/', duration_ms=50.0, timestamp=1634558460.0))
+        self.assertEqual(self.call().splitlines(), [
+            f'{second}  2021-10-18T12:01:00+00:00        50.0 ms  GET /second/',
+            f'{first}  2021-10-18T12:00:00+00:00      1234.6 ms  GET /first/',
+        ])
+
+    def test_dumps_one_profile_as_json(self):
+        profile_id = self.store.save(profile('/first/'))
+        self.assertEqual(json.loads(self.call(profile_id)), dict(profile('/first/'), id=profile_id))
+
+    def test_unknown_profiles(self):
+        with self.assertRaisesMessage(CommandError, "No profile with id 'missing'"):
+            self.call('missing')
+
+    def test_clear(self):
+        self.store.save(profile('/first/'))
+        self.assertEqual(self.call('--clear'), '')
+        self.assertEqual(self.store.list(), [])
+
+
+class CurrentRequestMiddlewareTests(SimpleTestCase):
+
+    def test_the_request_is_current_until_the_response(self):
+        request = RequestFactory().get('/')
+        seen = []
+
+        def view(r):
+            seen.append(get_current_request())
+            return HttpResponse()
+
+        CurrentRequestMiddleware(view)(request)
+        self.assertEqual(seen, [request])
+        self.assertIsNone(get_current_request())
+
+    def test_the_request_is_reset_when_the_view_raises(self):
+        def view(r):
+            raise ValueError('broken')
+
+        with self.assertRaises(ValueError):
+            CurrentRequestMiddleware(view)(RequestFactory().get('/'))
+        self.assertIsNone(get_current_request())
+
+    def test_threads_see_their_own_request(self):
+        barrier = threading.Barrier(2, timeout=5)
+        seen = {}
+
+        def view(request):
+            # Both requests are current at the same time.
+            barrier.wait()
+            seen[request.path] = get_current_request()
+            return HttpResponse()
+
+        requests = [RequestFactory().get(f'/{number}/') for number in range(2)]
+        threads = [threading.Thread(target=CurrentRequestMiddleware(view), args=(request,)) for request in requests]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(seen, {request.path: request for request in requests})
+
+    async def test_tasks_see_their_own_request(self):
+        both_started = asyncio.Event()
+        started = []
+        seen = {}
+
+        async def view(request):
+            started.append(request)
+            if len(started) == 2:
+                both_started.set()
+            await asyncio.wait_for(both_started.wait(), 5)
+            seen[request.path] = get_current_request()
+            return HttpResponse()
+
+        middleware = CurrentRequestMiddleware(view)
+        requests = [RequestFactory().get(f'/{number}/') for number in range(2)]
+        await asyncio.gather(*(middleware(request) for request in requests))
+        self.assertEqual(seen, {request.path: request for request in requests})
+        self.assertIsNone(get_current_request())
+
+
+def describe_request(request):
+    current = get_current_request()
+    return HttpResponse(f'{request.path} current={current is request} ip={get_request_context_fields()["remote_ip"]}')
+
+
+async def async_view(request):
+    return describe_request(request)
+
+
+def rendezvous(request):
+    rendezvous_barrier.wait()
+    return HttpResponse()
+
+
+# The two requests of ASGITests.test_sync_views_run_concurrently wait here for each other.
+rendezvous_barrier = threading.Barrier(2, timeout=2)
+
+
+# The URLs for ASGITests.
+urlpatterns = [
+    path('async/', async_view),
+    path('sync/', describe_request),
+    path('rendezvous/', rendezvous),
+]
+
+
+@override_settings(ROOT_URLCONF='seedling.core.tests')
+class ASGITests(SimpleTestCase):
+
+    async def test_requests_run_through_the_async_middleware_chain(self):
+        calls = []
+        original = CurrentRequestMiddleware.__acall__
+
+        async def spy(middleware, request):
+            calls.append(request.path)
+            return await original(middleware, request)
+
+        with mock.patch.object(CurrentRequestMiddleware, '__acall__', spy):
+            client = AsyncClient()
+            async_response = await client.get('/async/')
+            sync_response = await client.get('/sync/')
+        self.assertEqual(calls, ['/async/', '/sync/'])
+        self.assertEqual(async_response.content, b'/async/ current=True ip=127.0.0.1')
+        # Sync views run in another thread, and the current request follows them there.
+        self.assertEqual(sync_response.content, b'/sync/ current=True ip=127.0.0.1')
+
+    @staticmethod
+    async def asgi_get(path):
+        """
+        Return the start and body messages of seedling.asgi's response to a GET of ``path``.
+        """
+        from ..asgi import application
+        communicator = ApplicationCommunicator(application, {
+            'type': 'http',
+            'asgi': {'version': '3.0'},
+            'http_version': '1.1',
+            'method': 'GET',
+            'scheme': 'http',
+            'path': path,
+            'raw_path': path.encode(),
+            'query_string': b'',
+            'root_path': '',
+            'headers': [(b'host', b'testserver')],
+            'client': ('127.0.0.1', 12345),
+            'server': ('testserver', 80),
+        })
+        await communicator.send_input({'type': 'http.request', 'body': b'', 'more_body': False})
+        start = await communicator.receive_output(5)
+        body = await communicator.receive_output(5)
+        await communicator.wait(5)
+        return start, body
+
+    async def test_asgi_application(self):
+        start, body = await self.asgi_get('/async/')
+        self.assertEqual((start['type'], start['status']), ('http.response.start', 200))
+        self.assertEqual(body['body'], b'/async/ current=True ip=127.0.0.1')
+
+    async def test_sync_views_run_concurrently(self):
+        # Each request waits in the view for the other, which only works if they run in different threads.
+        responses = await asyncio.gather(self.asgi_get('/rendezvous/'), self.asgi_get('/rendezvous/'))
+        self.assertEqual([start['status'] for start, body in responses], [200, 200])
+
+    def test_middleware_must_implement_acall(self):
+        class SyncOnlyMiddleware(AsyncCapableMiddleware):
+
+            def __call__(self, request):
+                return self.get_response(request)
+
+        with self.assertRaisesMessage(ImproperlyConfigured, 'SyncOnlyMiddleware must implement'):
+            SyncOnlyMiddleware(lambda request: None)
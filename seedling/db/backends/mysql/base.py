@@ -0,0 +1,67 @@
+"""
+Django's MySQL backend, plus validation of persistent connections.
+
+Django 3.2 reuses a persistent (CONN_MAX_AGE) connection without checking it, so a connection that the server or a
+proxy has dropped fails the first query of the next request. When ``CONN_HEALTH_CHECKS`` is ``True`` in the database's
+settings, this backend pings a reused connection the first time each request uses it, and reconnects if the ping
+fails, just like Django 4.1's setting of the same name.
+"""
+from django.db import utils
+from django.db.backends.mysql import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, settings_dict, *args, **kwargs):
+        super().__init__(settings_dict, *args, **kwargs)
+        self.health_check_enabled = settings_dict.get('CONN_HEALTH_CHECKS', False)
+        self.health_check_done = False
+
+    def connect(self):
+        # A brand new connection doesn't need checking, not even by the set_autocommit() that connect() makes.
+        self.health_check_done = True
+        super().connect()
+
+    def close_if_unusable_or_obsolete(self):
+        # Django calls this at the start and end of every request. It checks the autocommit mode through
+        # ensure_connection(), which is why the health check is made by the first cursor() or set_autocommit() instead.
+        if self.connection is not None:
+            self.health_check_done = False
+        super().close_if_unusable_or_obsolete()
+
+    def _close_if_health_check_failed(self):
+        if (
+            self.connection is None or not self.health_check_enabled or self.health_check_done
+            or self.in_atomic_block
+        ):
+            return
+        self.health_check_done = True
+        if not self.is_usable():
+            self._discard_connection()
+
+    def set_autocommit(self, *args, **kwargs):
+        # With ATOMIC_REQUESTS, this is a request's first use of the connection.
+        self._close_if_health_check_failed()
+        super().set_autocommit(*args, **kwargs)
+
+    def _cursor(self, name=None):
+        self._close_if_health_check_failed()
+        return super()._cursor(name)
+
+    def _discard_connection(self):
+        """
+        Throw away a connection which failed its health check, so that ensure_connection() makes a new one.
+        """
+        # This keeps seedling.db.backends.mysql_pool from returning it to the pool.
+        self.errors_occurred = True
+        try:
+            self.close()
+        except (self.Database.Error, utils.Error):
+            # The connection is already broken, so there's nothing to close cleanly.
+            self.connection = None
+
+    def _set_autocommit(self, autocommit):
+        # The client library already knows the connection's autocommit mode, so skip the round trip to set it to what
+        # it already is, which is the common case for persistent and pooled connections.
+        if self.connection.get_autocommit() != autocommit:
+            super()._set_autocommit(autocommit)
@@ -0,0 +1,110 @@
+"""
+seedling.db.backends.mysql, with the real MySQL connections shared through an in-process ``ConnectionPool``.
+
+Django opens a connection per thread, and closes it at the end of each request when CONN_MAX_AGE is 0. With this
+backend, "opening" takes an already-connected and already-initialized connection from the pool, and "closing" returns
+it, so requests no longer pay for TCP setup, authentication and session setup. Use it with CONN_MAX_AGE = 0.
+
+Configure the pool with a ``POOL`` dict in the database's settings, whose keys are ``ConnectionPool``'s arguments in
+upper case: ``SIZE``, ``MAX_OVERFLOW``, ``TIMEOUT``, ``IDLE_TIMEOUT``, ``PING_INTERVAL`` and ``MAX_LIFETIME``.
+
+If STATSD_HOST is set, every checkout sends ``db.pool.<alias>.wait`` (timer) and ``db.pool.<alias>.checked_out``
+(gauge) metrics, and ``pool_stats()`` returns the pool's counters for this process.
+"""
+import os
+import threading
+
+from django.db.backends.mysql.base import Database
+
+from ....statsd import get_statsd_client
+from ...pool import ConnectionPool, PoolTimeout
+from ..mysql import base
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(alias, settings_dict, connect):
+    """
+    Return this process's pool for the given database alias, creating it if necessary.
+    """
+    global _pools_pid
+    pool = _pools.get(alias)
+    if pool is not None and _pools_pid == os.getpid():
+        return pool
+    with _pools_lock:
+        if _pools_pid != os.getpid():
+            # Connections inherited from our parent process belong to it; never use or close them here.
+            _pools.clear()
+            _pools_pid = os.getpid()
+        if alias not in _pools:
+            options = {key.lower(): value for key, value in settings_dict.get('POOL', {}).items()}
+            _pools[alias] = ConnectionPool(connect, **options)
+        return _pools[alias]
+
+
+def find_pool(alias):
+    """
+    Return this process's pool for the given database alias, or ``None`` if it hasn't made one.
+    """
+    if _pools_pid != os.getpid():
+        return None
+    return _pools.get(alias)
+
+
+def pool_stats():
+    """
+    Return the stats() of each of this process's pools, keyed by database alias.
+    """
+    return {alias: pool.stats() for alias, pool in list(_pools.items())}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        self._pool_entry = None
+
+    def get_new_connection(self, conn_params):
+        def connect():
+            return super(DatabaseWrapper, self).get_new_connection(conn_params)
+
+        pool = get_pool(self.alias, self.settings_dict, connect)
+        try:
+            entry, wait = pool.checkout()
+        except PoolTimeout as e:
+            # Raise it as a database error, so that Django wraps it in django.db.utils.OperationalError.
+            raise Database.OperationalError(str(e)) from e
+        self._pool, self._pool_entry = pool, entry
+        client = get_statsd_client()
+        if client is not None:
+            client.timing(f'db.pool.{self.alias}.wait', wait * 1000)
+            client.gauge(f'db.pool.{self.alias}.checked_out', pool.stats()['checked_out'])
+        return entry.connection
+
+    def init_connection_state(self):
+        # This runs SET statements whose effects last as long as the connection does, so pooled connections only
+        # need it once.
+        if not self._pool_entry.initialized:
+            super().init_connection_state()
+            self._pool_entry.initialized = True
+
+    def _close(self):
+        pool, entry = self._pool, self._pool_entry
+        self._pool = self._pool_entry = None
+        if entry is None or pool is not find_pool(self.alias):
+            # Either this isn't a pooled connection, or it came from a pool that this process doesn't have, e.g. one
+            # inherited across a fork(), so there's nowhere to return it to.
+            return super()._close()
+        discard = self.errors_occurred or self.needs_rollback
+        if not discard:
+            try:
+                if not self.connection.get_autocommit():
+                    # Never hand a connection with an open transaction to the next request.
+                    self.connection.rollback()
+                    self.connection.autocommit(True)
+            except Database.Error:
+                discard = True
+        pool.checkin(entry, discard=discard)
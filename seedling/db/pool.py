@@ -0,0 +1,177 @@
+"""
+A thread-safe, in-process pool of DB-API connections.
+
+``seedling.db.backends.mysql_pool`` uses this, so that gthread and async workers, whose many threads each have their
+own Django database connection, reuse a small set of real MySQL connections instead of opening one per request.
+"""
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection became available within the pool's ``timeout``.
+    """
+
+
+class _PooledConnection(object):
+    """
+    A real connection, plus the pool's bookkeeping about it.
+    """
+
+    __slots__ = ('connection', 'created', 'last_used', 'initialized')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.created = self.last_used = time.monotonic()
+        # Whether the backend has already run its per-connection setup queries on this connection.
+        self.initialized = False
+
+
+class ConnectionPool(object):
+    """
+    :param connect: a function which returns a new DB-API connection
+    :param size: how many idle connections to keep
+    :param max_overflow: how many connections may be checked out beyond ``size`` during bursts. Those are closed,
+        rather than kept, when they're returned, if ``size`` connections are already idle.
+    :param timeout: how many seconds checkout() waits for a connection when ``size + max_overflow`` are in use
+    :param idle_timeout: idle connections older than this many seconds are closed instead of reused
+    :param ping_interval: idle connections which haven't been used for this many seconds are pinged before reuse
+    :param max_lifetime: connections older than this many seconds are closed instead of reused. ``None`` for no limit.
+    """
+
+    def __init__(self, connect, size=5, max_overflow=10, timeout=10.0, idle_timeout=300.0, ping_interval=30.0,
+                 max_lifetime=None):
+        self.connect = connect
+        self.size = size
+        self.max_overflow = max_overflow
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.ping_interval = ping_interval
+        self.max_lifetime = max_lifetime
+        self._idle = deque()
+        self._checked_out = 0
+        self._condition = threading.Condition(threading.Lock())
+        # Counters for stats().
+        self.created = 0
+        self.discarded = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+
+    def _is_stale(self, entry, now):
+        if now - entry.last_used > self.idle_timeout:
+            return True
+        return self.max_lifetime is not None and now - entry.created > self.max_lifetime
+
+    def _close(self, entry):
+        self.discarded += 1
+        try:
+            entry.connection.close()
+        except Exception:  # noqa
+            # It's being thrown away because it's unusable, so failing to close it is expected.
+            pass
+
+    def checkout(self):
+        """
+        Return a ``(_PooledConnection, wait)`` pair, where the entry's ``connection`` is ready to use and ``wait`` is
+        how many seconds we waited for it. Makes a new connection if there are no idle ones and we're below
+        ``size + max_overflow``, and waits for one to be returned otherwise.
+        """
+        start = None
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                while self._idle:
+                    entry = self._idle.pop()
+                    if self._is_stale(entry, now):
+                        self._close(entry)
+                        continue
+                    self._checked_out += 1
+                    break
+                else:
+                    entry = None
+                if entry is not None:
+                    break
+                if self._checked_out < self.size + self.max_overflow:
+                    # Reserve the slot before connecting outside of the lock.
+                    self._checked_out += 1
+                    break
+                if start is None:
+                    start = now
+                    self.waits += 1
+                remaining = self.timeout - (now - start)
+                # Treat a sliver of remaining time as none, so float rounding can't turn the timeout into a busy loop.
+                if remaining <= 1e-9:
+                    self.timeouts += 1
+                    self.wait_time += now - start
+                    raise PoolTimeout(
+                        f'No database connection became available within {self.timeout}s '
+                        f'({self._checked_out} checked out).'
+                    )
+                self._condition.wait(remaining)
+            if start is not None:
+                self.wait_time += time.monotonic() - start
+
+        if entry is not None and time.monotonic() - entry.last_used > self.ping_interval and not self._ping(entry):
+            self._close(entry)
+            entry = None
+        if entry is None:
+            try:
+                entry = _PooledConnection(self.connect())
+            except BaseException:
+                self._release_slot()
+                raise
+            self.created += 1
+        return entry, (time.monotonic() - start) if start is not None else 0.0
+
+    @staticmethod
+    def _ping(entry):
+        try:
+            entry.connection.ping()
+        except Exception:  # noqa
+            return False
+        return True
+
+    def _release_slot(self):
+        with self._condition:
+            self._checked_out -= 1
+            self._condition.notify()
+
+    def checkin(self, entry, discard=False):
+        """
+        Return a connection to the pool. Pass ``discard=True`` if it's broken, or in an unknown state.
+        """
+        entry.last_used = time.monotonic()
+        with self._condition:
+            self._checked_out -= 1
+            if not discard and len(self._idle) < self.size:
+                self._idle.append(entry)
+                entry = None
+            self._condition.notify()
+        if entry is not None:
+            self._close(entry)
+
+    def close_all(self):
+        """
+        Close every idle connection, e.g. after a fork.
+        """
+        with self._condition:
+            idle, self._idle = self._idle, deque()
+        for entry in idle:
+            self._close(entry)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'idle': len(self._idle),
+                'checked_out': self._checked_out,
+                'created': self.created,
+                'discarded': self.discarded,
+                'waits': self.waits,
+                'wait_time_ms': round(self.wait_time * 1000, 3),
+                'timeouts': self.timeouts,
+            }
@@ -0,0 +1,224 @@
+"""
+Read-replica routing.
+
+``ReplicaRouter`` sends reads to the database aliases in settings.DATABASE_REPLICAS, and everything else to
+``default``. Reads go to the primary instead when:
+
+  * the current request has already written to the primary, so it always sees its own writes.
+    ``ReplicaPinningMiddleware`` extends this to the following REPLICA_PIN_SECONDS of the same client's requests, so
+    e.g. the page a form POST redirects to shows the change. Code that runs outside of a request, like a management
+    command, gets the same behaviour inside ``with primary_pinning():``. Reads that must not be stale even before the
+    first write, like read-modify-write cycles, should use select_for_update() or .using('default').
+  * every replica is more than REPLICA_MAX_LAG seconds behind the primary, or can't be reached. Each replica's lag is
+    checked at most once per REPLICA_LAG_CHECK_INTERVAL seconds per process.
+"""
+import contextvars
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.db.backends.signals import connection_created
+
+from ..logging import logger
+
+
+class _PinState(object):
+    """
+    Whether the current request must read from the primary. This is a mutable object, rather than a plain value in
+    the contextvar, because under ASGI the ORM runs in a copy of the request's context, where a set() wouldn't be seen
+    by our middleware.
+    """
+
+    __slots__ = ('pinned', 'wrote')
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+
+
+_pin_state = contextvars.ContextVar('replica_pin_state', default=None)
+
+
+def begin_pinning(pinned=False):
+    """
+    Start tracking writes for a new request. Returns a token for end_pinning(), which must always be called with it.
+    """
+    return _pin_state.set(_PinState(pinned))
+
+
+def end_pinning(token):
+    """
+    Return whether the request that begin_pinning() returned ``token`` for wrote to the primary, and stop tracking it.
+    """
+    state = _pin_state.get()
+    _pin_state.reset(token)
+    return state is not None and state.wrote
+
+
+@contextmanager
+def primary_pinning(pinned=False):
+    """
+    Track writes within this context, just like ReplicaPinningMiddleware does for a request, so that reads which
+    follow a write go to the primary. Yields the state, whose ``wrote`` attribute says whether we wrote.
+    """
+    token = begin_pinning(pinned)
+    try:
+        yield _pin_state.get()
+    finally:
+        end_pinning(token)
+
+
+def pin_to_primary():
+    """
+    Send the rest of the current request's reads to the primary. Outside of ReplicaPinningMiddleware and
+    primary_pinning() there's nothing to pin, since nothing would ever unpin it, so this returns ``False``.
+    """
+    state = _pin_state.get()
+    if state is None:
+        return False
+    state.pinned = state.wrote = True
+    return True
+
+
+def is_pinned_to_primary():
+    state = _pin_state.get()
+    return state is not None and state.pinned
+
+
+_write_statement = re.compile(r'\s*(INSERT|UPDATE|DELETE|REPLACE)\b', re.IGNORECASE)
+
+
+def _detect_writes(execute, sql, params, many, context):
+    """
+    A connection.execute_wrapper() for the primary, which pins the current request to it when it runs a statement
+    that changes data. The router can't do this itself, because db_for_write() is also asked about reads that merely
+    need the primary, like a transaction.atomic(using=router.db_for_write(model)) around a GET.
+    """
+    if _pin_state.get() is not None and _write_statement.match(sql):
+        pin_to_primary()
+    return execute(sql, params, many, context)
+
+
+# noinspection PyUnusedLocal
+def _install_write_detector(sender, connection, **kwargs):
+    if connection.alias == DEFAULT_DB_ALIAS and _detect_writes not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_detect_writes)
+
+
+def _instrument_writes():
+    connection_created.connect(_install_write_detector, dispatch_uid='seedling.db.routers.detect_writes')
+    # The primary's connection may have been opened before our router was loaded.
+    _install_write_detector(None, connections[DEFAULT_DB_ALIAS])
+
+
+class _LagMonitor(object):
+    """
+    Caches each replica's replication lag, in seconds, for ``interval`` seconds.
+    """
+
+    def __init__(self):
+        self._checked = {}
+        self._lock = threading.Lock()
+
+    def lag(self, alias, interval):
+        now = time.monotonic()
+        checked = self._checked.get(alias)
+        if checked is not None and now - checked[0] < interval:
+            return checked[1]
+        lag = self._query_lag(alias)
+        with self._lock:
+            self._checked[alias] = (now, lag)
+        return lag
+
+    @staticmethod
+    def _query_lag(alias):
+        """
+        Return how many seconds ``alias`` is behind the primary, 0 if it can't tell (e.g. on SQLite), or ``None`` if
+        the replica is unusable.
+        """
+        connection = connections[alias]
+        if connection.vendor != 'mysql':
+            return 0
+        # MySQL 8.0.22 renamed SHOW SLAVE STATUS and its Seconds_Behind_Master column, and 8.4 dropped the old names.
+        error = None
+        for statement, column in (
+            ('SHOW REPLICA STATUS', 'Seconds_Behind_Source'),
+            ('SHOW SLAVE STATUS', 'Seconds_Behind_Master'),
+        ):
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(statement)
+                    row = cursor.fetchone()
+                    if row is None:
+                        # This server isn't replicating from anything, so it's as up to date as it'll ever be.
+                        return 0
+                    columns = [description[0] for description in cursor.description]
+            except Exception as e:  # noqa
+                error = e
+                continue
+            lag = dict(zip(columns, row)).get(column)
+            if lag is None:
+                # This column is NULL when replication is broken.
+                logger.warning('db.replica.lag.unknown', alias=alias, reason='replication is not running')
+            return lag
+        logger.warning('db.replica.lag.unknown', alias=alias, reason=str(error))
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._checked.clear()
+
+
+lag_monitor = _LagMonitor()
+
+
+class ReplicaRouter(object):
+
+    def __init__(self):
+        _instrument_writes()
+
+    def _replicas(self):
+        return getattr(settings, 'DATABASE_REPLICAS', [])
+
+    def _healthy_replicas(self):
+        max_lag = getattr(settings, 'REPLICA_MAX_LAG', 5)
+        interval = getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5)
+        healthy = []
+        for alias in self._replicas():
+            lag = lag_monitor.lag(alias, interval)
+            if lag is not None and lag <= max_lag:
+                healthy.append(alias)
+        return healthy
+
+    # noinspection PyUnusedLocal
+    def db_for_read(self, model, **hints):
+        if is_pinned_to_primary():
+            return DEFAULT_DB_ALIAS
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db == DEFAULT_DB_ALIAS:
+            # Related objects of something we loaded from the primary come from the primary too.
+            return DEFAULT_DB_ALIAS
+        healthy = self._healthy_replicas()
+        if not healthy:
+            return DEFAULT_DB_ALIAS
+        return random.choice(healthy)
+
+    # noinspection PyUnusedLocal
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    # noinspection PyUnusedLocal
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *self._replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    # noinspection PyUnusedLocal
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # The replicas get their schema changes through replication.
+        return db not in self._replicas()
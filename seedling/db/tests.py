@@ -0,0 +1,640 @@
+import threading
+from unittest import mock, skipUnless
+
+from django.contrib.auth.models import Group
+from django.db import router, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from ..middleware import ReplicaPinningMiddleware
+from .pool import ConnectionPool, PoolTimeout
+from .routers import lag_monitor, pin_to_primary, primary_pinning
+
+try:
+    import MySQLdb
+except ImportError:
+    # mysqlclient is in requirements.txt, but it can't be built without the MySQL client library.
+    MySQLdb = None
+else:
+    from .backends.mysql import base as mysql_base
+    from .backends.mysql_pool import base as mysql_pool_base
+
+
+class FakeConnection(object):
+
+    def __init__(self, number):
+        self.number = number
+        self.closed = False
+        self.broken = False
+        self.pings = 0
+
+    def ping(self):
+        self.pings += 1
+        if self.broken:
+            raise OSError('MySQL server has gone away')
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock(object):
+    """
+    Stands in for the time module in seedling.db.pool, so that tests can move time forward.
+    """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def monotonic(self):
+        return self.now
+
+
+class ConnectionPoolTests(SimpleTestCase):
+
+    def setUp(self):
+        self.connections = []
+        self.clock = FakeClock()
+        patcher = mock.patch('seedling.db.pool.time', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def connect(self):
+        connection = FakeConnection(len(self.connections))
+        self.connections.append(connection)
+        return connection
+
+    def make_pool(self, **kwargs):
+        kwargs.setdefault('size', 2)
+        kwargs.setdefault('max_overflow', 1)
+        return ConnectionPool(self.connect, **kwargs)
+
+    def test_reuses_returned_connections(self):
+        pool = self.make_pool()
+        entry, wait = pool.checkout()
+        self.assertEqual(wait, 0.0)
+        pool.checkin(entry)
+        self.assertIs(pool.checkout()[0], entry)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_overflow_connections_are_closed_when_returned(self):
+        pool = self.make_pool()
+        entries = [pool.checkout()[0] for _ in range(3)]
+        self.assertEqual(pool.stats()['checked_out'], 3)
+        for entry in entries:
+            pool.checkin(entry)
+        self.assertEqual([connection.closed for connection in self.connections], [False, False, True])
+        self.assertEqual(pool.stats()['idle'], 2)
+
+    def test_checkout_times_out_when_every_connection_is_in_use(self):
+        pool = self.make_pool(size=1, max_overflow=0, timeout=0.05)
+        pool.checkout()
+        # Let the condition wait use real time, while pool.time.monotonic() moves past the timeout.
+        with mock.patch.object(pool._condition, 'wait', side_effect=lambda timeout: setattr(
+                self.clock, 'now', self.clock.now + timeout)):
+            with self.assertRaises(PoolTimeout):
+                pool.checkout()
+        stats = pool.stats()
+        self.assertEqual((stats['waits'], stats['timeouts'], stats['wait_time_ms']), (1, 1, 50.0))
+        self.assertEqual(len(self.connections), 1)
+
+    def test_checkout_waits_for_a_returned_connection(self):
+        pool = self.make_pool(size=1, max_overflow=0, timeout=5)
+        entry = pool.checkout()[0]
+        waiting = threading.Event()
+
+        def wait(timeout):
+            waiting.set()
+            self.clock.now += 0.25
+            # Simulate another thread returning its connection while we wait.
+            pool._condition.release()
+            try:
+                pool.checkin(entry)
+            finally:
+                pool._condition.acquire()
+
+        with mock.patch.object(pool._condition, 'wait', side_effect=wait):
+            self.assertEqual(pool.checkout(), (entry, 0.25))
+        self.assertTrue(waiting.is_set())
+        self.assertEqual(pool.stats()['waits'], 1)
+
+    def test_idle_connections_are_evicted(self):
+        pool = self.make_pool(idle_timeout=60)
+        entry = pool.checkout()[0]
+        pool.checkin(entry)
+        self.clock.now += 61
+        self.assertIsNot(pool.checkout()[0], entry)
+        self.assertTrue(entry.connection.closed)
+        self.assertEqual(pool.stats()['discarded'], 1)
+
+    def test_old_connections_are_evicted(self):
+        pool = self.make_pool(max_lifetime=100)
+        entry = pool.checkout()[0]
+        for _ in range(3):
+            self.clock.now += 40
+            pool.checkin(entry)
+            entry = pool.checkout()[0]
+        self.assertEqual(len(self.connections), 2)
+        self.assertTrue(self.connections[0].closed)
+
+    def test_connections_idle_past_the_ping_interval_are_pinged(self):
+        pool = self.make_pool(ping_interval=30)
+        entry = pool.checkout()[0]
+        pool.checkin(entry)
+        self.clock.now += 10
+        pool.checkin(pool.checkout()[0])
+        self.assertEqual(entry.connection.pings, 0)
+        self.clock.now += 31
+        self.assertIs(pool.checkout()[0], entry)
+        self.assertEqual(entry.connection.pings, 1)
+
+    def test_connections_which_fail_their_ping_are_replaced(self):
+        pool = self.make_pool(ping_interval=30)
+        entry = pool.checkout()[0]
+        pool.checkin(entry)
+        entry.connection.broken = True
+        self.clock.now += 31
+        replacement = pool.checkout()[0]
+        self.assertIsNot(replacement, entry)
+        self.assertTrue(entry.connection.closed)
+        self.assertEqual(pool.stats()['checked_out'], 1)
+
+    def test_discarded_connections_are_closed(self):
+        pool = self.make_pool()
+        entry = pool.checkout()[0]
+        pool.checkin(entry, discard=True)
+        self.assertTrue(entry.connection.closed)
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertIsNot(pool.checkout()[0], entry)
+
+    def test_failed_connect_releases_its_slot(self):
+        pool = self.make_pool(size=1, max_overflow=0)
+        with mock.patch.object(pool, 'connect', side_effect=OSError('Connection refused')):
+            with self.assertRaises(OSError):
+                pool.checkout()
+        self.assertEqual(pool.stats()['checked_out'], 0)
+        pool.checkout()
+
+    def test_close_all(self):
+        pool = self.make_pool()
+        entries = [pool.checkout()[0] for _ in range(2)]
+        for entry in entries:
+            pool.checkin(entry)
+        pool.close_all()
+        self.assertTrue(all(connection.closed for connection in self.connections))
+        self.assertEqual(pool.stats()['idle'], 0)
+
+    def test_stats(self):
+        pool = self.make_pool()
+        kept = pool.checkout()[0]
+        pool.checkin(pool.checkout()[0], discard=True)
+        self.assertEqual(pool.stats(), {
+            'size': 2,
+            'max_overflow': 1,
+            'idle': 0,
+            'checked_out': 1,
+            'created': 2,
+            'discarded': 1,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'timeouts': 0,
+        })
+        pool.checkin(kept)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+
+@override_settings(
+    DATABASE_REPLICAS=['replica'],
+    DATABASE_ROUTERS=['seedling.db.routers.ReplicaRouter'],
+    REPLICA_MAX_LAG=5,
+    REPLICA_LAG_CHECK_INTERVAL=60,
+    REPLICA_PIN_SECONDS=5,
+)
+class ReplicaRouterTests(TestCase):
+    """
+    The ``replica`` database is a separate SQLite database here, rather than a mirror of ``default``, so that we can
+    tell which one each query went to.
+    """
+
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        lag_monitor.clear()
+        self.addCleanup(lag_monitor.clear)
+        Group.objects.using('replica').create(name='replicated')
+
+    def names(self):
+        return list(Group.objects.order_by('name').values_list('name', flat=True))
+
+    def request(self, view, pinned=False):
+        request = RequestFactory().get('/')
+        if pinned:
+            request.COOKIES[ReplicaPinningMiddleware.cookie_name] = '1'
+        return ReplicaPinningMiddleware(view)(request)
+
+    def test_reads_go_to_the_replica(self):
+        self.assertEqual(router.db_for_read(Group), 'replica')
+        self.assertEqual(self.names(), ['replicated'])
+
+    def test_writes_go_to_the_primary(self):
+        Group.objects.create(name='written')
+        self.assertTrue(Group.objects.using('default').filter(name='written').exists())
+        self.assertFalse(Group.objects.using('replica').filter(name='written').exists())
+
+    def test_a_write_pins_the_rest_of_the_request_to_the_primary(self):
+        seen = []
+
+        def view(request):
+            seen.append(self.names())
+            Group.objects.create(name='written')
+            seen.append(self.names())
+            return HttpResponse()
+
+        response = self.request(view)
+        self.assertEqual(seen, [['replicated'], ['written']])
+        cookie = response.cookies[ReplicaPinningMiddleware.cookie_name]
+        self.assertEqual(cookie['max-age'], 5)
+        self.assertTrue(cookie['httponly'])
+
+    def test_the_cookie_pins_the_next_request_to_the_primary(self):
+        seen = []
+
+        def view(request):
+            seen.append(router.db_for_read(Group))
+            return HttpResponse()
+
+        response = self.request(view, pinned=True)
+        self.assertEqual(seen, ['default'])
+        # Only a write starts a new pin.
+        self.assertNotIn(ReplicaPinningMiddleware.cookie_name, response.cookies)
+        self.request(view)
+        self.assertEqual(seen, ['default', 'replica'])
+
+    def test_asking_for_the_write_database_does_not_pin(self):
+        seen = []
+
+        def view(request):
+            # What the admin's changeform view does, even for a GET.
+            with transaction.atomic(using=router.db_for_write(Group)):
+                Group.objects.using('default').count()
+            seen.append(router.db_for_read(Group))
+            return HttpResponse()
+
+        response = self.request(view)
+        self.assertEqual(seen, ['replica'])
+        self.assertNotIn(ReplicaPinningMiddleware.cookie_name, response.cookies)
+
+    def test_primary_pinning(self):
+        with primary_pinning() as state:
+            self.assertEqual(router.db_for_read(Group), 'replica')
+            Group.objects.create(name='written')
+            self.assertTrue(state.wrote)
+            self.assertEqual(router.db_for_read(Group), 'default')
+        self.assertEqual(router.db_for_read(Group), 'replica')
+
+    def test_writes_outside_of_a_pinning_scope_do_not_pin(self):
+        self.assertFalse(pin_to_primary())
+        Group.objects.create(name='written')
+        self.assertEqual(router.db_for_read(Group), 'replica')
+
+    def test_falls_back_to_the_primary_when_the_replica_lags_too_far(self):
+        with mock.patch.object(lag_monitor, '_query_lag', return_value=6):
+            self.assertEqual(router.db_for_read(Group), 'default')
+        lag_monitor.clear()
+        with mock.patch.object(lag_monitor, '_query_lag', return_value=5):
+            self.assertEqual(router.db_for_read(Group), 'replica')
+
+    def test_falls_back_to_the_primary_when_the_replica_lag_is_unknown(self):
+        with mock.patch.object(lag_monitor, '_query_lag', return_value=None):
+            self.assertEqual(router.db_for_read(Group), 'default')
+
+    def test_lag_is_checked_once_per_interval(self):
+        with mock.patch.object(lag_monitor, '_query_lag', return_value=0) as query_lag:
+            for _ in range(3):
+                router.db_for_read(Group)
+        self.assertEqual(query_lag.call_count, 1)
+
+    def test_replicas_are_not_migrated(self):
+        self.assertTrue(router.allow_migrate('default', 'auth'))
+        self.assertFalse(router.allow_migrate('replica', 'auth'))
+
+
+class FakeCursor(object):
+    """
+    Answers each statement with the (columns, row) from ``results``, or raises it if it's an exception.
+    """
+
+    def __init__(self, results):
+        self.results = results
+        self.description = None
+        self.row = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        result = self.results[sql]
+        if isinstance(result, Exception):
+            raise result
+        columns, self.row = result
+        self.description = [(column,) for column in columns]
+
+    def fetchone(self):
+        return self.row
+
+
+class FakeMySQLConnection(object):
+
+    vendor = 'mysql'
+
+    def __init__(self, results):
+        self.results = results
+
+    def cursor(self):
+        return FakeCursor(self.results)
+
+
+class ReplicaLagTests(SimpleTestCase):
+
+    def query_lag(self, **results):
+        connection = FakeMySQLConnection({statement.replace('_', ' '): result for statement, result in results.items()})
+        with mock.patch('seedling.db.routers.connections', {'replica': connection}):
+            with mock.patch('seedling.db.routers.logger') as logger:
+                lag = lag_monitor._query_lag('replica')
+        return lag, logger.warning.call_args_list
+
+    def test_show_replica_status(self):
+        lag, warnings = self.query_lag(SHOW_REPLICA_STATUS=(['Source_Host', 'Seconds_Behind_Source'], ('db', 3)))
+        self.assertEqual((lag, warnings), (3, []))
+
+    def test_falls_back_to_show_slave_status(self):
+        lag, warnings = self.query_lag(
+            SHOW_REPLICA_STATUS=Exception('You have an error in your SQL syntax'),
+            SHOW_SLAVE_STATUS=(['Master_Host', 'Seconds_Behind_Master'], ('db', 2)),
+        )
+        self.assertEqual((lag, warnings), (2, []))
+
+    def test_a_server_which_is_not_replicating_has_no_lag(self):
+        lag, warnings = self.query_lag(SHOW_REPLICA_STATUS=([], None))
+        self.assertEqual((lag, warnings), (0, []))
+
+    def test_broken_replication_is_unknown_lag(self):
+        lag, warnings = self.query_lag(SHOW_REPLICA_STATUS=(['Seconds_Behind_Source'], (None,)))
+        self.assertIsNone(lag)
+        self.assertEqual(warnings, [
+            mock.call('db.replica.lag.unknown', alias='replica', reason='replication is not running')
+        ])
+
+    def test_an_unreachable_replica_is_unknown_lag(self):
+        lag, warnings = self.query_lag(
+            SHOW_REPLICA_STATUS=Exception('Lost connection'),
+            SHOW_SLAVE_STATUS=Exception('Lost connection'),
+        )
+        self.assertIsNone(lag)
+        self.assertEqual(warnings, [mock.call('db.replica.lag.unknown', alias='replica', reason='Lost connection')])
+
+
+class FakeMySQLdbConnection(FakeConnection):
+    """
+    Stands in for a MySQLdb connection, for the DatabaseWrappers in seedling.db.backends.
+    """
+
+    def __init__(self, number):
+        super().__init__(number)
+        self.autocommit_mode = False
+        self.autocommit_calls = []
+        self.rollbacks = 0
+        self.rollback_error = None
+
+    def ping(self):
+        self.pings += 1
+        if self.broken:
+            raise MySQLdb.OperationalError(2006, 'MySQL server has gone away')
+
+    def get_autocommit(self):
+        return self.autocommit_mode
+
+    def autocommit(self, mode):
+        self.autocommit_calls.append(mode)
+        self.autocommit_mode = mode
+
+    def rollback(self):
+        if self.rollback_error is not None:
+            raise self.rollback_error
+        self.rollbacks += 1
+
+    def cursor(self):
+        return mock.Mock()
+
+
+@skipUnless(MySQLdb, 'mysqlclient is not installed')
+class MySQLBackendTestCase(SimpleTestCase):
+    """
+    Runs seedling.db.backends' DatabaseWrappers against FakeMySQLdbConnections instead of a MySQL server.
+    """
+
+    alias = 'fake'
+
+    def setUp(self):
+        self.connections = []
+        for target, kwargs in [
+            ('get_new_connection', {'side_effect': self.connect}),
+            # This queries the server for its settings.
+            ('init_connection_state', {}),
+        ]:
+            patcher = mock.patch.object(mysql_base.base.DatabaseWrapper, target, **kwargs)
+            setattr(self, target, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    # noinspection PyUnusedLocal
+    def connect(self, conn_params):
+        connection = FakeMySQLdbConnection(len(self.connections))
+        self.connections.append(connection)
+        return connection
+
+    def make_wrapper(self, wrapper_class, **settings_dict):
+        settings_dict = dict({
+            'ENGINE': wrapper_class.__module__.rsplit('.', 1)[0],
+            'NAME': 'seedling',
+            'USER': '',
+            'PASSWORD': '',
+            'HOST': '',
+            'PORT': '',
+            'OPTIONS': {},
+            'TIME_ZONE': None,
+            'AUTOCOMMIT': True,
+            'ATOMIC_REQUESTS': False,
+            'CONN_MAX_AGE': None,
+            'CONN_HEALTH_CHECKS': True,
+            'TEST': {},
+        }, **settings_dict)
+        wrapper = wrapper_class(settings_dict, self.alias)
+        self.addCleanup(self.close, wrapper)
+        return wrapper
+
+    @staticmethod
+    def close(wrapper):
+        wrapper.in_atomic_block = False
+        wrapper.close()
+
+    @staticmethod
+    def new_request(wrapper):
+        # What django.db.close_old_connections() does at the start and end of every request.
+        wrapper.close_if_unusable_or_obsolete()
+
+
+class MySQLHealthCheckTests(MySQLBackendTestCase):
+
+    def test_new_connections_are_not_pinged(self):
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper)
+        wrapper.cursor()
+        self.assertEqual(self.connections[0].pings, 0)
+        # connect() turned autocommit on, since the connection didn't already have it.
+        self.assertEqual(self.connections[0].autocommit_calls, [True])
+
+    def test_reused_connections_are_pinged_once_per_request(self):
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper)
+        wrapper.cursor()
+        for request in range(1, 3):
+            self.new_request(wrapper)
+            wrapper.cursor()
+            wrapper.cursor()
+            self.assertEqual(self.connections[0].pings, request)
+        self.assertEqual(len(self.connections), 1)
+
+    def test_a_connection_which_fails_its_health_check_is_replaced(self):
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper)
+        wrapper.cursor()
+        self.new_request(wrapper)
+        self.connections[0].broken = True
+        wrapper.cursor()
+        self.assertTrue(self.connections[0].closed)
+        self.assertIs(wrapper.connection, self.connections[1])
+
+    def test_set_autocommit_checks_the_connection(self):
+        # With ATOMIC_REQUESTS, the transaction's set_autocommit(False) is a request's first use of the connection.
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper)
+        wrapper.ensure_connection()
+        self.new_request(wrapper)
+        self.connections[0].broken = True
+        wrapper.set_autocommit(False)
+        self.assertIs(wrapper.connection, self.connections[1])
+        self.assertFalse(self.connections[1].autocommit_mode)
+
+    def test_no_health_check_inside_a_transaction(self):
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper)
+        wrapper.ensure_connection()
+        self.new_request(wrapper)
+        wrapper.in_atomic_block = True
+        wrapper.cursor()
+        self.assertEqual(self.connections[0].pings, 0)
+
+    def test_health_checks_can_be_turned_off(self):
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper, CONN_HEALTH_CHECKS=False)
+        wrapper.cursor()
+        self.new_request(wrapper)
+        self.connections[0].broken = True
+        wrapper.cursor()
+        self.assertEqual(self.connections[0].pings, 0)
+        self.assertIs(wrapper.connection, self.connections[0])
+
+    def test_set_autocommit_skips_setting_the_current_mode(self):
+        wrapper = self.make_wrapper(mysql_base.DatabaseWrapper)
+        wrapper.ensure_connection()
+        connection = self.connections[0]
+        wrapper.set_autocommit(True)
+        self.assertEqual(connection.autocommit_calls, [True])
+        wrapper.set_autocommit(False)
+        self.assertEqual(connection.autocommit_calls, [True, False])
+
+
+class MySQLPoolBackendTests(MySQLBackendTestCase):
+
+    alias = 'fake_pool'
+
+    def setUp(self):
+        super().setUp()
+        self.addCleanup(mysql_pool_base._pools.pop, self.alias, None)
+
+    def make_wrapper(self, wrapper_class=None, **settings_dict):
+        settings_dict.setdefault('CONN_MAX_AGE', 0)
+        settings_dict.setdefault('POOL', {'SIZE': 1, 'MAX_OVERFLOW': 1})
+        return super().make_wrapper(wrapper_class or mysql_pool_base.DatabaseWrapper, **settings_dict)
+
+    def pool(self):
+        return mysql_pool_base.find_pool(self.alias)
+
+    def test_close_returns_the_connection_to_the_pool(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        connection = wrapper.connection
+        wrapper.close()
+        self.assertFalse(connection.closed)
+        self.assertEqual(self.pool().stats()['idle'], 1)
+        wrapper.ensure_connection()
+        self.assertIs(wrapper.connection, connection)
+        # The session setup only runs on a connection's first checkout.
+        self.assertEqual(self.init_connection_state.call_count, 1)
+
+    def test_wrappers_share_the_pool(self):
+        first, second = self.make_wrapper(), self.make_wrapper()
+        first.ensure_connection()
+        second.ensure_connection()
+        self.assertIsNot(first.connection, second.connection)
+        first.close()
+        second.close()
+        # The pool keeps SIZE idle connections, and closes the overflow one.
+        self.assertEqual([connection.closed for connection in self.connections], [False, True])
+
+    def test_connections_with_errors_are_discarded(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        wrapper.errors_occurred = True
+        wrapper.close()
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(self.pool().stats()['idle'], 0)
+
+    def test_open_transactions_are_rolled_back_before_checkin(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        wrapper.set_autocommit(False)
+        connection = wrapper.connection
+        wrapper.close()
+        self.assertEqual(connection.rollbacks, 1)
+        self.assertTrue(connection.autocommit_mode)
+        self.assertFalse(connection.closed)
+        self.assertEqual(self.pool().stats()['idle'], 1)
+
+    def test_connections_which_fail_to_roll_back_are_discarded(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        wrapper.set_autocommit(False)
+        wrapper.connection.rollback_error = MySQLdb.OperationalError(2013, 'Lost connection to MySQL server')
+        wrapper.close()
+        self.assertTrue(self.connections[0].closed)
+        self.assertEqual(self.pool().stats()['idle'], 0)
+
+    def test_connections_which_fail_their_health_check_are_discarded(self):
+        # Keep the connection between requests, rather than returning it to the pool, so that it gets a health check.
+        wrapper = self.make_wrapper(CONN_MAX_AGE=None)
+        wrapper.ensure_connection()
+        self.new_request(wrapper)
+        self.connections[0].broken = True
+        wrapper.cursor()
+        self.assertTrue(self.connections[0].closed)
+        self.assertIs(wrapper.connection, self.connections[1])
+        self.assertEqual(self.pool().stats()['discarded'], 1)
+
+    def test_closing_without_a_pool_closes_the_connection(self):
+        wrapper = self.make_wrapper()
+        wrapper.ensure_connection()
+        pool = self.pool()
+        # As if we'd been forked since the connection was checked out.
+        with mock.patch.object(mysql_pool_base, '_pools_pid', -1):
+            wrapper.close()
+            self.assertIsNone(self.pool())
+        self.assertTrue(self.connections[0].closed)
+        self.assertIs(self.pool(), pool)
+        self.assertEqual(pool.stats()['idle'], 0)
@@ -1,16 +1,103 @@
+import os
+import random
+
 import environ
 
 env = environ.Env()
 
+
+def _read_cgroup_file(*paths):
+    """
+    Return the stripped contents of the first of the given cgroup files that exists, or ``None``.
+    """
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def _available_cpus():
+    """
+    Return how many CPUs this container may actually use: the smaller of our CPU affinity and our cgroup CPU quota.
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = None
+    # cgroup v2 puts "<quota> <period>" in cpu.max; cgroup v1 splits them into two files. A quota of "max" or -1 means
+    # there's no limit.
+    cpu_max = _read_cgroup_file('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        limit, _, period = cpu_max.partition(' ')
+        if limit != 'max' and period:
+            quota = int(limit) / int(period)
+    else:
+        limit = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+        period = _read_cgroup_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+        if limit and period and int(limit) > 0:
+            quota = int(limit) / int(period)
+    if quota is not None:
+        cpus = min(cpus, max(1, int(quota + 0.5)))
+    return cpus
+
+
+def _memory_limit_mb():
+    """
+    Return this container's cgroup memory limit in MB, or ``None`` if it doesn't have one.
+    """
+    limit = _read_cgroup_file('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+    if not limit or limit == 'max':
+        return None
+    limit = int(limit) // (1024 * 1024)
+    # cgroup v1 reports "no limit" as a huge number, rather than "max".
+    return limit if limit < 1024 * 1024 * 1024 else None
+
+
 ##### General #####
 bind = 'unix:/tmp/app.sock'
-workers = 8
-worker_class = 'sync'
 daemon = False
-timeout = 300
+timeout = env.int('GUNICORN_TIMEOUT', default=300)
+graceful_timeout = env.int('GUNICORN_GRACEFUL_TIMEOUT', default=30)
 worker_tmp_dir = '/tmp'
-# requires futures module for threads > 1
-threads = 1
+
+##### Workers #####
+# GUNICORN_WORKER_CLASS may be 'sync' (one request at a time per worker) or 'gthread' (GUNICORN_THREADS requests at a
+# time per worker, which suits our I/O-bound views better, at a much lower memory cost than more workers).
+# GUNICORN_WORKERS defaults to the usual 2 * CPUs + 1, capped so that GUNICORN_WORKER_MEMORY_MB per worker fits into
+# the container's memory limit.
+worker_class = env('GUNICORN_WORKER_CLASS', default='sync')
+cpus = _available_cpus()
+workers = 2 * cpus + 1
+memory_limit_mb = _memory_limit_mb()
+if memory_limit_mb is not None:
+    workers = min(workers, max(1, memory_limit_mb // env.int('GUNICORN_WORKER_MEMORY_MB', default=200)))
+workers = env.int('GUNICORN_WORKERS', default=workers)
+threads = env.int('GUNICORN_THREADS', default=4 if worker_class == 'gthread' else 1)
+
+# Restart each worker after it has served roughly this many requests, so that slow memory growth can't add up. The
+# jitter keeps the workers from all restarting at the same moment. Set GUNICORN_MAX_REQUESTS=0 to disable.
+max_requests = env.int('GUNICORN_MAX_REQUESTS', default=1000)
+max_requests_jitter = env.int('GUNICORN_MAX_REQUESTS_JITTER', default=max_requests // 10)
+
+# Load the app once in the master, so workers start faster and share its memory pages. The pre_fork and post_fork
+# hooks below keep the master's database and cache connections from being shared with the workers.
+preload_app = env.bool('GUNICORN_PRELOAD', default=False)
+
+##### ASGI #####
+# Set GUNICORN_ASGI=True to serve seedling.asgi with uvicorn's worker class, so that each worker can have many requests
+# in flight at once, instead of being tied up by one that's waiting on a slow upstream service. Sync views still work;
+# seedling.asgi runs each request's sync code in a thread of its own, and closes its database connections when the
+# request ends, so consider DB_POOL=True to keep from reconnecting for every request.
+asgi = env.bool('GUNICORN_ASGI', default=False)
+if asgi:
+    worker_class = 'uvicorn.workers.UvicornWorker'
+    wsgi_app = 'seedling.asgi:application'
+else:
+    wsgi_app = 'seedling.wsgi:application'
 
 ##### Devel #####
 reload = env.bool('GUNICORN_RELOAD', default=False)
@@ -70,3 +157,43 @@ _host = env('STATSD_HOST', default=None)
 _port = env.int('STATSD_PORT', default=8125)
 statsd_host = f'{_host}:{_port}' if (_host and _port) else None
 statsd_prefix = env('STATSD_PREFIX', default=None)
+
+
+##### Hooks #####
+# Set LOGGING_QUEUE=True to route gunicorn's own log output through a per-worker queue and listener thread, just like
+# seedling/settings.py does for Django's. See seedling.logging.QueuedLogging.
+logging_queue = env.bool('LOGGING_QUEUE', default=False)
+
+
+def pre_fork(server, worker):
+    """
+    With preload_app, close any database and cache connections that loading the app opened in the master, since a
+    socket shared between processes corrupts whatever is sent over it.
+    """
+    if preload_app:
+        from django.core.cache import close_caches
+        from django.db import connections
+        connections.close_all()
+        close_caches()
+
+
+def post_fork(server, worker):
+    """
+    Make this worker's random numbers (used for log and profile sampling) differ from its siblings', start its logging
+    listener thread, and route gunicorn's loggers through it.
+    """
+    random.seed()
+    if logging_queue:
+        from seedling.logging import queued_logging
+        queued_logging.install(['gunicorn.error', 'gunicorn.access'])
+
+
+def worker_exit(server, worker):
+    """
+    Write out any model audit log events and log records that are still queued before this worker goes away.
+    """
+    from seedling.audit import audit_logger
+    audit_logger.stop()
+    if logging_queue:
+        from seedling.logging import queued_logging
+        queued_logging.stop()
@@ -1,13 +1,35 @@
+import contextvars
+import copy
+import datetime
+import decimal
+import json
 import logging
+import logging.handlers
 import os
+import queue
+import random
 import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
 from io import StringIO
+from operator import attrgetter
 
-from django.db.models import ManyToManyField, QuerySet
+from django.db.models import Field, ManyToManyField, QuerySet
+from django.db.models.signals import class_prepared
+from django.utils.functional import LazyObject, empty
+from django.core.signals import setting_changed
 import environ
 import structlog
 from structlog.dev import (_ColorfulStyles, _PlainStyles)
 
+try:
+    import orjson
+except ImportError:
+    # orjson is optional; JSONLinesRenderer falls back to the standard library's json module without it.
+    orjson = None
+
 
 logger = structlog.get_logger('seedling')
 
@@ -120,35 +142,291 @@ class ConsoleRenderer(object):
         return msg
 
 
-def model_to_dict(instance, exclude_passwords=False):
+class PrecompiledConsoleRenderer(ConsoleRenderer):
     """
-    Convert the given model instance to a dictionary keyed by field name.
-    Pass in exclude_passwords = True to skip any field named "password". This is primarily useful to prevent
-    hashed passwords from being logged when a User object is created or changed.
+    A drop-in replacement for ``ConsoleRenderer`` which produces exactly the same output, but does less work per
+    event: the styled fragments for levels and keys are built once and cached, the line is assembled with a single
+    ``str.join()``, and newlines are collapsed with ``str.replace()`` instead of ``re.sub()``.
+
+    ``ConsoleRenderer`` is kept as the reference implementation; ``manage.py benchmark_renderers`` compares the two.
     """
-    data = {}
-    for f in instance._meta.get_fields():
-        if isinstance(f, ManyToManyField) or (f.name == 'password' and exclude_passwords):
-            continue
 
-        if hasattr(f, 'value_from_object'):
+    #: The maximum number of styled key fragments we cache. Event keys are normally a small, fixed vocabulary, so this
+    #: is only here to keep a misbehaving caller from growing the cache without bound.
+    max_cached_keys = 1024
+
+    def __init__(self, colors=False, repr_native_str=False, newlines=True):
+        super().__init__(colors=colors, repr_native_str=repr_native_str, newlines=newlines)
+        styles = self._styles
+        self._reset = styles.reset
+        self._bright = styles.bright
+        self._timestamp = styles.timestamp
+        self._level_fragments = {
+            level: '[{}{}{}] '.format(color, level.upper(), styles.reset)
+            for level, color in self._level_to_color.items()
+        }
+        self._key_fragments = {}
+
+    def _key_fragment(self, key):
+        """
+        Return the styled "key=" fragment for the given key, which is followed by the styled value.
+        """
+        fragment = self._key_fragments.get(key)
+        if fragment is None:
+            styles = self._styles
+            fragment = '{}{}{}={}'.format(styles.kv_key, key, styles.reset, styles.kv_value)
+            if len(self._key_fragments) < self.max_cached_keys:
+                self._key_fragments[key] = fragment
+        return fragment
+
+    def __call__(self, _, __, event_dict):
+        reset = self._reset
+        bright = self._bright
+        parts = []
+        append = parts.append
+
+        ts = event_dict.pop('timestamp', None)
+        if ts:
+            append(f'{self._timestamp}{ts} {reset}')
+
+        level = event_dict.pop('level', None)
+        if level:
+            append(self._level_fragments[level])
+
+        logger_name = event_dict.pop('logger', None)
+        if logger_name:
+            append(f'{bright}{logger_name}{reset}: ')
+
+        append(f'{bright}{event_dict.pop("event")}{reset}')
+        # Just like ConsoleRenderer, this checks for leftover data before the stack and exception are removed.
+        if event_dict:
+            append(' ')
+
+        stack = event_dict.pop('stack', None)
+        exc = event_dict.pop('exception', None)
+        if stack is not None:
+            append('\n' + stack)
+            if exc is not None:
+                append('\n\n' + '=' * 79 + '\n')
+        if exc is not None:
+            append('\n' + exc)
+
+        if event_dict:
+            key_fragment = self._key_fragment
+            append(' '.join([f'{key_fragment(key)}{event_dict[key]}{reset}' for key in sorted(event_dict)]))
+
+        msg = ''.join(parts)
+        if not self.newlines:
+            msg = msg.replace('\n', '|||')
+        return msg
+
+
+def _json_default(obj):
+    """
+    Convert objects that the JSON serializers can't handle natively into something they can. Anything we don't
+    specifically know about is logged as its repr(), just like the key=value output does.
+    """
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, (decimal.Decimal, uuid.UUID)):
+        return str(obj)
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    return log_compat(obj)
+
+
+class JSONLinesRenderer(object):
+    """
+    Render ``event_dict`` as a single-line JSON object, so that our log shipper can index the fields directly instead of
+    having to regex-parse them back out of the key=value output of ``ConsoleRenderer``.
+
+    Keys are emitted in a stable order: ``timestamp``, ``level``, ``logger`` and ``event`` first (when present), then
+    the rest sorted by name. Values that can't be serialized as JSON are logged as their ``repr()``.
+
+    Like ``DockerFormatter``, this never emits a raw newline inside a log message: JSON escapes newlines in strings, so
+    every event, tracebacks included, is exactly one line.
+
+    We use orjson_ when it's installed, and the standard library's json module otherwise.
+
+    .. _orjson: https://github.com/ijl/orjson
+    """
+
+    leading_keys = ('timestamp', 'level', 'logger', 'event')
+
+    def _ordered(self, event_dict):
+        ordered = {}
+        for key in self.leading_keys:
+            if key in event_dict:
+                ordered[key] = event_dict.pop(key)
+        for key in sorted(event_dict, key=str):
+            ordered[key] = event_dict[key]
+        return ordered
+
+    def _dumps_json(self, data):
+        return json.dumps(data, default=_json_default, ensure_ascii=False, separators=(',', ':'))
+
+    def __call__(self, _, __, event_dict):
+        data = self._ordered(event_dict)
+        if orjson is not None:
             try:
-                data[f.name] = f.value_from_object(instance)
-            except:  # noqa
-                # If anything goes wrong at this step, just ignore this field.
+                return orjson.dumps(data, default=_json_default, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+            except TypeError:
+                # orjson refuses some things that json handles (e.g. integers wider than 64 bits).
                 pass
+        return self._dumps_json(data)
+
+
+# The compiled extraction plans for model_to_dict(), keyed by (model class, exclude_passwords).
+_extraction_plans = {}
+# A marker returned by extraction plan accessors for fields which should be left out of the dict.
+_SKIP = object()
+# The ways model_to_dict() can represent related objects. See the AUDIT_LOG_RELATIONS setting.
+RELATION_POLICIES = ('skip', 'pk', 'count', 'first')
+
+
+def _get_relation_policy():
+    """
+    Return the (policy, limit) pair that model_to_dict() uses for related objects, from the AUDIT_LOG_RELATIONS and
+    AUDIT_LOG_RELATIONS_LIMIT settings.
+    """
+    # This is imported here because settings.py imports this module.
+    from django.conf import settings
+    policy = getattr(settings, 'AUDIT_LOG_RELATIONS', 'pk')
+    if policy not in RELATION_POLICIES:
+        raise ValueError(f'AUDIT_LOG_RELATIONS must be one of {RELATION_POLICIES}, not {policy!r}')
+    return policy, getattr(settings, 'AUDIT_LOG_RELATIONS_LIMIT', 10)
+
+
+def _summarize_queryset(qs, policy, limit):
+    """
+    Represent the objects in the given QuerySet according to our relation policy, with no more than ``limit`` of them.
+    This never queries: QuerySets that haven't already been evaluated (e.g. via prefetch_related()) are skipped.
+    """
+    cached = qs._result_cache
+    if cached is None:
+        return _SKIP
+    if policy == 'count':
+        return len(cached)
+    if policy == 'pk':
+        return [obj.pk for obj in cached[:limit]]
+    return list(cached[:limit])
+
+
+def _custom_value_getter(field, policy, limit):
+    """
+    Return an accessor for a concrete field which overrides ``value_from_object()``, and thus might do anything.
+    """
+    def getter(instance):
+        try:
+            value = field.value_from_object(instance)
+        except:  # noqa
+            # If anything goes wrong at this step, just ignore this field.
+            return _SKIP
+        if isinstance(value, QuerySet):
+            # Convert QuerySets to something printable and comparable (for logging).
+            if policy == 'skip':
+                return _SKIP
+            value = _summarize_queryset(value, policy, limit)
+        return value
+    return getter
+
+
+def _related_value_getter(field, policy, limit):
+    """
+    Return an accessor for a field with no column of its own, e.g. a reverse relation or a GenericForeignKey.
+    """
+    # Reverse relations are reached through their accessor name (e.g. "book_set"), not their field name ("book").
+    name = field.get_accessor_name() if hasattr(field, 'get_accessor_name') else field.name
+    multiple = getattr(field, 'multiple', False) or getattr(field, 'one_to_many', False)
+
+    def getter(instance):
+        if not multiple and hasattr(field, 'is_cached') and not field.is_cached(instance):
+            # Reverse one-to-ones and GenericForeignKeys that select_related() or an earlier access didn't load.
+            return _SKIP
+        try:
+            field_data = getattr(instance, name, None)
+            if multiple and field_data is not None:
+                # This field is a manager. all() returns the prefetched objects if there are any, and otherwise an
+                # unevaluated QuerySet, which _summarize_queryset() skips.
+                return _summarize_queryset(field_data.all(), policy, limit)
+        except (AttributeError, ValueError):
+            # Managers for unsaved instances can raise ValueError.
+            return None
+        # Single related objects (reverse one-to-ones, GenericForeignKeys) cost at most one row.
+        if policy == 'count':
+            return int(field_data is not None)
+        if policy == 'pk' and field_data is not None:
+            return field_data.pk
+        return field_data
+    return getter
+
+
+def get_extraction_plan(model, exclude_passwords=False, fields=None, exclude=None, related=True):
+    """
+    Return the extraction plan that model_to_dict() uses for the given model class: a tuple of (field name, accessor)
+    pairs, with the fields that model_to_dict() skips already left out.
+
+    Plans are built once per model class (and set of options) and cached until the app registry or the relation
+    policy settings change.
+    """
+    key = (model, exclude_passwords, fields, exclude, related)
+    plan = _extraction_plans.get(key)
+    if plan is None:
+        policy, limit = _get_relation_policy()
+        entries = []
+        for f in model._meta.get_fields():
+            if isinstance(f, ManyToManyField) or (f.name == 'password' and exclude_passwords):
+                continue
+            if (fields is not None and f.name not in fields) or (exclude is not None and f.name in exclude):
+                continue
+            if getattr(f, 'concrete', False) and type(f).value_from_object is Field.value_from_object:
+                # This is what Field.value_from_object() does, minus the method call.
+                getter = attrgetter(f.attname)
+            elif getattr(f, 'concrete', False):
+                getter = _custom_value_getter(f, policy, limit)
+            elif policy == 'skip' or not related:
+                continue
             else:
-                if isinstance(data[f.name], QuerySet):
-                    # Convert QuerySets to concrete lists, so they're printable and comparable (for logging).
-                    data[f.name] = list(data[f.name].all())
-        else:
-            field_data = getattr(instance, f.name, None)
-            try:
-                # If this field is a manager, grab all the managed objects.
-                field_data = list(field_data.all())
-            except AttributeError:
-                pass
-            data[f.name] = field_data
+                getter = _related_value_getter(f, policy, limit)
+            entries.append((f.name, getter))
+        plan = tuple(entries)
+        _extraction_plans[key] = plan
+    return plan
+
+
+def clear_extraction_plans(**kwargs):
+    """
+    Throw away all the cached extraction plans. This is connected to ``class_prepared``, so the plans are rebuilt
+    whenever a model class is (re)defined, e.g. while migrations are running.
+    """
+    _extraction_plans.clear()
+
+
+def _relation_policy_changed(setting, **kwargs):
+    if setting in ('AUDIT_LOG_RELATIONS', 'AUDIT_LOG_RELATIONS_LIMIT'):
+        clear_extraction_plans()
+
+
+class_prepared.connect(clear_extraction_plans, dispatch_uid='seedling.logging.clear_extraction_plans')
+setting_changed.connect(_relation_policy_changed, dispatch_uid='seedling.logging.relation_policy_changed')
+
+
+def model_to_dict(instance, exclude_passwords=False, fields=None, exclude=None, related=True):
+    """
+    Convert the given model instance to a dictionary keyed by field name.
+    Pass in exclude_passwords = True to skip any field named "password". This is primarily useful to prevent
+    hashed passwords from being logged when a User object is created or changed.
+    Pass in ``fields`` and/or ``exclude`` (frozensets of field names) to include only, or to skip, those fields.
+
+    Related objects (reverse relations and the like) are only included if they're already loaded on the instance,
+    e.g. by prefetch_related() or select_related(), so this never queries. Pass ``related=False`` to leave them out
+    entirely.
+    """
+    data = {}
+    for name, getter in get_extraction_plan(instance.__class__, exclude_passwords, fields, exclude, related):
+        value = getter(instance)
+        if value is not _SKIP:
+            data[name] = value
     return data
 
 
@@ -168,7 +446,16 @@ def log_model_changes(logger, original, new):
     """
     original_dict = model_to_dict(original, exclude_passwords=True)
     new_dict = model_to_dict(new, exclude_passwords=True)
+    log_model_dict_changes(logger, new, original_dict, new_dict)
+
+
+def log_model_dict_changes(logger, instance, original_dict, new_dict):
+    """
+    Logs the changes between two dicts of field values for the given model instance to the specified logger.
 
+    This is the workhorse for ``log_model_changes()``, split out so that callers which already have the original
+    values (e.g. from a ``seedling.core.snapshots`` snapshot) don't need to load an original instance to diff against.
+    """
     changes = {}
     for field_name, original_value in original_dict.items():
         new_value = new_dict.get(field_name)
@@ -180,7 +467,7 @@ def log_model_changes(logger, original, new):
             # there's not much we can do about it, so we just skip that field.
             pass
     if changes:
-        if original._meta.label.endswith(('.User')):
+        if instance._meta.label.endswith(('.User')):
             if 'last_login' in changes and len(changes) == 1:
                 # Don't log changes that are only to the "last_login" field on a User model.
                 # That field gets changed every time the user logs in, and we already log logins.
@@ -192,42 +479,105 @@ def log_model_changes(logger, original, new):
         # happen when renaming a model in a migration.
         if 'model' in changes:
             changes['other_model'] = changes.pop('model')
-        logger.info('model.update', model=original._meta.label, pk=original.pk, **changes)
+        logger.info('model.update', model=instance._meta.label, pk=instance.pk, **changes)
+
+
+M2M_POLICIES = ('pk', 'repr')
 
 
 def log_model_m2m_changes(logger, instance, action, model, pk_set):
     """
     Logs the changes made to an object's many-to-many fields to the specified logger.
+
+    How the added or removed objects are logged depends on the AUDIT_LOG_M2M setting:
+
+      ``pk``: log their pks, which costs no queries at all.
+      ``repr``: log the objects themselves, which costs one query.
+
+    Either way, sets of more than AUDIT_LOG_BULK_PK_LIMIT objects are logged as just their lowest and highest pks, as
+    ``first_pk`` and ``last_pk``, without a query. ``count`` is always logged.
     """
     # The post_add and post_remove signals get sent even if no changes are actually made by their respective actions
     # (e.g. when add()'ing an object that's already in the m2m relationship).
     # Since there are no changes, there's nothing to log.
     if not pk_set:
         return
-
     if action == "post_remove":
-        removed_objects = model.objects.filter(pk__in=pk_set)
-        logger.info(
-            'model.m2m.delete',
-            model=instance._meta.label,
-            objects=", ".join(log_compat(obj) for obj in removed_objects),
-            instance=log_compat(instance)
-        )
+        event = 'model.m2m.delete'
     elif action == "post_add":
-        added_objects = model.objects.filter(pk__in=pk_set)
-        logger.info(
-            'model.m2m.add',
-            model=instance._meta.label,
-            objects=", ".join(log_compat(obj) for obj in added_objects),
-            instance=log_compat(instance)
-        )
+        event = 'model.m2m.add'
+    else:
+        return
+
+    # This is imported here because settings.py imports this module.
+    from django.conf import settings
+    policy = getattr(settings, 'AUDIT_LOG_M2M', 'pk')
+    if policy not in M2M_POLICIES:
+        raise ValueError(f'AUDIT_LOG_M2M must be one of {M2M_POLICIES}, not {policy!r}')
+    limit = getattr(settings, 'AUDIT_LOG_BULK_PK_LIMIT', 100)
+    pks = sorted(pk_set)
+    if len(pks) > limit:
+        # These are separate fields, rather than a range, since the pks in between usually aren't all in the set.
+        objects = {'first_pk': pks[0], 'last_pk': pks[-1]}
+    elif policy == 'repr':
+        objects = {
+            'objects': ", ".join(log_compat(obj) for obj in model._base_manager.filter(pk__in=pks).order_by('pk'))
+        }
+    else:
+        objects = {'objects': pks}
+    logger.info(
+        event,
+        model=instance._meta.label,
+        pk=instance.pk,
+        related_model=model._meta.label,
+        count=len(pks),
+        instance=log_compat(instance),
+        **objects
+    )
+
+
+def summarize_pks(pks, limit):
+    """
+    Return the log fields for the given primary keys: ``pks``, a list of them, if there are no more than ``limit``,
+    and otherwise just the lowest and highest of them, as ``first_pk`` and ``last_pk``, so that bulk audit events stay
+    a reasonable size. ``pks`` is ``None`` if none of the pks are known, e.g. after a bulk_create() on a database that
+    can't return them.
+    """
+    pks = [pk for pk in pks if pk is not None]
+    if not pks:
+        return {'pks': None}
+    if len(pks) <= limit:
+        return {'pks': pks}
+    # These are separate fields, rather than a range, since the pks in between usually aren't all in the set.
+    return {'first_pk': min(pks), 'last_pk': max(pks)}
 
 
-def log_new_model(logger, instance):
+def log_bulk_operation(logger, model, operation, count, pk_summary=None, fields=None, **kwargs):
+    """
+    Logs one aggregate event for a bulk operation (bulk_create, bulk_update, update or delete) on the given model to
+    the specified logger.
+
+    ``pk_summary`` is the dict of fields that summarize_pks() returns, and ``fields`` is the list of names of the
+    columns that were written, if any. Their values are deliberately not logged.
+    """
+    if fields is not None:
+        kwargs['fields'] = sorted(fields)
+    kwargs.update(pk_summary or {'pks': None})
+    logger.info(
+        'model.bulk_{}'.format(operation),
+        model=model._meta.label,
+        count=count,
+        **kwargs
+    )
+
+
+def log_new_model(logger, instance, fields=None, exclude=None):
     """
     Logs the field values set on a newly-saved model instance to the specified logger.
+    ``fields`` and ``exclude`` are passed on to model_to_dict().
     """
-    kwargs = model_to_dict(instance, exclude_passwords=True)
+    # A new instance can't have any related objects yet, so don't even look for them.
+    kwargs = model_to_dict(instance, exclude_passwords=True, fields=fields, exclude=exclude, related=False)
     if 'model' not in kwargs:
         kwargs['model'] = instance._meta.label
     if 'event' in kwargs:
@@ -239,11 +589,12 @@ def log_new_model(logger, instance):
     logger.info('model.create', instance=log_compat(instance), **kwargs)
 
 
-def log_model_deletion(logger, instance):
+def log_model_deletion(logger, instance, fields=None, exclude=None):
     """
     Logs the deletion of this model instance to the specified logger.
+    ``fields`` and ``exclude`` are passed on to model_to_dict().
     """
-    kwargs = model_to_dict(instance, exclude_passwords=True)
+    kwargs = model_to_dict(instance, exclude_passwords=True, fields=fields, exclude=exclude)
     if 'event' in kwargs:
         # The first argument to logger.info() here is technically a kwarg called
         # 'event', so if kwargs also has a key in it called 'event', our
@@ -357,6 +708,241 @@ class DockerFormatter(logging.Formatter):
         return re.sub("\n", "|||", s)
 
 
+class _RoutingQueueHandler(logging.handlers.QueueHandler):
+    """
+    A ``QueueHandler`` that stands in for one of our real handlers. It puts ``(real handler, record)`` pairs on the
+    shared queue of a ``QueuedLogging``, so that one listener thread can write records from many loggers, each to the
+    handler it was originally meant for.
+
+    Unlike the stock ``QueueHandler``, this doesn't format the record before queueing it. Our structlog records carry
+    their event dict in ``record.msg``, and ``ProcessorFormatter`` needs it intact.
+    """
+
+    def __init__(self, topology, target):
+        super().__init__(None)
+        self.topology = topology
+        self.target = target
+        # Reject records the real handler would ignore before they ever get queued.
+        self.setLevel(target.level)
+
+    def prepare(self, record):
+        return copy.copy(record)
+
+    def enqueue(self, record):
+        self.topology.put(self.target, record)
+
+
+class _RoutingQueueListener(logging.handlers.QueueListener):
+    """
+    The listener for ``_RoutingQueueHandler``: writes each record to the real handler it was queued for.
+    """
+
+    def handle(self, item):
+        target, record = item
+        target.handle(record)
+
+    def enqueue_sentinel(self):
+        # The stock version uses put_nowait(), which fails if the queue is full.
+        self.queue.put(self._sentinel)
+
+
+class QueuedLogging(object):
+    """
+    An opt-in logging topology that takes writing log output out of the request thread.
+
+    ``install()`` replaces every handler on the given loggers with a ``_RoutingQueueHandler``, which puts the records
+    on a bounded queue. One listener thread per process takes them off the queue, and formats and writes them using
+    the original handlers. A request therefore never blocks on a ``write()`` to a backed-up stdout/stderr pipe.
+
+    If the queue is full, records are dropped and counted rather than blocking the caller. The count is reported when
+    the listener stops.
+
+    The listener is restarted automatically in child processes after a ``fork()``. gunicorn workers also start it in
+    ``post_fork``, and stop it in ``worker_exit``, which writes out everything still in the queue.
+    """
+
+    def __init__(self, max_size=10000):
+        self.max_size = max_size
+        self.dropped = 0
+        self.queue = None
+        self.listener = None
+        self._lock = threading.Lock()
+        self._fork_hook_registered = False
+        self._stopping = False
+
+    def install(self, logger_names, max_size=None):
+        """
+        Route the handlers of the named loggers through our queue. Use '' for the root logger.
+
+        :param max_size: (optional) the most records that may be waiting to be written before we start dropping them
+        :type max_size: int
+        """
+        if max_size is not None:
+            self.max_size = max_size
+        for name in logger_names:
+            logger = logging.getLogger(name or None)
+            for handler in list(logger.handlers):
+                if isinstance(handler, (_RoutingQueueHandler, logging.NullHandler)):
+                    continue
+                logger.removeHandler(handler)
+                logger.addHandler(_RoutingQueueHandler(self, handler))
+        self.start()
+
+    def put(self, target, record):
+        try:
+            if self._stopping:
+                # The listener is draining the queue, so waiting for room is bounded, and the records logged while
+                # stopping (like the dropped count) matter most.
+                self.queue.put((target, record), timeout=5)
+            else:
+                self.queue.put_nowait((target, record))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        """
+        Start the listener thread, if it isn't already running in this process.
+        """
+        with self._lock:
+            if self.listener is not None and self.listener._thread is not None:
+                return
+            self.queue = queue.Queue(maxsize=self.max_size)
+            self.listener = _RoutingQueueListener(self.queue)
+            self.listener.start()
+            if not self._fork_hook_registered:
+                os.register_at_fork(after_in_child=self._after_fork)
+                self._fork_hook_registered = True
+
+    def _after_fork(self):
+        # Threads don't survive a fork(), and the queue's lock may have been held when we forked.
+        self._lock = threading.Lock()
+        self._stopping = False
+        self.listener = None
+        self.start()
+
+    def stop(self):
+        """
+        Write out every queued record, and then stop the listener thread.
+        """
+        with self._lock:
+            if self.listener is None or self.listener._thread is None:
+                return
+            self._stopping = True
+            try:
+                if self.dropped:
+                    # This goes through the queue too, so it must be logged before the listener stops.
+                    logging.getLogger(__name__).warning('logging.queue.dropped count=%d', self.dropped)
+                    self.dropped = 0
+                self.listener.stop()
+            finally:
+                self._stopping = False
+
+
+queued_logging = QueuedLogging()
+
+
+class RequestLoggingContext(object):
+    """
+    The request context fields that ``request_context_logging_processor`` adds to log messages, for one request.
+
+    ``remote_ip`` is resolved when the context is bound. The user fields are snapshotted the first time something is
+    logged after the request's user has been loaded, and then reused for every later log line. Until then, they are
+    logged as placeholders (see ``_get_user_fields()``). ``login()`` and ``logout()`` throw the snapshot away, since
+    they replace ``request.user``.
+    """
+
+    __slots__ = ('request', 'fields')
+
+    def __init__(self, request):
+        self.request = request
+        self.fields = {'remote_ip': _get_client_ip(request)}
+
+    def resolve(self):
+        if 'username' not in self.fields:
+            user_fields = _get_user_fields(self.request)
+            if user_fields is UNRESOLVED_USER_FIELDS:
+                return dict(self.fields, **user_fields)
+            self.fields.update(user_fields)
+        return self.fields
+
+    def forget_user(self):
+        """
+        Drop the snapshot of the user fields, so that they're looked up again the next time something is logged.
+        """
+        self.fields.pop('username', None)
+        self.fields.pop('superuser', None)
+
+
+# The RequestLoggingContext of the current request. This is bound once per request by
+# seedling.middleware.RequestLoggingContextMiddleware.
+_request_logging_context = contextvars.ContextVar('request_logging_context', default=None)
+
+
+def bind_request_logging_context(request):
+    """
+    Bind the given request as the source of the request context fields in log messages, until
+    clear_request_logging_context() is called. Returns a token for clear_request_logging_context().
+    """
+    return _request_logging_context.set(RequestLoggingContext(request))
+
+
+def clear_request_logging_context(token=None):
+    """
+    Unbind the request bound by bind_request_logging_context().
+    """
+    if token is not None:
+        _request_logging_context.reset(token)
+    else:
+        _request_logging_context.set(None)
+
+
+# noinspection PyUnusedLocal
+def forget_request_logging_user(sender, request, **kwargs):
+    """
+    Drop the current request's snapshot of the user fields when ``login()`` or ``logout()`` changes its user. This is
+    connected to ``user_logged_in`` and ``user_logged_out`` in core.apps.CoreConfig.ready().
+    """
+    context = _request_logging_context.get()
+    if context is not None and context.request is request:
+        context.forget_user()
+
+
+def _get_client_ip(request):
+    try:
+        # django-xff will set this appropriately to the actual client IP when
+        # we are behind a proxy
+        return request.META['REMOTE_ADDR']
+    except (AttributeError, KeyError):
+        # Sometimes there will be a current request, but it's not a real request (during tests). If we can't get
+        # the real client ip, just use a placeholder.
+        return 'fake IP'
+
+
+# What we log for the user fields when the request's user hasn't been loaded yet.
+UNRESOLVED_USER_FIELDS = {'username': '__UNRESOLVED__', 'superuser': None}
+
+
+def _get_user_fields(request):
+    """
+    Return the user fields for our log messages, without ever loading the request's user ourselves.
+
+    ``AuthenticationMiddleware`` sets ``request.user`` to a lazy object, which costs a session lookup and a user SELECT
+    the first time it's touched. If nothing has touched it yet (or authentication hasn't run at all), we return
+    ``UNRESOLVED_USER_FIELDS`` rather than triggering that load just to log something.
+    """
+    user = request.__dict__.get('user')
+    if isinstance(user, LazyObject):
+        user = user._wrapped
+        if user is empty:
+            return UNRESOLVED_USER_FIELDS
+    if user is None:
+        return UNRESOLVED_USER_FIELDS
+    return {
+        'username': user.username or 'AnonymousUser',
+        'superuser': user.is_superuser,
+    }
+
+
 def request_context_logging_processor(_, __, event_dict):
     """
     Adds extra runtime event info to our log messages based on the current request.
@@ -366,26 +952,245 @@ def request_context_logging_processor(_, __, event_dict):
       ``remote_ip``: the REMOTE_ADDR address. django-xff will handle properly setting this if we're behind a proxy
       ``superuser``: True if the current User is a superuser
 
+    When ``RequestLoggingContextMiddleware`` has bound the request, these are looked up once per request and then
+    reused. Otherwise, we fall back to looking them up from the current request on every call.
+
+    This never loads the request's user itself, so logging can't add database round trips: until something else has
+    loaded the user, ``username`` and ``superuser`` are logged as placeholders.
+
     Does not overwrite any event info that's already been set in the logging call.
     """
+    for key, value in get_request_context_fields().items():
+        event_dict.setdefault(key, value)
+    return event_dict
+
+
+def get_request_context_fields():
+    """
+    Return a dict of the fields that ``request_context_logging_processor`` adds to log messages, for the current
+    request. It's empty when there's no current request.
+    """
+    context = _request_logging_context.get()
+    if context is not None:
+        return dict(context.resolve())
     # This is imported here to avoid a circular import which is triggered during the docker image build by the
     # imports in middleware.py
     from seedling.middleware import get_current_request
     request = get_current_request()
+    if request is None:
+        return {}
+    fields = {'remote_ip': _get_client_ip(request)}
+    fields.update(_get_user_fields(request))
+    return fields
 
-    if request is not None:
-        try:
-            # django-xff will set this appropriately to the actual client IP when
-            # we are behind a proxy
-            client_ip = request.META['REMOTE_ADDR']
-        except AttributeError:
-            # Sometimes there will be a current request, but it's not a real request (during tests). If we can't get
-            # the real client ip, just use a placeholder.
-            client_ip = 'fake IP'
-        event_dict.setdefault('remote_ip', client_ip)
-        event_dict.setdefault('username', request.user.username or 'AnonymousUser')
-        event_dict.setdefault('superuser', request.user.is_superuser)
-    return event_dict
+
+class _TokenBucket(object):
+    """
+    A token bucket which allows ``rate`` events per second on average, in bursts of up to ``burst`` events.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        # now can be a moment older than a brand new bucket's updated.
+        self.tokens = min(self.burst, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+# The log levels of the structlog logger methods, for LogSampler.
+_METHOD_LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'msg': logging.INFO,
+    'warn': logging.WARNING,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'err': logging.ERROR,
+    'exception': logging.ERROR,
+    'critical': logging.CRITICAL,
+    'fatal': logging.CRITICAL,
+}
+
+
+class LogSampler(object):
+    """
+    A structlog processor which thins out high-frequency events, so that a hot loop or a noisy library can't drown
+    our workers in logging overhead.
+
+    Events are matched by event name (e.g. ``model.update``) first, and then by logger name (e.g. ``django.db``).
+    Events at ERROR level and above are never dropped.
+
+    :param rates: a dict mapping names to the fraction of their events to keep, e.g. ``{'model.update': 0.1}``
+    :type rates: dict
+
+    :param limits: a dict mapping names to a ``(events per second, burst)`` pair, enforced with a token bucket
+    :type limits: dict
+
+    :param default_limit: (optional) a ``(events per second, burst)`` pair, enforced separately for each name that
+        isn't in ``rates`` or ``limits``
+    :type default_limit: tuple
+
+    :param max_names: how many names to keep ``default_limit`` buckets and suppressed counts for. When dynamic event
+        names push past this, the least recently seen name's bucket is forgotten, and suppressed events for new
+        names are counted under ``(other)``.
+    :type max_names: int
+
+    :param summary_interval: how often, in seconds, to log an ``log.suppressed`` WARNING with the number of events
+        dropped for each name since the last one
+    :type summary_interval: float
+
+    Use ``LogSamplingFilter`` to apply the same sampler to foreign (non-structlog) log records.
+    """
+
+    OTHER = '(other)'
+
+    def __init__(self, rates=None, limits=None, default_limit=None, summary_interval=60.0, max_names=1000):
+        self.rates = dict(rates or {})
+        self.limits = dict(limits or {})
+        self.default_limit = default_limit
+        self.summary_interval = summary_interval
+        self.max_names = max_names
+        self.enabled = bool(self.rates or self.limits or self.default_limit)
+        # The buckets for the names in self.limits, which can't outgrow it.
+        self._buckets = {}
+        # The buckets for every other name, least recently used first.
+        self._default_buckets = OrderedDict()
+        self._suppressed = {}
+        self._last_summary = time.monotonic()
+        self._lock = threading.Lock()
+
+    def allow(self, name, levelno):
+        """
+        Return ``True`` if an event with the given name and level should be logged.
+        """
+        if levelno >= logging.ERROR:
+            return True
+        rate = self.rates.get(name)
+        if rate is not None and random.random() >= rate:
+            self._suppress(name)
+            return False
+        limit = self.limits.get(name)
+        if limit is not None:
+            buckets = self._buckets
+        elif rate is None and self.default_limit is not None:
+            limit = self.default_limit
+            buckets = self._default_buckets
+        else:
+            return True
+        now = time.monotonic()
+        with self._lock:
+            bucket = buckets.get(name)
+            if bucket is None:
+                bucket = buckets[name] = _TokenBucket(*limit)
+                if len(self._default_buckets) > self.max_names:
+                    self._default_buckets.popitem(last=False)
+            elif buckets is self._default_buckets:
+                buckets.move_to_end(name)
+            allowed = bucket.take(now)
+        if not allowed:
+            self._suppress(name)
+        return allowed
+
+    def _suppress(self, name):
+        with self._lock:
+            if name not in self._suppressed and len(self._suppressed) >= self.max_names:
+                name = self.OTHER
+            self._suppressed[name] = self._suppressed.get(name, 0) + 1
+
+    def _summarize(self):
+        """
+        Log how many events were suppressed for each name, if it's been at least ``summary_interval`` seconds since
+        the last time we did so.
+        """
+        now = time.monotonic()
+        if now - self._last_summary < self.summary_interval:
+            return
+        with self._lock:
+            self._last_summary = now
+            suppressed, self._suppressed = self._suppressed, {}
+        # This goes through the stdlib logger, rather than back through the structlog chain we're in the middle of.
+        for name, count in sorted(suppressed.items()):
+            logging.getLogger('seedling.sampling').warning('log.suppressed event=%s count=%d', name, count)
+
+    def _name_for(self, logger, event_dict):
+        event = event_dict.get('event')
+        if event in self.rates or event in self.limits:
+            return event
+        logger_name = getattr(logger, 'name', None)
+        if logger_name in self.rates or logger_name in self.limits:
+            return logger_name
+        return event
+
+    def __call__(self, logger, method_name, event_dict):
+        if not self.enabled:
+            return event_dict
+        if self._suppressed:
+            self._summarize()
+        levelno = _METHOD_LEVELS.get(method_name, logging.INFO)
+        if not self.allow(self._name_for(logger, event_dict), levelno):
+            raise structlog.DropEvent
+        return event_dict
+
+
+class LogSamplingFilter(logging.Filter):
+    """
+    A logging filter which applies a ``LogSampler`` to foreign (non-structlog) log records, by logger name. Records
+    from structlog have already been through the sampler in the processor chain, so they're always let through.
+
+    Set it up like this in your LOGGING dict:
+    'filters': {
+        'sampling': {
+            '()': 'seedling.logging.LogSamplingFilter',
+            'sampler': log_sampler,
+        },
+    },
+    """
+
+    def __init__(self, sampler, name=''):
+        super().__init__(name)
+        self.sampler = sampler
+
+    def filter(self, record):
+        if not self.sampler.enabled or isinstance(record.msg, dict):
+            return True
+        if record.name == 'seedling.sampling':
+            return True
+        if self.sampler._suppressed:
+            self.sampler._summarize()
+        return self.sampler.allow(record.name, record.levelno)
+
+
+def parse_rate_limits(value):
+    """
+    Parse a rate limit setting like ``"model.update=100:200,django.db=10:10"`` into a dict mapping names to
+    ``(events per second, burst)`` pairs.
+    """
+    limits = {}
+    for item in filter(None, (chunk.strip() for chunk in value.split(','))):
+        name, _, limit = item.partition('=')
+        limits[name.strip()] = parse_rate_limit(limit)
+    return limits
+
+
+def parse_rate_limit(value):
+    """
+    Parse a single rate limit like ``"100:200"`` (or just ``"100"``, for a burst equal to the rate) into a
+    ``(events per second, burst)`` pair. Returns ``None`` for an empty string.
+    """
+    if not value:
+        return None
+    rate, _, burst = value.partition(':')
+    return float(rate), float(burst or rate)
 
 
 def censor_password_processor(_, __, event_dict):
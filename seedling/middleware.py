@@ -1,5 +1,20 @@
+import asyncio
+import contextvars
+import cProfile
+import random
 import sys
-from crequest.middleware import CrequestMiddleware
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured, MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .db.routers import begin_pinning, end_pinning
+from .logging import bind_request_logging_context, clear_request_logging_context, logger
+from .profiling import ProfileStore, SQLRecorder, summarize_profile
+from .statsd import get_statsd_client, sanitize_metric_name
 
 
 try:
@@ -21,6 +36,26 @@ class NoCurrentRequestException(Exception):
     pass
 
 
+# The request being handled in the current thread or asyncio task. Unlike a thread-local, this follows the request
+# into async views, and into the threads that sync views are run in under ASGI.
+_current_request = contextvars.ContextVar('current_request', default=None)
+
+
+def set_current_request(request):
+    """
+    Make ``request`` the current request, e.g. for a manage.py command that does work on behalf of a user. Returns a
+    token to pass to ``reset_current_request()``.
+    """
+    return _current_request.set(request)
+
+
+def reset_current_request(token):
+    """
+    Restore whatever the current request was before the ``set_current_request()`` call which returned ``token``.
+    """
+    _current_request.reset(token)
+
+
 def get_current_request(default=None, silent=True, label='__DEFAULT_LABEL__'):
     """
     Returns the current request. This is a more robust form of get_current_request, but it's not backwards compatible,
@@ -43,10 +78,12 @@ def get_current_request(default=None, silent=True, label='__DEFAULT_LABEL__'):
 
     :rtype: a Django request object
     """
-    request = CrequestMiddleware.get_request(default)
+    request = _current_request.get()
+    if request is None:
+        request = default
     if request is None and not silent:
         raise NoCurrentRequestException(
-            "{} failed because there is no current request. Try using FakeCurrentRequest.".format(label)
+            "{} failed because there is no current request. Try using set_current_request().".format(label)
         )
     return request
 
@@ -69,3 +106,444 @@ def get_current_user(default=None):
         # There's no current request to grab a user from.
         return default
 
+
+class AsyncCapableMiddleware(object):
+    """
+    A base class for our middleware, which lets Django call it directly in both sync and async middleware chains,
+    without any sync_to_async() or async_to_sync() thread hops.
+
+    Subclasses must implement both ``__call__()``, for sync chains, and ``async def __acall__()``, for async ones, and
+    must start ``__call__()`` with:
+
+        if self.is_async:
+            return self.__acall__(request)
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not asyncio.iscoroutinefunction(getattr(self, '__acall__', None)):
+            raise ImproperlyConfigured(f'{self.__class__.__name__} must implement "async def __acall__()".')
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # This is how Django itself marks a middleware instance as async. See MiddlewareMixin._async_check().
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+
+class CurrentRequestMiddleware(AsyncCapableMiddleware):
+    """
+    Makes the request available to get_current_request() and get_current_user() for as long as it's being handled.
+    This works under both WSGI and ASGI, and with both sync and async views.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = _current_request.set(request)
+        try:
+            return self.get_response(request)
+        finally:
+            _current_request.reset(token)
+
+    async def __acall__(self, request):
+        token = _current_request.set(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            _current_request.reset(token)
+
+
+class RequestLoggingContextMiddleware(AsyncCapableMiddleware):
+    """
+    Binds the current request's logging context (``remote_ip``, ``username``, ``superuser``) once per request, so
+    that ``seedling.logging.request_context_logging_processor`` doesn't have to look it up again for every log line.
+
+    Put this after ``xff.middleware.XForwardedForMiddleware``, so that ``remote_ip`` is the real client IP.
+    """
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = bind_request_logging_context(request)
+        try:
+            return self.get_response(request)
+        finally:
+            clear_request_logging_context(token)
+
+    async def __acall__(self, request):
+        token = bind_request_logging_context(request)
+        try:
+            return await self.get_response(request)
+        finally:
+            clear_request_logging_context(token)
+
+
+# The objects which are recording the current request's queries. Each must have a record(sql, elapsed) method.
+_query_observers = contextvars.ContextVar('query_observers', default=())
+
+
+def _observe_query(execute, sql, params, many, context):
+    """
+    A connection.execute_wrapper() which times each query for the current request's query observers.
+
+    Database connections belong to a single thread, and under ASGI the ORM runs in a different thread than our
+    middleware, so rather than wrapping the connections for the duration of each request, we wrap every connection
+    permanently and find the observers through a contextvar, which follows the request into those threads.
+    """
+    observers = _query_observers.get()
+    if not observers:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        for observer in observers:
+            observer.record(sql, elapsed)
+
+
+# noinspection PyUnusedLocal
+def _install_query_observer(sender, connection, **kwargs):
+    if _observe_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_observe_query)
+
+
+def _instrument_queries():
+    connection_created.connect(_install_query_observer, dispatch_uid='seedling.middleware.observe_queries')
+    # Connections which were opened before our middleware was loaded have already sent connection_created.
+    for connection in connections.all():
+        _install_query_observer(None, connection)
+
+
+@contextmanager
+def observe_queries(observer):
+    """
+    Within this context, every query is passed to ``observer.record(sql, elapsed)``.
+    """
+    token = _query_observers.set(_query_observers.get() + (observer,))
+    try:
+        yield observer
+    finally:
+        _query_observers.reset(token)
+
+
+class RequestMetrics(object):
+    """
+    The DB, cache and template counters for the current request.
+    """
+
+    __slots__ = ('db_queries', 'db_time', 'cache_hits', 'cache_misses', 'template_time', 'template_depth')
+
+    def __init__(self):
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.template_time = 0.0
+        self.template_depth = 0
+
+    def record(self, sql, elapsed):
+        self.db_queries += 1
+        self.db_time += elapsed
+
+
+_request_metrics = contextvars.ContextVar('request_metrics', default=None)
+_MISSING = object()
+
+
+def get_request_metrics():
+    """
+    Return the RequestMetrics which RequestMetricsMiddleware is collecting for the current request, or ``None``.
+    """
+    return _request_metrics.get()
+
+
+def _counting_cache_methods(cache, metrics):
+    """
+    Return get() and get_many() functions which call ``cache``'s own, and count their hits and misses in ``metrics``.
+    """
+    original_get = cache.get
+    original_get_many = cache.get_many
+
+    def get(key, default=None, version=None, **kwargs):
+        value = original_get(key, _MISSING, version=version, **kwargs)
+        if value is _MISSING:
+            metrics.cache_misses += 1
+            return default
+        metrics.cache_hits += 1
+        return value
+
+    def get_many(keys, version=None, **kwargs):
+        keys = list(keys)
+        # Some backends implement get_many() with get(), which mustn't count the same keys again.
+        counting_get = cache.__dict__.pop('get', None)
+        try:
+            values = original_get_many(keys, version=version, **kwargs)
+        finally:
+            if counting_get is not None:
+                cache.get = counting_get
+        metrics.cache_hits += len(values)
+        metrics.cache_misses += len(keys) - len(values)
+        return values
+
+    return get, get_many
+
+
+# The (RequestMetrics, list of wrapped cache instances) of the current count_cache_lookups(), if any.
+_cache_lookup_counter = contextvars.ContextVar('cache_lookup_counter', default=None)
+
+
+def _wrap_cache(cache, metrics, wrapped):
+    if 'get' in cache.__dict__ or 'get_many' in cache.__dict__:
+        # Something else, like an outer count_cache_lookups(), is already wrapping this instance.
+        return
+    cache.get, cache.get_many = _counting_cache_methods(cache, metrics)
+    wrapped.append(cache)
+
+
+def _instrument_caches():
+    """
+    Make ``django.core.cache.caches`` wrap the cache instances it creates inside a count_cache_lookups(), so that caches
+    which are first used partway through a request are counted, too.
+    """
+    create_connection = caches.create_connection
+    if getattr(create_connection, 'counts_lookups', False):
+        return
+
+    def counting_create_connection(alias):
+        cache = create_connection(alias)
+        counter = _cache_lookup_counter.get()
+        if counter is not None:
+            _wrap_cache(cache, *counter)
+        return cache
+
+    counting_create_connection.counts_lookups = True
+    caches.create_connection = counting_create_connection
+
+
+@contextmanager
+def count_cache_lookups(metrics):
+    """
+    Within this context, get() and get_many() calls on the cache backends in ``django.core.cache.caches`` count their
+    hits and misses in ``metrics``.
+
+    Cache backend instances belong to a single thread (or, under ASGI, a single request), so rather than patching the
+    backend classes for every thread, this shadows the methods on the current instances with instance attributes, and
+    deletes them again on the way out. Only the caches that have already been created are wrapped up front; creating
+    the others just to wrap them would open connections (e.g. to Redis) that the request may never use. Those are
+    wrapped as they're created instead, once ``_instrument_caches()`` has been called.
+    """
+    wrapped = []
+    token = _cache_lookup_counter.set((metrics, wrapped))
+    for cache in caches.all(initialized_only=True):
+        _wrap_cache(cache, metrics, wrapped)
+    try:
+        yield metrics
+    finally:
+        _cache_lookup_counter.reset(token)
+        for cache in wrapped:
+            cache.__dict__.pop('get', None)
+            cache.__dict__.pop('get_many', None)
+
+
+class RequestMetricsMiddleware(AsyncCapableMiddleware):
+    """
+    Sends per-view request metrics to statsd:
+
+      ``view.<view_name>.latency``: (timer) the time spent in the rest of the middleware and the view
+      ``view.<view_name>.db.queries``: (histogram) how many database queries the request made
+      ``view.<view_name>.db.time``: (timer) how long those queries took in total
+      ``view.<view_name>.cache.hits``, ``view.<view_name>.cache.misses``: (counters) cache lookups
+      ``view.<view_name>.template.time``: (timer) time spent rendering Django templates, when TEMPLATES uses the
+        ``seedling.template_backends.MetricsDjangoTemplates`` backend
+      ``view.<view_name>.status.<N>xx``: (counter) responses by status class
+
+    Each request's metrics are sent in as few UDP packets as will hold them, after the response has been built.
+    This does nothing unless the STATSD_HOST setting is set. Put it first in MIDDLEWARE, so its latency covers as much
+    of the request as possible.
+    """
+
+    def __init__(self, get_response):
+        self.client = get_statsd_client()
+        if self.client is None:
+            raise MiddlewareNotUsed('STATSD_HOST is not set.')
+        super().__init__(get_response)
+        _instrument_queries()
+        _instrument_caches()
+
+    def _view_name(self, request):
+        match = getattr(request, 'resolver_match', None)
+        if match is None:
+            return 'unresolved'
+        return sanitize_metric_name((match.view_name or match._func_path).replace(':', '.'))
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with observe_queries(metrics), count_cache_lookups(metrics):
+                response = self.get_response(request)
+        finally:
+            _request_metrics.reset(token)
+        self._send(request, response, metrics, time.perf_counter() - start)
+        return response
+
+    async def __acall__(self, request):
+        metrics = RequestMetrics()
+        token = _request_metrics.set(metrics)
+        start = time.perf_counter()
+        try:
+            with observe_queries(metrics), count_cache_lookups(metrics):
+                response = await self.get_response(request)
+        finally:
+            _request_metrics.reset(token)
+        self._send(request, response, metrics, time.perf_counter() - start)
+        return response
+
+    def _send(self, request, response, metrics, elapsed):
+        prefix = f'view.{self._view_name(request)}'
+        client = self.client
+        client.timing(f'{prefix}.latency', elapsed * 1000)
+        client.histogram(f'{prefix}.db.queries', metrics.db_queries)
+        client.timing(f'{prefix}.db.time', metrics.db_time * 1000)
+        if metrics.cache_hits:
+            client.incr(f'{prefix}.cache.hits', metrics.cache_hits)
+        if metrics.cache_misses:
+            client.incr(f'{prefix}.cache.misses', metrics.cache_misses)
+        if metrics.template_time:
+            client.timing(f'{prefix}.template.time', metrics.template_time * 1000)
+        client.incr(f'{prefix}.status.{response.status_code // 100}xx')
+        client.flush()
+
+
+class SlowRequestProfilerMiddleware(AsyncCapableMiddleware):
+    """
+    Captures evidence about slow requests, and stores it in the default cache for the ``slow_requests`` management
+    command to list and dump. See seedling.profiling for what's stored.
+
+    When SLOW_REQUEST_PROFILING is on, every request has its SQL recorded, and a random SLOW_REQUEST_PROFILE_RATE
+    fraction of requests also runs under cProfile. Requests which take at least SLOW_REQUEST_THRESHOLD_MS are stored,
+    with their cProfile summary if they had one. With a threshold of 0, every profiled request is stored.
+
+    cProfile only sees the thread it was started in, so requests through an async middleware chain never run under
+    it; their SQL is still recorded.
+
+    When SLOW_REQUEST_PROFILING is off, the only overhead is checking ``self.enabled``.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.enabled = settings.SLOW_REQUEST_PROFILING
+        self.sample_rate = settings.SLOW_REQUEST_PROFILE_RATE
+        self.threshold_ms = settings.SLOW_REQUEST_THRESHOLD_MS
+        self.function_limit = settings.SLOW_REQUEST_PROFILE_FUNCTIONS
+        self.sql_limit = settings.SLOW_REQUEST_PROFILE_SQL
+        self.store = ProfileStore(
+            max_entries=settings.SLOW_REQUEST_PROFILE_MAX_ENTRIES,
+            timeout=settings.SLOW_REQUEST_PROFILE_TIMEOUT,
+        )
+        if self.enabled:
+            _instrument_queries()
+
+    def __call__(self, request):
+        if not self.enabled:
+            return self.get_response(request)
+        if self.is_async:
+            return self.__acall__(request)
+        recorder = SQLRecorder()
+        profiler = cProfile.Profile() if self.sample_rate and random.random() < self.sample_rate else None
+        start = time.perf_counter()
+        with observe_queries(recorder):
+            if profiler is not None:
+                profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                if profiler is not None:
+                    profiler.disable()
+        self._finish(request, response, time.perf_counter() - start, recorder, profiler)
+        return response
+
+    async def __acall__(self, request):
+        recorder = SQLRecorder()
+        start = time.perf_counter()
+        with observe_queries(recorder):
+            response = await self.get_response(request)
+        self._finish(request, response, time.perf_counter() - start, recorder, None)
+        return response
+
+    def _finish(self, request, response, elapsed, recorder, profiler):
+        duration_ms = elapsed * 1000
+        if duration_ms >= self.threshold_ms and (profiler is not None or self.threshold_ms):
+            self._save(request, response, duration_ms, recorder, profiler)
+
+    def _save(self, request, response, duration_ms, recorder, profiler):
+        match = getattr(request, 'resolver_match', None)
+        profile = {
+            'timestamp': time.time(),
+            'method': request.method,
+            'path': request.path,
+            'view': match.view_name if match is not None else None,
+            'status': response.status_code,
+            'duration_ms': round(duration_ms, 3),
+            'profiled': profiler is not None,
+            'functions': summarize_profile(profiler, self.function_limit) if profiler is not None else [],
+            'db_queries': recorder.queries,
+            'db_time_ms': round(recorder.time * 1000, 3),
+            'sql': recorder.summary(self.sql_limit),
+        }
+        try:
+            profile_id = self.store.save(profile)
+        except Exception:  # noqa
+            # The cache being down mustn't turn a slow request into a failed one.
+            logger.exception('request.slow.store.failed', path=request.path)
+            return
+        logger.warning(
+            'request.slow', path=request.path, duration_ms=profile['duration_ms'], profile_id=profile_id
+        )
+
+
+class ReplicaPinningMiddleware(AsyncCapableMiddleware):
+    """
+    Tracks whether each request writes to the primary database, for seedling.db.routers.ReplicaRouter. After a request
+    that wrote, this sends the same client's reads to the primary for the next REPLICA_PIN_SECONDS, with a cookie, so
+    that they can't see a replica that hasn't caught up with their own change yet.
+
+    This does nothing unless DATABASE_REPLICAS is set.
+    """
+
+    cookie_name = 'primary_db_pin'
+
+    def __init__(self, get_response):
+        if not settings.DATABASE_REPLICAS:
+            raise MiddlewareNotUsed('DATABASE_REPLICAS is empty.')
+        super().__init__(get_response)
+        self.pin_seconds = settings.REPLICA_PIN_SECONDS
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        token = begin_pinning(pinned=self.cookie_name in request.COOKIES)
+        try:
+            response = self.get_response(request)
+        finally:
+            wrote = end_pinning(token)
+        return self._set_cookie(response, wrote)
+
+    async def __acall__(self, request):
+        token = begin_pinning(pinned=self.cookie_name in request.COOKIES)
+        try:
+            response = await self.get_response(request)
+        finally:
+            wrote = end_pinning(token)
+        return self._set_cookie(response, wrote)
+
+    def _set_cookie(self, response, wrote):
+        if wrote and self.pin_seconds:
+            response.set_cookie(self.cookie_name, '1', max_age=self.pin_seconds, httponly=True, samesite='Lax')
+        return response
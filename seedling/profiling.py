@@ -0,0 +1,104 @@
+"""
+Compact profiles of slow requests, stored in the default cache.
+
+``seedling.middleware.SlowRequestProfilerMiddleware`` builds these, and the ``slow_requests`` management command lists
+and dumps them. Each one is a plain dict, so it can be pickled by any cache backend and dumped as JSON:
+
+  ``id``, ``timestamp``, ``method``, ``path``, ``view``, ``status``, ``duration_ms``: what the request was
+  ``profiled``: whether the request ran under cProfile. Slow requests that weren't sampled only have their SQL.
+  ``functions``: the top functions by cumulative time, as dicts of ``function``, ``calls``, ``tottime_ms`` and
+      ``cumtime_ms``
+  ``db_queries``, ``db_time_ms``: how many queries the request made, and how long they took in total
+  ``sql``: the most expensive distinct SQL statements, as dicts of ``sql``, ``count`` and ``time_ms``
+"""
+import pstats
+import uuid
+
+from django.core.cache import caches
+
+INDEX_KEY = 'slow_request:index'
+KEY_PREFIX = 'slow_request:'
+
+
+class SQLRecorder(object):
+    """
+    A query observer (see seedling.middleware.observe_queries()) which totals up the time spent in each distinct SQL
+    statement.
+    """
+
+    def __init__(self, max_sql_length=500):
+        self.max_sql_length = max_sql_length
+        self.queries = 0
+        self.time = 0.0
+        self.statements = {}
+
+    def record(self, sql, elapsed):
+        self.queries += 1
+        self.time += elapsed
+        # The SQL is parameterized, so all the executions of the same query add up under the same statement.
+        count, total = self.statements.get(sql, (0, 0.0))
+        self.statements[sql] = (count + 1, total + elapsed)
+
+    def summary(self, limit):
+        top = sorted(self.statements.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            {'sql': sql[:self.max_sql_length], 'count': count, 'time_ms': round(total * 1000, 3)}
+            for sql, (count, total) in top
+        ]
+
+
+def summarize_profile(profiler, limit):
+    """
+    Return the top ``limit`` functions by cumulative time from the given (stopped) cProfile.Profile.
+    """
+    stats = pstats.Stats(profiler).stats
+    top = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [
+        {
+            'function': pstats.func_std_string(func),
+            'calls': calls,
+            'tottime_ms': round(tottime * 1000, 3),
+            'cumtime_ms': round(cumtime * 1000, 3),
+        }
+        for func, (_, calls, tottime, cumtime, _) in top
+    ]
+
+
+class ProfileStore(object):
+    """
+    Keeps the ``max_entries`` most recent slow request profiles in the given cache, for ``timeout`` seconds each.
+    """
+
+    def __init__(self, cache_alias='default', max_entries=100, timeout=7 * 24 * 3600):
+        self.cache_alias = cache_alias
+        self.max_entries = max_entries
+        self.timeout = timeout
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def save(self, profile):
+        """
+        Store the given profile dict, and return its id.
+        """
+        profile_id = profile.setdefault('id', uuid.uuid4().hex[:12])
+        self.cache.set(KEY_PREFIX + profile_id, profile, self.timeout)
+        # This read-modify-write can lose an index entry when two workers save at once. That's an acceptable price for
+        # working with any cache backend; the lost profile just expires unlisted.
+        index = self.cache.get(INDEX_KEY) or []
+        index.insert(0, (profile_id, profile['timestamp'], profile['duration_ms'], profile['method'], profile['path']))
+        self.cache.set(INDEX_KEY, index[:self.max_entries], self.timeout)
+        return profile_id
+
+    def list(self):
+        """
+        Return ``(id, timestamp, duration_ms, method, path)`` tuples for the stored profiles, most recent first.
+        """
+        return self.cache.get(INDEX_KEY) or []
+
+    def get(self, profile_id):
+        return self.cache.get(KEY_PREFIX + profile_id)
+
+    def clear(self):
+        self.cache.delete_many([KEY_PREFIX + entry[0] for entry in self.list()] + [INDEX_KEY])
@@ -14,10 +14,16 @@ import logging
 import logging.config
 import sentry_sdk
 import structlog
-from seedling.logging import ConsoleRenderer
+from seedling.logging import (
+    JSONLinesRenderer,
+    LogSampler,
+    PrecompiledConsoleRenderer,
+    parse_rate_limit,
+    parse_rate_limits,
+)
 from sentry_sdk.integrations.django import DjangoIntegration
 
-from .logging import censor_password_processor, request_context_logging_processor
+from .logging import censor_password_processor, queued_logging, request_context_logging_processor
 
 # The name of our project
 # ------------------------------------------------------------------------------
@@ -67,24 +73,75 @@ if TESTING:
     DATABASES = {
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-            'NAME': BASE_DIR.path('db.sqlite3'),
-        }
+            # Django needs a str here; environ.Path isn't hashable.
+            'NAME': str(BASE_DIR.path('db.sqlite3')),
+        },
+        # seedling.db.tests routes reads to this one, to stand in for a read replica.
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': str(BASE_DIR.path('db_replica.sqlite3')),
+        },
     }
 else:
     DATABASES = {
         'default': {
-            'ENGINE': 'django.db.backends.mysql',
+            # Django's MySQL backend, plus CONN_HEALTH_CHECKS support. See seedling/db/backends/mysql/base.py.
+            'ENGINE': 'seedling.db.backends.mysql',
             'NAME': env('DB_NAME', None),
             'USER': env('DB_USER', default=None),
             'PASSWORD': env('DB_PASSWORD', default=None),
             'HOST': env('DB_HOST', default=None),
             'ATOMIC_REQUESTS': True,
+            # Keep each thread's connection open between requests for this many seconds, rather than reconnecting for
+            # every request, and ping it before its first use in each request.
+            'CONN_MAX_AGE': env.int('DB_CONN_MAX_AGE', default=60),
+            'CONN_HEALTH_CHECKS': True,
             # This is needed in case the database doesn't have the newer default settings that enable "strict mode".
             'OPTIONS': {
                 'sql_mode': 'traditional',
             }
         }
     }
+    # Set DB_POOL=True to share a pool of MySQL connections between all of a worker's threads instead, which suits
+    # gthread and ASGI workers better. See seedling/db/backends/mysql_pool/base.py.
+    if env.bool('DB_POOL', default=False):
+        DATABASES['default'].update({
+            'ENGINE': 'seedling.db.backends.mysql_pool',
+            # Connections go back to the pool at the end of each request, instead of staying with their thread.
+            'CONN_MAX_AGE': 0,
+            'POOL': {
+                'SIZE': env.int('DB_POOL_SIZE', default=5),
+                'MAX_OVERFLOW': env.int('DB_POOL_MAX_OVERFLOW', default=10),
+                'TIMEOUT': env.float('DB_POOL_TIMEOUT', default=10.0),
+                'IDLE_TIMEOUT': env.float('DB_POOL_IDLE_TIMEOUT', default=300.0),
+                'PING_INTERVAL': env.float('DB_POOL_PING_INTERVAL', default=30.0),
+            },
+        })
+
+# seedling.asgi runs each request's sync code in a new thread, and each thread has its own connections, so a persistent
+# connection would be left open by every request. DB_POOL's connections already go back to the pool instead.
+if env.bool('SERVING_ASGI', default=False):
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
+# Read replicas. DB_REPLICA_HOSTS is a comma-separated list of MySQL hosts which replicate from DB_HOST, with the same
+# database name and credentials. seedling.db.routers.ReplicaRouter sends reads to them; see there for the details.
+DATABASE_REPLICAS = []
+for _index, _host in enumerate(env.list('DB_REPLICA_HOSTS', default=[]), start=1):
+    DATABASES[f'replica{_index}'] = dict(
+        DATABASES['default'],
+        HOST=_host,
+        ATOMIC_REQUESTS=False,
+        # Tests read the default database through the replica aliases.
+        TEST={'MIRROR': 'default'},
+    )
+    DATABASE_REPLICAS.append(f'replica{_index}')
+if DATABASE_REPLICAS:
+    DATABASE_ROUTERS = ['seedling.db.routers.ReplicaRouter']
+# Fall back to the primary for reads when every replica is further behind it than this many seconds.
+REPLICA_MAX_LAG = env.int('REPLICA_MAX_LAG', default=5)
+REPLICA_LAG_CHECK_INTERVAL = env.int('REPLICA_LAG_CHECK_INTERVAL', default=5)
+# After a request writes to the primary, the same client reads from the primary for this many seconds.
+REPLICA_PIN_SECONDS = env.int('REPLICA_PIN_SECONDS', default=5)
 
 # REDIS
 # ------------------------------------------------------------------------------
@@ -100,6 +157,13 @@ if env.bool('DISABLE_CACHE', default=False):
             'BACKEND': 'django.core.cache.backends.dummy.DummyCache',
         }
     }
+elif TESTING:
+    # Tests mustn't need a Redis server.
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
 else:
     CACHES = {
         # … default cache config and others
@@ -113,6 +177,29 @@ else:
         }
     }
 
+# STATSD
+# ------------------------------------------------------------------------------
+# The same statsd server that gunicorn_config.py sends gunicorn's own metrics to. If STATSD_HOST isn't set,
+# seedling.middleware.RequestMetricsMiddleware disables itself.
+STATSD_HOST = env('STATSD_HOST', default=None)
+STATSD_PORT = env.int('STATSD_PORT', default=8125)
+STATSD_PREFIX = env('STATSD_PREFIX', default=None)
+STATSD_MAX_PACKET_SIZE = env.int('STATSD_MAX_PACKET_SIZE', default=512)
+# The client sends its buffered metrics once it has this many, even if nothing has called flush().
+STATSD_MAX_BUFFER_SIZE = env.int('STATSD_MAX_BUFFER_SIZE', default=1000)
+
+# SLOW REQUEST PROFILING
+# ------------------------------------------------------------------------------
+# See seedling.middleware.SlowRequestProfilerMiddleware. Use "manage.py slow_requests" to see what it has stored.
+SLOW_REQUEST_PROFILING = env.bool('SLOW_REQUEST_PROFILING', default=False)
+SLOW_REQUEST_THRESHOLD_MS = env.int('SLOW_REQUEST_THRESHOLD_MS', default=1000)
+# The fraction of requests to run under cProfile, e.g. 0.01 for 1%.
+SLOW_REQUEST_PROFILE_RATE = env.float('SLOW_REQUEST_PROFILE_RATE', default=0.0)
+SLOW_REQUEST_PROFILE_FUNCTIONS = env.int('SLOW_REQUEST_PROFILE_FUNCTIONS', default=30)
+SLOW_REQUEST_PROFILE_SQL = env.int('SLOW_REQUEST_PROFILE_SQL', default=20)
+SLOW_REQUEST_PROFILE_MAX_ENTRIES = env.int('SLOW_REQUEST_PROFILE_MAX_ENTRIES', default=100)
+SLOW_REQUEST_PROFILE_TIMEOUT = env.int('SLOW_REQUEST_PROFILE_TIMEOUT', default=7 * 24 * 3600)
+
 # URLS
 # ------------------------------------------------------------------------------
 # https://docs.djangoproject.com/en/3.2/ref/settings/#root-urlconf
@@ -183,6 +270,14 @@ AUTH_PASSWORD_VALIDATORS = [
 # MIDDLEWARE
 # ------------------------------------------------------------------------
 MIDDLEWARE = [
+    # Sends per-view latency, query, cache and template metrics to statsd, if STATSD_HOST is set.
+    'seedling.middleware.RequestMetricsMiddleware',
+    # Stores SQL and cProfile summaries of slow requests, if SLOW_REQUEST_PROFILING is on.
+    'seedling.middleware.SlowRequestProfilerMiddleware',
+    # Reads the primary database, rather than a replica, for a few seconds after a client writes, if there are replicas.
+    # This must come before anything that might write, like SessionMiddleware.
+    'seedling.middleware.ReplicaPinningMiddleware',
+
     # Set our REMOTE_ADDR properly when we're behind a proxy.
     'xff.middleware.XForwardedForMiddleware',
 
@@ -196,7 +291,9 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 
     # Enables the use of the get_current_request() and get_current_user() functions.
-    'crequest.middleware.CrequestMiddleware',
+    'seedling.middleware.CurrentRequestMiddleware',
+    # Binds the request context fields of our log messages once per request.
+    'seedling.middleware.RequestLoggingContextMiddleware',
 ]
 
 # STATIC
@@ -238,7 +335,10 @@ MEDIA_URL = '/media/'
 CACHE_TEMPLATES = env.bool('CACHE_TEMPLATES', default=True)
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, plus render timing for seedling.middleware.RequestMetricsMiddleware.
+        'BACKEND': 'seedling.template_backends.MetricsDjangoTemplates',
+        # Keep the alias that DjangoTemplates would get, i.e. django.template.engines['django'].
+        'NAME': 'django',
         'APP_DIRS': True,
         'OPTIONS': {
             # Django does template caching for us correctly as long as OPTIONS['debug'] is False.
@@ -326,11 +426,28 @@ MANAGERS = ADMINS
 
 # LOGGING
 # ------------------------------------------------------------------------------
+# Thin out high-frequency log events, to cap our logging overhead during load spikes. Events at ERROR and above are
+# never dropped. Names may be event names (e.g. model.update) or logger names (e.g. django.db.backends).
+#   LOG_SAMPLE_RATES: the fraction of events to keep per name, e.g. "model.update=0.1,django.db.backends=0.01"
+#   LOG_RATE_LIMITS: events/sec:burst per name, e.g. "model.update=100:200"
+#   LOG_RATE_LIMIT_DEFAULT: events/sec:burst for every other name, e.g. "1000:2000"
+#   LOG_SUPPRESSED_SUMMARY_INTERVAL: seconds between "log.suppressed" summaries of what was dropped
+#   LOG_SAMPLING_MAX_NAMES: how many distinct names LOG_RATE_LIMIT_DEFAULT keeps a bucket for, least recently seen out
+log_sampler = LogSampler(
+    rates=env.dict('LOG_SAMPLE_RATES', cast={'value': float}, default={}),
+    limits=parse_rate_limits(env('LOG_RATE_LIMITS', default='')),
+    default_limit=parse_rate_limit(env('LOG_RATE_LIMIT_DEFAULT', default='')),
+    summary_interval=env.float('LOG_SUPPRESSED_SUMMARY_INTERVAL', default=60.0),
+    max_names=env.int('LOG_SAMPLING_MAX_NAMES', default=1000),
+)
+
 # Use structlog to ease the difficulty of adding context to log messages
 # See https://structlog.readthedocs.io/en/stable/index.html
 structlog.configure(
     processors=[
         structlog.stdlib.filter_by_level,
+        # Drop sampled-out events as early as possible, before we spend any time on them.
+        log_sampler,
         structlog.stdlib.add_logger_name,
         structlog.stdlib.add_log_level,
         structlog.stdlib.PositionalArgumentsFormatter(),
@@ -344,7 +461,10 @@ structlog.configure(
     context_class=dict,
     logger_factory=structlog.stdlib.LoggerFactory(),
     wrapper_class=structlog.stdlib.BoundLogger,
-    cache_logger_on_first_use=False,
+    # Cached loggers skip rebuilding the bound logger chain on every call. Set STRUCTLOG_CACHE_LOGGERS=False if you need
+    # to call structlog.configure() again after loggers have been used, e.g. in a test. Run
+    # `manage.py benchmark_logging` to see what this buys us.
+    cache_logger_on_first_use=env.bool('STRUCTLOG_CACHE_LOGGERS', default=True),
 )
 
 pre_chain = [
@@ -353,6 +473,11 @@ pre_chain = [
     structlog.processors.TimeStamper(fmt='iso'),
 ]
 
+# Set LOG_FORMAT=json to log one JSON object per line instead of key=value text. This is much cheaper for our log
+# shipper to ingest, since it doesn't have to regex-parse the fields back out of each line.
+LOG_FORMAT = env('LOG_FORMAT', default='console')
+STRUCTLOG_FORMATTER = 'structlog_json' if LOG_FORMAT == 'json' else 'structlog'
+
 # Prevent Django from doing its own base logging config, since we need to replace its 'django' logger with our own.
 LOGGING_CONFIG = None
 # Build our custom logging config.
@@ -399,12 +524,13 @@ LOGGING = {
         'structlog_console': {
             'level': 'DEBUG',
             'class': 'logging.StreamHandler',
-            'formatter': 'structlog'
+            'formatter': STRUCTLOG_FORMATTER,
+            'filters': ['sampling'],
         },
         'devel_console': {
             'level': 'DEBUG',
             'class': 'logging.StreamHandler',
-            'formatter': 'structlog',
+            'formatter': STRUCTLOG_FORMATTER,
             'filters': ['require_development_true'],
         },
         'null': {
@@ -416,12 +542,17 @@ LOGGING = {
         'require_development_true': {
             '()': 'seedling.logging.RequireDevelopmentTrueFilter',
         },
+        # Applies log_sampler to log records from non-structlog loggers.
+        'sampling': {
+            '()': 'seedling.logging.LogSamplingFilter',
+            'sampler': log_sampler,
+        },
     },
     'formatters': {
         # Set up a special formatter for our structlog output
         'structlog': {
             '()': structlog.stdlib.ProcessorFormatter,
-            'processor': ConsoleRenderer(
+            'processor': PrecompiledConsoleRenderer(
                 # Remember to set the env var COLORED_LOGGING=True in dev, to make this colorize all the logs.
                 # It needs to remain disabled in test/prod, though, so it doesn't mess with the ELK stack.
                 colors=env.bool('COLORED_LOGGING', default=False),
@@ -431,20 +562,81 @@ LOGGING = {
             'foreign_pre_chain': pre_chain,
             'format': 'SYSLOG %(message)s',
         },
+        # The same, but rendered as JSON lines. Select this with LOG_FORMAT=json.
+        'structlog_json': {
+            '()': structlog.stdlib.ProcessorFormatter,
+            'processor': JSONLinesRenderer(),
+            'foreign_pre_chain': pre_chain,
+            'format': '%(message)s',
+        },
     },
 }
 # Execute our custom logging config. Django normally does this for us after this file is loaded, but since we set
 # LOGGING_CONFIG = False so we could override some of django's default loggers, we need to load LOGGING ourselves.
 logging.config.dictConfig(LOGGING)
+# Set LOGGING_QUEUE=True to have our handlers put log records on a queue, which a listener thread in each process
+# formats and writes. This keeps requests from stalling on write() when the stdout/stderr pipe backs up.
+# See seedling.logging.QueuedLogging.
+LOGGING_QUEUE = env.bool('LOGGING_QUEUE', default=False)
+if LOGGING_QUEUE:
+    queued_logging.install([''] + list(LOGGING['loggers']), max_size=env.int('LOGGING_QUEUE_SIZE', default=10000))
 
 # Do not log changes to the following models. The model's full app_label.ModelName string must be included.
 # This setting is used by ADS's custom model change logging code. By default we skip logging changes to sessions and
-UNLOGGED_MODELS = ['sessions.Session']
+# to the stored audit log events themselves.
+UNLOGGED_MODELS = ['sessions.Session', 'core.AuditEvent']
+
+# Per-model field lists for the model change audit log, keyed by the model's app_label.ModelName string. 'fields' lists
+# the only fields to log, and 'exclude' lists fields not to log, e.g. {'users.User': {'exclude': ['last_login']}}.
+# Like UNLOGGED_MODELS, this is read once at startup, by seedling.core.registry.
+AUDIT_LOG_MODEL_FIELDS = {}
+
+# Audit log events from inside a transaction are only logged once it commits, and are discarded if it rolls back.
+AUDIT_LOG_ON_COMMIT = env.bool('AUDIT_LOG_ON_COMMIT', default=True)
+
+# Model change audit log events are written by a background thread, so rendering and writing them doesn't add to
+# request latency. See seedling/audit.py for what these do. The pipeline is synchronous during tests by default, so
+# that tests can see the log output right away.
+AUDIT_LOG_ASYNC = env.bool('AUDIT_LOG_ASYNC', default=not TESTING)
+AUDIT_LOG_QUEUE_SIZE = env.int('AUDIT_LOG_QUEUE_SIZE', default=10000)
+AUDIT_LOG_BATCH_SIZE = env.int('AUDIT_LOG_BATCH_SIZE', default=100)
+AUDIT_LOG_FLUSH_INTERVAL = env.float('AUDIT_LOG_FLUSH_INTERVAL', default=1.0)
+# Either 'block' or 'drop'.
+AUDIT_LOG_FULL_POLICY = env('AUDIT_LOG_FULL_POLICY', default='block')
+AUDIT_LOG_BLOCK_TIMEOUT = env.float('AUDIT_LOG_BLOCK_TIMEOUT', default=5.0)
+# Also save audit log events in the core.AuditEvent table, so they can be queried with AuditEvent.objects. The
+# prune_audit_events management command deletes the ones older than AUDIT_LOG_STORE_RETENTION_DAYS.
+AUDIT_LOG_STORE = env.bool('AUDIT_LOG_STORE', default=False)
+AUDIT_LOG_STORE_RETENTION_DAYS = env.int('AUDIT_LOG_STORE_RETENTION_DAYS', default=365)
+# How model_to_dict() represents related objects (reverse relations and the like) in audit log events:
+#   'skip': leave them out, 'pk': log the pks of the first AUDIT_LOG_RELATIONS_LIMIT of them, 'count': log how many
+#   there are, 'first': log the first AUDIT_LOG_RELATIONS_LIMIT objects themselves.
+# Only related objects which are already loaded, e.g. by prefetch_related(), are logged. Audit logging never queries
+# for them, and model.create events never include them.
+AUDIT_LOG_RELATIONS = env('AUDIT_LOG_RELATIONS', default='pk')
+AUDIT_LOG_RELATIONS_LIMIT = env.int('AUDIT_LOG_RELATIONS_LIMIT', default=10)
+# Bulk operations through seedling.core.managers.AuditedQuerySet log their pks as a list when there are no more than
+# this many of them, and as just the lowest and highest of them otherwise.
+AUDIT_LOG_BULK_PK_LIMIT = env.int('AUDIT_LOG_BULK_PK_LIMIT', default=100)
+# How objects added to or removed from many-to-many relations are logged: 'pk' logs their pks without querying for them,
+# 'repr' loads them and logs them the way they were logged before. Either way, sets of more than AUDIT_LOG_BULK_PK_LIMIT
+# objects are logged as just their count and their lowest and highest pks.
+AUDIT_LOG_M2M = env('AUDIT_LOG_M2M', default='pk')
 
 # Seedling
 # ------------------------------------------------------------------------------
 BOOTSTRAP_ALWAYS_MIGRATE = True
 
+# Users
+# ------------------------------------------------------------------------------
+# See seedling.users.search. Searches return at most USER_SEARCH_MAX_RESULTS users, and their results are cached for
+# USER_SEARCH_CACHE_TIMEOUT seconds. USER_SEARCH_MIN_WORD_LENGTH should match MySQL's innodb_ft_min_token_size.
+USER_SEARCH_MAX_RESULTS = env.int('USER_SEARCH_MAX_RESULTS', default=1000)
+USER_SEARCH_CACHE_TIMEOUT = env.int('USER_SEARCH_CACHE_TIMEOUT', default=60)
+USER_SEARCH_MIN_WORD_LENGTH = env.int('USER_SEARCH_MIN_WORD_LENGTH', default=3)
+# See seedling.users.profiles. Cached user profiles are invalidated when the user changes, so this can be long.
+USER_PROFILE_CACHE_TIMEOUT = env.int('USER_PROFILE_CACHE_TIMEOUT', default=3600)
+
 # unittest-xml-reporting
 # ------------------------------------------------------------------------------
 # https://github.com/xmlrunner/unittest-xml-reporting/tree/master/#django-support
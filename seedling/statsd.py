@@ -0,0 +1,199 @@
+"""
+A minimal statsd client that batches metrics into as few UDP packets as possible.
+
+Metrics are buffered in memory until ``flush()`` is called, or until ``max_buffer_size`` of them have piled up, and
+are then packed into newline-separated datagrams of
+no more than ``max_packet_size`` bytes each, which statsd, Telegraf and the Datadog agent all accept. Sending is
+fire-and-forget: a missing or overloaded statsd server never slows down or breaks a request.
+
+``LocalStatsdListener`` is a stand-in statsd server for tests and local debugging, which collects the metrics that
+are sent to it.
+"""
+import re
+import socket
+import threading
+
+_UNSAFE_CHARS = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+def sanitize_metric_name(name):
+    """
+    Return ``name`` with every character that isn't safe in a statsd metric name replaced by an underscore.
+    """
+    return _UNSAFE_CHARS.sub('_', name)
+
+
+class StatsdClient(object):
+    """
+    :param host: the statsd server's hostname
+    :param port: the statsd server's UDP port
+    :param prefix: (optional) prepended, with a ".", to every metric name
+    :param max_packet_size: the largest datagram to send, in bytes. 512 is safe on any network; 1432 fits in a
+        single Ethernet frame.
+    :param max_buffer_size: the most metrics to buffer. Adding one more flushes the buffer, so code which never calls
+        flush() can't make it grow without bound.
+    """
+
+    def __init__(self, host, port=8125, prefix=None, max_packet_size=512, max_buffer_size=1000):
+        self.address = (host, port)
+        self.prefix = f'{prefix}.' if prefix else ''
+        self.max_packet_size = max_packet_size
+        self.max_buffer_size = max_buffer_size
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._socket = None
+
+    def _add(self, name, value, metric_type):
+        line = f'{self.prefix}{name}:{value}|{metric_type}'
+        with self._lock:
+            self._buffer.append(line)
+            full = len(self._buffer) >= self.max_buffer_size
+        if full:
+            self.flush()
+
+    def incr(self, name, count=1):
+        self._add(name, count, 'c')
+
+    def gauge(self, name, value):
+        self._add(name, value, 'g')
+
+    def timing(self, name, ms):
+        """
+        Record a duration, in milliseconds. statsd turns these into percentiles, i.e. a latency histogram.
+        """
+        self._add(name, round(ms, 3), 'ms')
+
+    def histogram(self, name, value):
+        """
+        Record a value which isn't a duration, like a query count, with the same percentile aggregation as timing().
+        """
+        self._add(name, value, 'h')
+
+    def _packets(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            line_size = len(line.encode('utf-8'))
+            if packet and size + 1 + line_size > self.max_packet_size:
+                yield '\n'.join(packet)
+                packet = []
+                size = 0
+            size += line_size + (1 if packet else 0)
+            packet.append(line)
+        if packet:
+            yield '\n'.join(packet)
+
+    def flush(self):
+        """
+        Send every buffered metric.
+        """
+        with self._lock:
+            lines, self._buffer = self._buffer, []
+        if not lines:
+            return
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._socket.setblocking(False)
+            for packet in self._packets(lines):
+                self._socket.sendto(packet.encode('utf-8'), self.address)
+        except OSError:
+            # Metrics are best-effort. This includes name resolution failures and full socket buffers.
+            pass
+
+
+class LocalStatsdListener(object):
+    """
+    A stand-in statsd server which listens on a local UDP port, and collects every metric line it receives.
+
+    Use it like this::
+
+        with LocalStatsdListener() as listener:
+            client = StatsdClient('127.0.0.1', listener.port)
+            ...
+            client.flush()
+            assert 'some.metric:1|c' in listener.wait_for(1)
+    """
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.packets = []
+        self._socket = None
+        self._thread = None
+        self._received = threading.Condition()
+
+    @property
+    def lines(self):
+        with self._received:
+            return [line for packet in self.packets for line in packet.split('\n')]
+
+    def start(self):
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._socket.bind((self.host, self.port))
+        self._socket.settimeout(0.1)
+        self.port = self._socket.getsockname()[1]
+        self._thread = threading.Thread(target=self._run, name='statsd-listener', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while self._socket is not None:
+            try:
+                data = self._socket.recv(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                return
+            with self._received:
+                self.packets.append(data.decode('utf-8'))
+                self._received.notify_all()
+
+    def wait_for(self, count, timeout=1.0):
+        """
+        Wait up to ``timeout`` seconds for at least ``count`` metric lines to arrive, then return all of them.
+        """
+        with self._received:
+            self._received.wait_for(
+                lambda: sum(packet.count('\n') + 1 for packet in self.packets) >= count, timeout=timeout
+            )
+        return self.lines
+
+    def stop(self):
+        sock, self._socket = self._socket, None
+        if self._thread is not None:
+            self._thread.join()
+        if sock is not None:
+            sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_statsd_client():
+    """
+    Return the process-wide StatsdClient configured by the STATSD_* settings, or ``None`` if STATSD_HOST isn't set.
+    """
+    global _client
+    if _client is None:
+        from django.conf import settings
+        host = getattr(settings, 'STATSD_HOST', None)
+        if not host:
+            return None
+        with _client_lock:
+            if _client is None:
+                _client = StatsdClient(
+                    host,
+                    port=getattr(settings, 'STATSD_PORT', 8125),
+                    prefix=getattr(settings, 'STATSD_PREFIX', None),
+                    max_packet_size=getattr(settings, 'STATSD_MAX_PACKET_SIZE', 512),
+                    max_buffer_size=getattr(settings, 'STATSD_MAX_BUFFER_SIZE', 1000),
+                )
+    return _client
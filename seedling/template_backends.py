@@ -0,0 +1,44 @@
+"""
+A Django template backend which times template renders for seedling.middleware.RequestMetricsMiddleware.
+
+Use it in place of ``django.template.backends.django.DjangoTemplates`` in the TEMPLATES setting. It takes the same
+options, and renders exactly the same output.
+"""
+import time
+
+from django.template.backends.django import DjangoTemplates, Template
+
+from .middleware import get_request_metrics
+
+
+class MetricsTemplate(Template):
+    """
+    A backend template whose render() adds its time to the current request's RequestMetrics, if there is one.
+    """
+
+    def render(self, context=None, request=None):
+        metrics = get_request_metrics()
+        if metrics is None:
+            return super().render(context, request)
+        metrics.template_depth += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_depth -= 1
+            if metrics.template_depth == 0:
+                # Only the outermost render counts, e.g. when a template tag calls render_to_string().
+                metrics.template_time += time.perf_counter() - start
+
+
+class MetricsDjangoTemplates(DjangoTemplates):
+    """
+    DjangoTemplates, but with templates which time their renders. Templates which are included or extended render
+    inside the template which uses them, so their time is part of its time.
+    """
+
+    def from_string(self, template_code):
+        return MetricsTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return MetricsTemplate(super().get_template(template_name).template, self)
@@ -1,8 +1,10 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
 from django.contrib.auth import admin as auth_admin
 from django.contrib.auth import get_user_model
 
 from seedling.users.forms import UserChangeForm, UserCreationForm
+from seedling.users.search import search_user_pks
 
 User = get_user_model()
 
@@ -14,4 +16,23 @@ class UserAdmin(auth_admin.UserAdmin):
     add_form = UserCreationForm
     fieldsets = (("User", {"fields": ("full_name", )}),) + auth_admin.UserAdmin.fieldsets
     list_display = ["username", "last_name", "first_name", "is_superuser"]
-    search_fields = ["last_name", "first_name"]
+    # The admin only uses this to decide whether to show the search box; get_search_results() does the searching.
+    search_fields = ["username", "first_name", "last_name", "full_name", "email"]
+
+    def get_search_results(self, request, queryset, search_term):
+        """
+        Use the indexed, cached user search instead of the admin's LIKE '%term%' scan over every search field.
+        Searches are capped at USER_SEARCH_MAX_RESULTS users, so say so when there were more matches than that.
+        """
+        if not search_term.strip():
+            return queryset, False
+        limit = getattr(settings, 'USER_SEARCH_MAX_RESULTS', 1000)
+        # Ask for one more than we'll show, to tell whether there are more.
+        pks = search_user_pks(search_term, limit + 1)
+        if len(pks) > limit:
+            self.message_user(
+                request,
+                f"Only the first {limit} users matching this search are shown. Try a longer search term.",
+                messages.WARNING,
+            )
+        return queryset.filter(pk__in=pks[:limit]), False
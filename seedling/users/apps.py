@@ -1,6 +1,20 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_init, post_save
 
 
 class UsersConfig(AppConfig):
     name = 'seedling.users'
     label = 'users'
+
+    def ready(self):
+        """
+        Keep the cached user search results and profiles up to date.
+        """
+        from .profiles import remember_username, user_changed
+        from .search import user_saved
+        user_model = self.get_model('User')
+        post_save.connect(user_saved, sender=user_model, dispatch_uid='users.search.post_save')
+        post_delete.connect(user_saved, sender=user_model, dispatch_uid='users.search.post_delete')
+        post_init.connect(remember_username, sender=user_model, dispatch_uid='users.profiles.post_init')
+        post_save.connect(user_changed, sender=user_model, dispatch_uid='users.profiles.post_save')
+        post_delete.connect(user_changed, sender=user_model, dispatch_uid='users.profiles.post_delete')
@@ -0,0 +1,36 @@
+from django.db import migrations, models
+
+# These must match seedling.users.search.FULLTEXT_INDEX and FULLTEXT_FIELDS.
+FULLTEXT_INDEX = 'users_user_search'
+FULLTEXT_FIELDS = ('first_name', 'last_name', 'email', 'full_name')
+
+
+def create_fulltext_index(apps, schema_editor):
+    # Only MySQL has FULLTEXT indexes. Elsewhere, seedling.users.search falls back to prefix lookups.
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    quote = schema_editor.quote_name
+    columns = ', '.join(quote(field) for field in FULLTEXT_FIELDS)
+    schema_editor.execute(f'CREATE FULLTEXT INDEX {quote(FULLTEXT_INDEX)} ON {quote("users_user")} ({columns})')
+
+
+def drop_fulltext_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'mysql':
+        return
+    quote = schema_editor.quote_name
+    schema_editor.execute(f'DROP INDEX {quote(FULLTEXT_INDEX)} ON {quote("users_user")}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['email'], name='users_user_email_idx'),
+        ),
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
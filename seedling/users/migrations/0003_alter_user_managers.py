@@ -0,0 +1,20 @@
+# Generated by Django 3.2.8 on 2026-10-18 18:27
+
+from django.db import migrations
+import seedling.users.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_search_index'),
+    ]
+
+    operations = [
+        migrations.AlterModelManagers(
+            name='user',
+            managers=[
+                ('objects', seedling.users.models.UserManager()),
+            ],
+        ),
+    ]
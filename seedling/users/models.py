@@ -1,13 +1,30 @@
-from django.db.models import CharField
+from django.db.models import CharField, Index
 from django.urls import reverse
 from django.utils.translation import ugettext_lazy as _
 
-from django.contrib.auth.models import AbstractUser
+from django.contrib.auth.models import AbstractUser, UserManager as DjangoUserManager
+
+from seedling.core.managers import AuditedQuerySet
+
+
+class UserManager(DjangoUserManager.from_queryset(AuditedQuerySet)):
+    """
+    Django's UserManager, plus one audit log event per bulk operation (see seedling.core.managers).
+    """
 
 
 class User(AbstractUser):
 
     full_name = CharField(_("Full Name"), blank=True, max_length=255)
 
+    objects = UserManager()
+
+    class Meta(AbstractUser.Meta):
+        # For logins by email address, and for email prefix searches (see seedling.users.search). The FULLTEXT index
+        # that searches use is created by migration 0002, since Django can't describe it.
+        indexes = [
+            Index(fields=["email"], name="users_user_email_idx"),
+        ]
+
     def get_absolute_url(self):
         return reverse("users:detail", kwargs={"username": self.username})
@@ -0,0 +1,103 @@
+"""
+Cached user profiles, for UserDetailView.
+
+A profile is a plain dict of the user's ``pk`` and ``username``, and ``html``: their profile fragment, rendered from
+users/_user_profile.html. Nothing in it depends on who is looking, so it's shared by every viewer, and a repeated
+profile view costs two cache lookups instead of a query and a template render.
+
+Profiles are cached under their username and a version counter, which is bumped when the user is saved or deleted,
+so there's never a stale profile to delete. A user who changes their username gets both their old and new usernames'
+versions bumped. Saves that only touch fields the profile doesn't show, like the ``last_login`` update on every login,
+leave it alone. If the cache is down, that's logged and the save goes ahead.
+"""
+import time
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.template.loader import render_to_string
+
+from seedling.logging import logger
+
+PROFILE_TEMPLATE = 'users/_user_profile.html'
+# Saves of only these fields don't change anything in a profile.
+UNSHOWN_FIELDS = frozenset(['last_login', 'password'])
+
+
+def _version_key(username):
+    return f'user_profile:version:{username}'
+
+
+def _new_version():
+    # When a version key is evicted, restart it from the current time in ms rather than from 1, so that it can't land
+    # on the version of a profile that is still cached.
+    return int(time.time() * 1000)
+
+
+def profile_version(username):
+    key = _version_key(username)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _new_version(), None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_profile(username):
+    key = _version_key(username)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # There's no version yet, so there's no cached profile either; but a get_profile() that is rendering one
+        # right now may store it under a version we'd be reusing, so start a new one anyway.
+        cache.add(key, _new_version(), None)
+
+
+def render_profile(user):
+    return {
+        'pk': user.pk,
+        'username': user.username,
+        'html': render_to_string(PROFILE_TEMPLATE, {'object': user}),
+    }
+
+
+def get_profile(username):
+    """
+    Return the profile dict for the user with the given username, or ``None`` if there is no such user.
+    """
+    key = f'user_profile:{username}:{profile_version(username)}'
+    profile = cache.get(key)
+    if profile is None:
+        user = get_user_model()._default_manager.filter(username=username).first()
+        if user is None:
+            # Missing users aren't cached, so that requests for made-up usernames can't fill up the cache.
+            return None
+        profile = render_profile(user)
+        cache.set(key, profile, getattr(settings, 'USER_PROFILE_CACHE_TIMEOUT', 3600))
+    return profile
+
+
+# noinspection PyUnusedLocal
+def remember_username(sender, instance, **kwargs):
+    """
+    post_init receiver for the User model, which records the username each user was loaded with, so that
+    user_changed() can tell when it changes. Deferred usernames aren't loaded just for this.
+    """
+    instance._profile_username = instance.__dict__.get('username')
+
+
+# noinspection PyUnusedLocal
+def user_changed(sender, instance, update_fields=None, **kwargs):
+    """
+    post_save and post_delete receiver for the User model. UsersConfig.ready() connects this, and remember_username().
+    """
+    if update_fields is not None and set(update_fields) <= UNSHOWN_FIELDS:
+        return
+    usernames = {instance.__dict__.get('username'), getattr(instance, '_profile_username', None)}
+    for username in usernames - {None}:
+        try:
+            invalidate_profile(username)
+        except Exception:  # noqa
+            # This runs on every user save, which a cache outage mustn't break.
+            logger.exception('users.profile.invalidate.failed', username=username)
+    instance._profile_username = instance.__dict__.get('username')
@@ -0,0 +1,126 @@
+"""
+Server-side user search, for the user list page and the admin.
+
+``search_user_pks()`` returns the users whose username or email address starts with the search term, plus those where
+every word of the term starts a word of their first name, last name, full name or email address. Neither half scans
+the user table:
+
+  * the username and email matches are ``LIKE 'term%'`` range scans on the username's unique index and on
+    ``users_user_email_idx``.
+  * on MySQL, the name and email match uses the ``users_user_search`` FULLTEXT index (see migration 0002), in boolean
+    mode with each word as a required prefix (``+word*``). Words shorter than USER_SEARCH_MIN_WORD_LENGTH are left
+    out, since InnoDB doesn't index them (see innodb_ft_min_token_size). Elsewhere, e.g. on SQLite in tests, this
+    falls back to ``istartswith`` lookups, which only match the start of each column rather than of each word in it.
+
+Results are cached for USER_SEARCH_CACHE_TIMEOUT seconds. Saving or deleting a user invalidates every cached search,
+unless the save only touched fields that searches don't look at, like ``last_login``. If the cache is down, that's
+logged and the save goes ahead, and searches may be stale for up to USER_SEARCH_CACHE_TIMEOUT seconds.
+"""
+import hashlib
+import re
+import uuid
+from functools import reduce
+from operator import and_, or_
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Q
+
+from seedling.logging import logger
+
+FULLTEXT_INDEX = 'users_user_search'
+FULLTEXT_FIELDS = ('first_name', 'last_name', 'email', 'full_name')
+PREFIX_FIELDS = ('username', 'email')
+SEARCHED_FIELDS = ('username',) + FULLTEXT_FIELDS
+VERSION_KEY = 'user_search:version'
+_WORD = re.compile(r'\w+')
+
+
+def normalize_term(term):
+    return ' '.join(term.lower().split())
+
+
+def _filter_words(queryset, words):
+    """
+    Filter ``queryset`` down to the users where each of ``words`` starts a word in one of the FULLTEXT_FIELDS.
+    """
+    if connections[queryset.db].vendor == 'mysql':
+        min_length = getattr(settings, 'USER_SEARCH_MIN_WORD_LENGTH', 3)
+        words = [word for word in words if len(word) >= min_length]
+        if not words:
+            return queryset.none()
+        # Django has no FULLTEXT lookup, and filtering on a boolean expression would compare MATCH()'s relevance
+        # score to 1, so this has to be extra().
+        columns = ', '.join(connections[queryset.db].ops.quote_name(field) for field in FULLTEXT_FIELDS)
+        return queryset.extra(
+            where=[f'MATCH ({columns}) AGAINST (%s IN BOOLEAN MODE)'],
+            params=[' '.join(f'+{word}*' for word in words)],
+        )
+    return queryset.filter(reduce(and_, (
+        reduce(or_, (Q(**{f'{field}__istartswith': word}) for field in FULLTEXT_FIELDS)) for word in words
+    )))
+
+
+def _search(term, limit):
+    users = get_user_model()._default_manager.order_by('username').values_list('pk', flat=True)
+    pks = list(users.filter(reduce(or_, (Q(**{f'{field}__istartswith': term}) for field in PREFIX_FIELDS)))[:limit])
+    words = _WORD.findall(term)
+    if words and len(pks) < limit:
+        seen = set(pks)
+        # Ask for enough rows that the ones we already have from the prefix match can't crowd out the rest.
+        pks.extend(pk for pk in _filter_words(users, words)[:limit + len(pks)] if pk not in seen)
+    return pks[:limit]
+
+
+def _cache_key(term, limit):
+    version = cache.get_or_set(VERSION_KEY, uuid.uuid4().hex, None)
+    digest = hashlib.md5(term.encode('utf-8')).hexdigest()
+    return f'user_search:{version}:{limit}:{digest}'
+
+
+def search_user_pks(term, limit=None):
+    """
+    Return the pks of the first ``limit`` (default: USER_SEARCH_MAX_RESULTS) users matching ``term``, ordered by
+    username, with the username and email prefix matches first.
+    """
+    term = normalize_term(term)
+    if limit is None:
+        limit = getattr(settings, 'USER_SEARCH_MAX_RESULTS', 1000)
+    if not term:
+        return []
+    key = _cache_key(term, limit)
+    pks = cache.get(key)
+    if pks is None:
+        pks = _search(term, limit)
+        cache.set(key, pks, getattr(settings, 'USER_SEARCH_CACHE_TIMEOUT', 60))
+    return pks
+
+
+def search_users(queryset, term, limit=None):
+    """
+    Filter the given User queryset down to the users that search_user_pks() finds for ``term``.
+    """
+    return queryset.filter(pk__in=search_user_pks(term, limit))
+
+
+def invalidate_search_cache():
+    """
+    Make every cached search result stale. They're not deleted, just never looked up again, so they expire on their own.
+    """
+    try:
+        cache.set(VERSION_KEY, uuid.uuid4().hex, None)
+    except Exception:  # noqa
+        # This runs on every user save, which a cache outage mustn't break.
+        logger.exception('users.search.invalidate.failed')
+
+
+# noinspection PyUnusedLocal
+def user_saved(sender, instance, created=False, update_fields=None, **kwargs):
+    """
+    post_save and post_delete receiver for the User model, which is connected in UsersConfig.ready().
+    """
+    if update_fields is not None and not set(update_fields) & set(SEARCHED_FIELDS):
+        return
+    invalidate_search_cache()
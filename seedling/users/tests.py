@@ -1,3 +1,321 @@
-from django.test import TestCase
+import csv
+import io
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.contrib.messages import get_messages
+from django.core.cache import cache
+from django.http import Http404
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import path, reverse
+from django.views.generic import ListView
+
+from .models import User
+from .profiles import get_profile
+from .search import search_user_pks
+from .views import KeysetPaginationMixin, UserDetailView, UserExportView, UserListView
+
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'users'}}
+
+# seedling.urls only has the admin in development. UserSearchTests uses this as its ROOT_URLCONF instead.
+urlpatterns = [
+    path('admin/', admin.site.urls),
+]
+
+
+class UsersByPk(KeysetPaginationMixin, ListView):
+
+    model = User
+    paginate_by = 2
+
+
+class UsersByFullName(KeysetPaginationMixin, ListView):
+
+    model = User
+    keyset_field = 'full_name'
+    paginate_by = 2
+
+
+class KeysetPaginationTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        # Created out of name order, so that name order and pk order differ.
+        cls.users = {
+            username: User.objects.create_user(username, full_name=full_name)
+            for username, full_name in [('dave', 'Same'), ('alice', 'Same'), ('eve', 'Other'), ('carol', 'Same'),
+                                        ('bob', 'Same')]
+        }
+
+    def page(self, view_class, **params):
+        response = view_class.as_view()(RequestFactory().get('/', params))
+        context = response.context_data
+        return [user.username for user in context['object_list']], context['previous_cursor'], context['next_cursor']
+
+    def list_page(self, **params):
+        self.client.force_login(self.users['alice'])
+        with mock.patch.object(UserListView, 'paginate_by', 2):
+            response = self.client.get(reverse('users:users--list'), params)
+        self.assertEqual(response.status_code, 200)
+        context = response.context
+        return [user.username for user in context['object_list']], context['previous_cursor'], context['next_cursor']
+
+    def test_after_cursor(self):
+        self.assertEqual(self.list_page(), (['alice', 'bob'], None, 'bob'))
+        self.assertEqual(self.list_page(after='bob'), (['carol', 'dave'], 'carol', 'dave'))
+        self.assertEqual(self.list_page(after='dave'), (['eve'], 'eve', None))
+
+    def test_before_cursor(self):
+        self.assertEqual(self.list_page(before='eve'), (['carol', 'dave'], 'carol', 'dave'))
+        self.assertEqual(self.list_page(before='carol'), (['alice', 'bob'], None, 'bob'))
+
+    def test_ties_are_ordered_by_pk(self):
+        expected = ['eve'] + [user.username for user in User.objects.filter(full_name='Same').order_by('pk')]
+        seen, cursor = [], None
+        while True:
+            usernames, _, cursor = self.page(UsersByFullName, **({'after': cursor} if cursor else {}))
+            seen.extend(usernames)
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+        # Walking back from the last page gives the same pages in reverse.
+        self.assertEqual(self.page(UsersByFullName, before=f'Same,{self.users[expected[-1]].pk}')[0], expected[2:4])
+
+    def test_cursor_for_a_non_unique_field_includes_the_pk(self):
+        usernames, _, cursor = self.page(UsersByFullName)
+        self.assertEqual(cursor, f'Same,{self.users[usernames[-1]].pk}')
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(Http404):
+            self.page(UsersByPk, after='bob')
+        with self.assertRaises(Http404):
+            self.page(UsersByFullName, before='Same')
+        with self.assertRaises(Http404):
+            self.page(UsersByFullName, after='Same,bob')
+
+
+class UserExportViewTests(TestCase):
+
+    url = reverse('users:users--export')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', full_name='Staff', email='staff@example.com', is_staff=True)
+
+    def export(self):
+        self.client.force_login(self.staff)
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        return list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+    def test_staff_only(self):
+        self.assertRedirects(self.client.get(self.url), f"{reverse('account_login')}?next={self.url}",
+                             fetch_redirect_response=False)
+        self.client.force_login(User.objects.create_user('someone'))
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_exports_every_user_in_chunks(self):
+        for number in range(4):
+            User.objects.create_user(f'user{number}')
+        with mock.patch.object(UserExportView, 'chunk_size', 2):
+            rows = self.export()
+        self.assertEqual(rows[0], UserExportView.fields)
+        self.assertEqual([row[0] for row in rows[1:]], ['staff', 'user0', 'user1', 'user2', 'user3'])
+
+    def test_formulas_are_escaped(self):
+        for number, full_name in enumerate(['=HYPERLINK("http://example.com")', '+1', '-1', '@SUM(A1)', 'A=B']):
+            User.objects.create_user(f'user{number}', full_name=full_name)
+        rows = self.export()
+        self.assertEqual(
+            [row[1] for row in rows[2:]],
+            ['\'=HYPERLINK("http://example.com")', "'+1", "'-1", "'@SUM(A1)", 'A=B']
+        )
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserSearchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.users = {
+            username: User.objects.create_user(username, **fields)
+            for username, fields in [
+                ('alice', {'email': 'bob@example.com'}),
+                ('bobby', {}),
+                ('carol', {'first_name': 'Bob', 'last_name': 'Smith', 'full_name': 'Bob Smith'}),
+                ('dave', {'full_name': 'Jim Bob'}),
+                ('eve', {'first_name': 'Bobbie', 'last_name': 'Smithers'}),
+            ]
+        }
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def search(self, term, limit=None):
+        return [User.objects.get(pk=pk).username for pk in search_user_pks(term, limit)]
+
+    def test_prefix_matches_come_before_word_matches(self):
+        # On SQLite, words only match the start of each field, so "Jim Bob" isn't found.
+        self.assertEqual(self.search('Bob'), ['alice', 'bobby', 'carol', 'eve'])
+
+    def test_every_word_must_match(self):
+        self.assertEqual(self.search('bob smith'), ['carol', 'eve'])
+        self.assertEqual(self.search('  BOB   Smithers '), ['eve'])
+        self.assertEqual(self.search('bob jones'), [])
+
+    def test_empty_term(self):
+        self.assertEqual(self.search('   '), [])
+
+    def test_limit(self):
+        self.assertEqual(self.search('bob', limit=3), ['alice', 'bobby', 'carol'])
+
+    def test_results_are_cached(self):
+        self.search('bob')
+        with self.assertNumQueries(0):
+            search_user_pks('bob')
+
+    def test_saving_a_user_invalidates_the_cache(self):
+        self.assertEqual(self.search('zed'), [])
+        User.objects.create_user('zed')
+        self.assertEqual(self.search('zed'), ['zed'])
+        user = self.users['dave']
+        user.full_name = 'Zed Bob'
+        user.save()
+        self.assertEqual(self.search('zed'), ['zed', 'dave'])
+        user.delete()
+        self.assertEqual(self.search('zed'), ['zed'])
+
+    def test_saving_unsearched_fields_keeps_the_cache(self):
+        self.search('bob')
+        self.users['alice'].save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            search_user_pks('bob')
+
+    def test_a_cache_outage_does_not_break_saves(self):
+        with mock.patch('seedling.users.search.cache') as broken_cache, \
+                mock.patch('seedling.users.search.logger') as logger:
+            broken_cache.set.side_effect = ConnectionError('Error 111 connecting to redis:6379. Connection refused.')
+            User.objects.create_user('zed')
+        logger.exception.assert_called_once_with('users.search.invalidate.failed')
+        self.assertTrue(User.objects.filter(username='zed').exists())
+
+    def changelist(self, term):
+        self.client.force_login(self.admin)
+        response = self.client.get(reverse('admin:users_user_changelist'), {'q': term})
+        self.assertEqual(response.status_code, 200)
+        return (
+            sorted(user.username for user in response.context['cl'].result_list),
+            [str(message) for message in get_messages(response.wsgi_request)],
+        )
+
+    @override_settings(ROOT_URLCONF='seedling.users.tests')
+    def test_admin_search(self):
+        self.assertEqual(self.changelist('bob smith'), (['carol', 'eve'], []))
+
+    @override_settings(ROOT_URLCONF='seedling.users.tests', USER_SEARCH_MAX_RESULTS=2)
+    def test_admin_search_says_when_results_are_cut_off(self):
+        self.assertEqual(self.changelist('bob'), (
+            ['alice', 'bobby'],
+            ['Only the first 2 users matching this search are shown. Try a longer search term.'],
+        ))
+        self.assertEqual(self.changelist('bob smith'), (['carol', 'eve'], []))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class UserProfileCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', full_name='Alice')
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    def detail(self, username='alice'):
+        request = RequestFactory().get(reverse('users:user--detail', kwargs={'username': username}))
+        request.user = self.user
+        return UserDetailView.as_view()(request, username=username).render()
+
+    def test_repeated_views_are_served_from_the_cache(self):
+        self.assertContains(self.detail(), '<h2>alice</h2>', html=True)
+        with self.assertNumQueries(0):
+            self.assertContains(self.detail(), '<h2>alice</h2>', html=True)
+
+    def test_missing_users_are_not_cached(self):
+        with self.assertRaises(Http404):
+            self.detail('nobody')
+        with self.assertNumQueries(1), self.assertRaises(Http404):
+            self.detail('nobody')
+
+    def test_saving_the_user_invalidates_the_profile(self):
+        get_profile('alice')
+        user = User.objects.get(pk=self.user.pk)
+        user.full_name = 'Alice Smith'
+        user.save()
+        with self.assertNumQueries(1):
+            get_profile('alice')
+
+    def test_renaming_the_user_invalidates_both_usernames(self):
+        get_profile('alice')
+        user = User.objects.get(pk=self.user.pk)
+        user.username = 'alicia'
+        user.save()
+        self.assertIsNone(get_profile('alice'))
+        self.assertEqual(get_profile('alicia')['username'], 'alicia')
+        # Renaming back must not bring back the profile cached under the old username's old version.
+        get_profile('alicia')
+        user.username = 'alice'
+        user.save()
+        self.assertIsNone(get_profile('alicia'))
+        self.assertEqual(get_profile('alice')['username'], 'alice')
+
+    def test_deleting_the_user_invalidates_the_profile(self):
+        get_profile('alice')
+        User.objects.get(pk=self.user.pk).delete()
+        self.assertIsNone(get_profile('alice'))
+
+    def test_a_cache_outage_does_not_break_saves(self):
+        with mock.patch('seedling.users.profiles.cache') as broken_cache, \
+                mock.patch('seedling.users.profiles.logger') as logger:
+            broken_cache.incr.side_effect = ConnectionError('Error 111 connecting to redis:6379. Connection refused.')
+            User.objects.create_user('zed')
+        logger.exception.assert_called_once_with('users.profile.invalidate.failed', username='zed')
+        self.assertTrue(User.objects.filter(username='zed').exists())
+
+    def test_saving_only_last_login_keeps_the_profile(self):
+        get_profile('alice')
+        self.client.force_login(self.user)
+        self.user.save(update_fields=['last_login'])
+        with self.assertNumQueries(0):
+            get_profile('alice')
+
+
+class UserUpdateViewTests(TestCase):
+
+    url = reverse('users:user--update')
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('alice', full_name='Alice')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+
+    def test_update(self):
+        response = self.client.post(self.url, {'full_name': 'Alice Smith'})
+        self.assertRedirects(response, reverse('users:user--detail', kwargs={'username': 'alice'}),
+                             fetch_redirect_response=False)
+        self.assertEqual(User.objects.get(pk=self.user.pk).full_name, 'Alice Smith')
+
+    def test_invalid_form_leaves_request_user_alone(self):
+        response = self.client.post(self.url, {'full_name': 'x' * 256})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['form'].errors)
+        self.assertIsNot(response.context['object'], response.wsgi_request.user)
+        self.assertEqual(response.wsgi_request.user.full_name, 'Alice')
+        self.assertEqual(User.objects.get(pk=self.user.pk).full_name, 'Alice')
@@ -3,6 +3,7 @@
 from django.urls import path
 
 from seedling.users.views import (
+    UserExportView,
     UserListView,
     UserRedirectView,
     UserUpdateView,
@@ -12,6 +13,7 @@ from seedling.users.views import (
 app_name = "users"
 urlpatterns = [
     path("", view=UserListView.as_view(), name="users--list"),
+    path("~export/", view=UserExportView.as_view(), name="users--export"),
     path("~redirect/", view=UserRedirectView.as_view(), name="user--redirect"),
     path("~update/", view=UserUpdateView.as_view(), name="user--update"),
     path("<str:username>/", view=UserDetailView.as_view(), name="user--detail"),
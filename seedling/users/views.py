@@ -1,14 +1,93 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import csv
+
 from django.contrib.auth import get_user_model
-from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404, StreamingHttpResponse
 from django.urls import reverse
-from django.views.generic import DetailView, ListView, RedirectView, UpdateView
+from django.views.generic import DetailView, ListView, RedirectView, UpdateView, View
+
+from seedling.users.profiles import get_profile
+from seedling.users.search import search_users
 
 User = get_user_model()
 
 
+class KeysetPaginationMixin(object):
+    """
+    Paginates a ListView by the value of ``keyset_field``, which should be indexed, instead of with LIMIT/OFFSET. Every
+    page is then a single index range scan, however deep into the list it is.
+
+    The page after the current one is requested with ``?after=<cursor>``, and the page before it with
+    ``?before=<cursor>``. The context gets ``next_cursor`` and ``previous_cursor``, either of which is ``None`` when
+    there's no such page. If ``keyset_field`` is unique, a cursor is just the value of the last (or first) row on the
+    page. Otherwise, rows with the same value are ordered by their pk, and the cursor is ``<value>,<pk>``.
+    """
+
+    keyset_field = 'pk'
+    paginate_by = 50
+
+    def paginate_queryset(self, queryset, page_size):
+        after = self.request.GET.get('after')
+        before = self.request.GET.get('before')
+        field = self.keyset_field
+        unique = self._keyset_model_field(queryset).unique
+        ordering = [field] if unique else [field, 'pk']
+        if before is not None:
+            # Read the previous page backwards from the cursor, then put it back in order.
+            queryset = queryset.filter(self._keyset_filter(queryset, before, 'lt'))
+            rows = list(queryset.order_by(*[f'-{name}' for name in ordering])[:page_size + 1])
+            has_more_before = len(rows) > page_size
+            rows = rows[:page_size][::-1]
+            has_more_after = True
+        else:
+            if after is not None:
+                queryset = queryset.filter(self._keyset_filter(queryset, after, 'gt'))
+            rows = list(queryset.order_by(*ordering)[:page_size + 1])
+            has_more_after = len(rows) > page_size
+            rows = rows[:page_size]
+            has_more_before = after is not None
+        self.next_cursor = self._keyset_cursor(rows[-1], unique) if rows and has_more_after else None
+        self.previous_cursor = self._keyset_cursor(rows[0], unique) if rows and has_more_before else None
+        # ListView expects (paginator, page, object_list, is_paginated).
+        return None, None, rows, self.next_cursor is not None or self.previous_cursor is not None
+
+    def _keyset_model_field(self, queryset):
+        meta = queryset.model._meta
+        return meta.pk if self.keyset_field == 'pk' else meta.get_field(self.keyset_field)
+
+    def _keyset_cursor(self, row, unique):
+        value = getattr(row, self.keyset_field)
+        return value if unique else f'{value},{row.pk}'
+
+    def _keyset_filter(self, queryset, cursor, lookup):
+        """
+        Return a Q for the rows after (``lookup`` is "gt") or before ("lt") ``cursor``, or raise Http404 if ``cursor``
+        isn't one of ours, just like ListView does for a bad page number.
+        """
+        field = self.keyset_field
+        model_field = self._keyset_model_field(queryset)
+        try:
+            if model_field.unique:
+                return Q(**{f'{field}__{lookup}': model_field.to_python(cursor)})
+            value, pk = cursor.rsplit(',', 1)
+            value = model_field.to_python(value)
+            pk = queryset.model._meta.pk.to_python(pk)
+        except (ValueError, ValidationError):
+            raise Http404('Invalid page cursor.')
+        return Q(**{f'{field}__{lookup}': value}) | Q(**{field: value, f'pk__{lookup}': pk})
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['next_cursor'] = getattr(self, 'next_cursor', None)
+        context['previous_cursor'] = getattr(self, 'previous_cursor', None)
+        return context
+
+
 class UserDetailView(
     LoginRequiredMixin,
     DetailView
@@ -18,15 +97,97 @@ class UserDetailView(
     slug_field = "username"
     slug_url_kwarg = "username"
 
+    def get_object(self, queryset=None):
+        """
+        Return the user's cached profile dict (see seedling.users.profiles), rather than the user.
+        """
+        profile = get_profile(self.kwargs[self.slug_url_kwarg])
+        if profile is None:
+            raise Http404("No user found matching the query")
+        return profile
+
 
 class UserListView(
     LoginRequiredMixin,
+    KeysetPaginationMixin,
     ListView
 ):
 
     model = User
     slug_field = "username"
     slug_url_kwarg = "username"
+    # username is unique, and thus indexed.
+    keyset_field = "username"
+    paginate_by = 50
+
+    def get_queryset(self):
+        # The list only shows usernames, so don't load (or audit snapshot) the rest of each row.
+        queryset = User.objects.only("pk", "username")
+        term = self.request.GET.get("q", "").strip()
+        if term:
+            queryset = search_users(queryset, term)
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["q"] = self.request.GET.get("q", "").strip()
+        return context
+
+
+class _Echo(object):
+    """
+    A file-like object whose write() returns what it was given, so that csv.writer can feed a streaming response.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _csv_safe(value):
+    """
+    Keep spreadsheet programs from running a cell as a formula, by prefixing the characters that start one with "'".
+    """
+    if isinstance(value, str) and value.startswith(('=', '+', '-', '@', '\t', '\r')):
+        return f"'{value}"
+    return value
+
+
+class UserExportView(
+    LoginRequiredMixin,
+    UserPassesTestMixin,
+    View
+):
+    """
+    Streams all the users as CSV, for staff only. The rows are read in keyset-paginated chunks, so neither the
+    database driver nor this process ever holds the whole table in memory. Users choose their own names, so cells
+    that a spreadsheet would treat as formulas are escaped.
+    """
+
+    chunk_size = 2000
+    fields = ["username", "full_name", "email", "is_active", "date_joined"]
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def rows(self):
+        writer = csv.writer(_Echo())
+        yield writer.writerow(self.fields)
+        last = None
+        while True:
+            queryset = User.objects.order_by("username").values_list(*self.fields)
+            if last is not None:
+                queryset = queryset.filter(username__gt=last)
+            chunk = list(queryset[:self.chunk_size])
+            for row in chunk:
+                yield writer.writerow([_csv_safe(value) for value in row])
+            if len(chunk) < self.chunk_size:
+                return
+            last = chunk[-1][0]
+
+    def get(self, request, *args, **kwargs):
+        response = StreamingHttpResponse(self.rows(), content_type="text/csv")
+        response["Content-Disposition"] = 'attachment; filename="users.csv"'
+        return response
 
 
 class UserUpdateView(
@@ -40,8 +201,10 @@ class UserUpdateView(
     def get_success_url(self):
         return reverse("users:user--detail", kwargs={"username": self.request.user.username})
 
-    def get_object(self):
-        return User.objects.get(username=self.request.user.username)
+    def get_object(self, queryset=None):
+        # Edit a copy, rather than request.user, so that a form that fails validation doesn't leave its values on the
+        # user that the rest of the request (and its log lines) sees.
+        return User.objects.get(pk=self.request.user.pk)
 
 
 class UserRedirectView(